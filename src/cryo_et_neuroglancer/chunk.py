@@ -1,25 +1,84 @@
+import gzip
 from dataclasses import dataclass
 from pathlib import Path
+from typing import Optional
+
+# Extension of the pre-compressed chunk files, as expected by static file
+# servers sending them with "Content-Encoding: gzip" (nginx gzip_static,
+# Caddy precompressed, http-server --gzip)
+GZIP_EXTENSION = ".gz"
+
+
+def get_chunk_name(
+    dimensions: tuple[tuple[int, int, int], tuple[int, int, int]],
+) -> str:
+    """Return the name of the chunk with the given dimensions, in z, y, x order"""
+    z_begin, z_end = dimensions[0][0], dimensions[1][0]
+    y_begin, y_end = dimensions[0][1], dimensions[1][1]
+    x_begin, x_end = dimensions[0][2], dimensions[1][2]
+    return f"{x_begin}-{x_end}_{y_begin}-{y_end}_{z_begin}-{z_end}"
 
 
 @dataclass
 class Chunk:
     buffer: bytearray
     dimensions: tuple[tuple[int, int, int], tuple[int, int, int]]
+    is_empty: bool = False
+    # Number of blocks with packed values, and how many of them reuse the
+    # packed values of an identical block
+    nb_packed_blocks: int = 0
+    nb_deduplicated_blocks: int = 0
+    # Index of the scale of the chunk in a multiscale pyramid, 0 at full resolution
+    scale: int = 0
+    # Size of the written file, smaller than the buffer once compressed
+    nb_written_bytes: int = 0
 
     def get_name(self) -> str:
         """Return the name of the chunk"""
-        z_begin, z_end = self.dimensions[0][0], self.dimensions[1][0]
-        y_begin, y_end = self.dimensions[0][1], self.dimensions[1][1]
-        x_begin, x_end = self.dimensions[0][2], self.dimensions[1][2]
-        return f"{x_begin}-{x_end}_{y_begin}-{y_end}_{z_begin}-{z_end}"
+        return get_chunk_name(self.dimensions)
+
+    def get_file(
+        self, compression_level: Optional[int] = None
+    ) -> tuple[str, bytes | bytearray]:
+        """Return the name and the content of the chunk file
+
+        With a `compression_level`, the content is gzip compressed at this
+        level and the name ends with the ".gz" extension.
+        """
+        if compression_level is None:
+            return self.get_name(), self.buffer
+        # A fixed modification time keeps the output reproducible
+        content = gzip.compress(self.buffer, compresslevel=compression_level, mtime=0)
+        return self.get_name() + GZIP_EXTENSION, content
+
+    def write_to_directory(
+        self,
+        directory: Path,
+        skip_empty: bool = False,
+        compression_level: Optional[int] = None,
+    ) -> bool:
+        """Write the chunk to the given directory
+
+        If `skip_empty` is set, chunks only containing background are not written.
+        This relies on neuroglancer considering missing chunks as filled with zeros.
+
+        With a `compression_level`, the chunk is written gzip compressed in a
+        ".gz" file, for static file servers to send as is with
+        "Content-Encoding: gzip", see `get_file`.
 
-    def write_to_directory(self, directory: Path) -> None:
-        """Write the chunk to the given directory"""
+        Returns
+        -------
+        bool
+            True if the chunk was written, False if it was skipped
+        """
+        if skip_empty and self.is_empty:
+            return False
         directory.mkdir(parents=True, exist_ok=True)
-        output_filename = self.get_name()
+        output_filename, content = self.get_file(compression_level)
         output_filepath = directory / output_filename
-        output_filepath.write_bytes(self.buffer)
+        output_filepath.write_bytes(content)
+        self.nb_written_bytes = len(content)
+        return True
 
     @property
     def shape(self) -> tuple[int, int, int]:
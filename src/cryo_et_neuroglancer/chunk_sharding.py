@@ -0,0 +1,245 @@
+import json
+from collections import Counter
+from math import ceil, log2
+from pathlib import Path
+from typing import Any, Optional
+
+import numpy as np
+
+from .chunk import Chunk
+from .chunk_writer import ChunkWriter
+from .conversion_manifest import ConversionManifest
+from .sharding import ShardingSpecification, synthesize_shard_file
+
+# Uncompressed size of the chunks of a shard, as chosen by default in igneous
+DEFAULT_SHARD_NB_BYTES = 3_500_000_000
+# Consecutive chunks in Morton order sharing a minishard, 2 x 2 x 2 chunks
+MAX_PRESHIFT_BITS = 3
+
+
+def _get_nb_bits(grid_size: tuple[int, int, int]) -> tuple[int, int, int]:
+    """Return the number of bits of the chunk position along each axis"""
+    nb_bits = [ceil(log2(size)) if size > 1 else 0 for size in grid_size]
+    return nb_bits[0], nb_bits[1], nb_bits[2]
+
+
+def compressed_morton_code(
+    grid_positions: np.ndarray, grid_size: tuple[int, int, int]
+) -> np.ndarray:
+    """
+    Return the compressed Morton code of the chunks, used as the key of the chunks in shards
+
+    The bits of the x, y and z positions are interleaved, starting from the
+    least significant bits and with x first. Once all the bits of an axis are
+    used, the axis is skipped.
+
+    Parameters
+    ----------
+    grid_positions : np.ndarray
+        The positions of the chunks in the grid, with shape (nb_chunks, 3) in z, y, x order
+    grid_size : tuple[int, int, int]
+        The number of chunks along each axis, in z, y, x order
+
+    Returns
+    -------
+    np.ndarray
+        The uint64 codes of the chunks
+    """
+    positions = np.asarray(grid_positions, dtype=np.uint64).reshape(-1, 3)
+    nb_bits = _get_nb_bits(grid_size)
+    codes = np.zeros(len(positions), dtype=np.uint64)
+    output_bit = 0
+    for bit in range(max(nb_bits)):
+        for axis in (2, 1, 0):
+            if bit < nb_bits[axis]:
+                value = (positions[:, axis] >> np.uint64(bit)) & np.uint64(1)
+                codes |= value << np.uint64(output_bit)
+                output_bit += 1
+    return codes
+
+
+def compute_sharding_specification(
+    grid_size: tuple[int, int, int],
+    chunk_nb_bytes: int,
+    target_shard_nb_bytes: int = DEFAULT_SHARD_NB_BYTES,
+) -> ShardingSpecification:
+    """
+    Choose the sharding of a scale from its number of chunks and the target shard size
+
+    Each shard gathers the largest power of two of chunks, consecutive in
+    Morton order so close in space, whose uncompressed size does not exceed
+    the target. Inside a shard, blocks of up to 2 x 2 x 2 chunks share a
+    minishard, so one minishard index lookup serves neighbouring chunks.
+
+    Parameters
+    ----------
+    grid_size : tuple[int, int, int]
+        The number of chunks along each axis
+    chunk_nb_bytes : int
+        The uncompressed size of a chunk
+    target_shard_nb_bytes : int
+        The uncompressed size of the chunks of a shard to aim for
+    """
+    nb_key_bits = sum(_get_nb_bits(grid_size))
+    chunks_per_shard = max(target_shard_nb_bytes // max(chunk_nb_bytes, 1), 1)
+    nb_chunk_bits = min(int(log2(chunks_per_shard)), nb_key_bits)
+    preshift_bits = min(MAX_PRESHIFT_BITS, nb_chunk_bits)
+    return ShardingSpecification(
+        type="neuroglancer_uint64_sharded_v1",
+        preshift_bits=preshift_bits,
+        hash="identity",
+        minishard_bits=nb_chunk_bits - preshift_bits,
+        shard_bits=nb_key_bits - nb_chunk_bits,
+        minishard_index_encoding="gzip",
+        data_encoding="raw",
+    )
+
+
+def get_sharding_metadata(specification: ShardingSpecification) -> dict[str, Any]:
+    """Return the sharding specification as the JSON compatible "sharding" entry of a scale"""
+    return json.loads(specification.to_json())
+
+
+class ShardedChunkWriter:
+    """
+    Gather the encoded chunks of a scale and write each shard as soon as it is complete
+
+    The chunks can come in any order. Only the encoded chunks of the shards
+    not written yet are kept. With a `staging_directory`, they wait in one
+    staging file per shard instead of in memory, and are read back when their
+    shard is complete: the memory used is then bounded by the size of a
+    shard, not by the size of the scale, even when the tiles complete the
+    shards in the last ones.
+
+    With a `manifest`, the shards are written atomically and recorded, and the
+    shards already recorded by an interrupted conversion are not written again:
+    their chunks are ignored. With a `writer`, the shards are queued to it
+    instead of being written by the caller.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        specification: ShardingSpecification,
+        chunk_size: tuple[int, int, int],
+        grid_size: tuple[int, int, int],
+        manifest: Optional[ConversionManifest] = None,
+        writer: Optional[ChunkWriter] = None,
+        staging_directory: Optional[Path] = None,
+    ):
+        self.directory = directory
+        self.specification = specification
+        self.chunk_size = chunk_size
+        self.grid_size = grid_size
+        all_positions = np.indices(grid_size).reshape(3, -1).T
+        all_codes = compressed_morton_code(all_positions, grid_size)
+        self.nb_missing_chunks = Counter(self._get_shard_numbers(all_codes))
+        self.shards: dict[int, dict[int, bytes]] = {}
+        self.staging_directory = staging_directory
+        # Offset and size of the staged chunks in the staging file of their shard
+        self.staged_chunks: dict[int, dict[int, tuple[int, int]]] = {}
+        self._staged_nb_bytes: Counter[int] = Counter()
+        self.nb_written_shards = 0
+        self.manifest = manifest
+        self.writer = writer
+        self.completed_shards: set[int] = set()
+        if manifest is not None:
+            self.completed_shards = {
+                shard_number
+                for shard_number in self.nb_missing_chunks
+                if manifest.is_done(self._get_shard_path(shard_number))
+            }
+            for shard_number in self.completed_shards:
+                del self.nb_missing_chunks[shard_number]
+
+    def _get_shard_numbers(self, codes: np.ndarray) -> list[int]:
+        spec = self.specification
+        shifted = codes >> np.uint64(spec.preshift_bits + spec.minishard_bits)
+        shard_mask = np.uint64((1 << int(spec.shard_bits)) - 1)
+        return [int(shard) for shard in shifted & shard_mask]
+
+    def _get_shard_path(self, shard_number: int) -> Path:
+        # The hash is the identity, the shard number is the name in hexadecimal
+        nb_digits = ceil(self.specification.shard_bits / 4)
+        return self.directory / f"{format(shard_number, 'x').zfill(nb_digits)}.shard"
+
+    def _get_chunk_key(self, start: tuple[int, int, int]) -> tuple[int, int]:
+        """Return the Morton code and the shard number of the chunk starting at `start`"""
+        position = [s // c for s, c in zip(start, self.chunk_size)]
+        code = int(compressed_morton_code(np.array([position]), self.grid_size)[0])
+        shard_number = self._get_shard_numbers(np.array([code], dtype=np.uint64))[0]
+        return code, shard_number
+
+    def is_chunk_done(
+        self, dimensions: tuple[tuple[int, int, int], tuple[int, int, int]]
+    ) -> bool:
+        """Return True if the shard of the chunk was written by a previous conversion"""
+        return self._get_chunk_key(dimensions[0])[1] in self.completed_shards
+
+    def add(self, chunk: Chunk, skip_empty: bool = False) -> None:
+        """Add the chunk to its shard, the empty chunks are left out if `skip_empty` is set"""
+        code, shard_number = self._get_chunk_key(chunk.dimensions[0])
+        if shard_number in self.completed_shards:
+            return
+        if not (skip_empty and chunk.is_empty):
+            if self.staging_directory is not None:
+                self._stage(shard_number, code, chunk.buffer)
+            else:
+                self.shards.setdefault(shard_number, {})[code] = bytes(chunk.buffer)
+        self.nb_missing_chunks[shard_number] -= 1
+        if self.nb_missing_chunks[shard_number] == 0:
+            self._write_shard(shard_number)
+
+    def _get_staging_path(self, shard_number: int) -> Path:
+        assert self.staging_directory is not None
+        return self.staging_directory / f"{shard_number:x}.chunks"
+
+    def _stage(self, shard_number: int, code: int, content: bytes | bytearray) -> None:
+        """Append the chunk to the staging file of its shard"""
+        path = self._get_staging_path(shard_number)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "ab") as staging_file:
+            staging_file.write(content)
+        offset = self._staged_nb_bytes[shard_number]
+        self.staged_chunks.setdefault(shard_number, {})[code] = (offset, len(content))
+        self._staged_nb_bytes[shard_number] += len(content)
+
+    def _unstage(self, shard_number: int) -> dict[int, memoryview]:
+        """Read back the staged chunks of the shard, and delete its staging file"""
+        offsets = self.staged_chunks.pop(shard_number, None)
+        if offsets is None:
+            return {}
+        del self._staged_nb_bytes[shard_number]
+        path = self._get_staging_path(shard_number)
+        content = memoryview(path.read_bytes())
+        path.unlink()
+        return {code: content[o : o + size] for code, (o, size) in offsets.items()}
+
+    def _write_shard(self, shard_number: int) -> None:
+        chunks: dict[int, Any] = self.shards.pop(shard_number, {})
+        chunks.update(self._unstage(shard_number))
+        path = self._get_shard_path(shard_number)
+        self.completed_shards.add(shard_number)
+        if not chunks:
+            if self.manifest is not None:
+                self.manifest.record_empty(path)
+            return
+        content = synthesize_shard_file(self.specification, chunks)
+        if self.writer is not None:
+            self.writer.write(path, content)
+            self.nb_written_shards += 1
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if self.manifest is not None:
+            self.manifest.write(path, content)
+        else:
+            path.write_bytes(content)
+        self.nb_written_shards += 1
+
+    def close(self) -> None:
+        """Check that all the chunks were added"""
+        incomplete = [n for n, count in self.nb_missing_chunks.items() if count > 0]
+        if incomplete:
+            raise ValueError(
+                f"{len(incomplete)} shards are missing chunks and were not written"
+            )
@@ -0,0 +1,163 @@
+import threading
+from pathlib import Path
+from queue import Queue
+from typing import Optional
+
+from .chunk import GZIP_EXTENSION, Chunk
+from .conversion_manifest import ConversionManifest
+from .io import write_bytes, write_bytes_atomically
+from .storage import Uploader
+
+DEFAULT_WRITER_WORKERS = 4
+
+
+class ChunkWriter:
+    """
+    Write chunk files from a pool of threads, fed through a bounded queue
+
+    The encoding threads only queue the files, the writes happen concurrently
+    in the background, which matters on network filesystems where each write
+    waits for a round trip. When `max_queued` files are waiting, queuing a
+    new one blocks until a write completes, so the encoding can not get too
+    far ahead of the disk and the memory used stays bounded. Each output
+    directory is created once.
+
+    The durability of the files is a trade-off with the throughput:
+    - with `fsync`, the content of each file is flushed to the disk before the
+      write is considered done,
+    - with `atomic`, each file is written to a temporary name then renamed, so
+      a file is never seen partially written.
+    With a `manifest`, the files are always written atomically, and recorded
+    once written.
+
+    With an `uploader`, the files are uploaded to an object store instead,
+    keyed by their path, which is then relative to the destination. Each
+    thread then holds an upload in flight, and the gzip compressed chunks
+    keep their name and are served with "Content-Encoding: gzip".
+
+    An error raised by a write is re-raised by the next call to `write` or
+    by `close`. The writer is a context manager, closed on exit.
+    """
+
+    def __init__(
+        self,
+        workers: int = DEFAULT_WRITER_WORKERS,
+        max_queued: Optional[int] = None,
+        fsync: bool = False,
+        atomic: bool = False,
+        manifest: Optional[ConversionManifest] = None,
+        uploader: Optional[Uploader] = None,
+    ):
+        if workers < 1:
+            raise ValueError(
+                f"The number of writer workers must be positive, got {workers}"
+            )
+        self.fsync = fsync
+        self.atomic = atomic or manifest is not None
+        self.manifest = manifest
+        self.uploader = uploader
+        self._queue: Queue[Optional[tuple[Path, bytes | bytearray, Optional[str]]]] = (
+            Queue(maxsize=max_queued or 2 * workers)
+        )
+        self._directories: set[Path] = set()
+        self._lock = threading.Lock()
+        self._error: Optional[BaseException] = None
+        self._threads = [
+            threading.Thread(target=self._work, daemon=True) for _ in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self) -> None:
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                return
+            if self._error is not None:
+                # Keep consuming so that the callers waiting on the queue are released
+                continue
+            try:
+                self._write_file(*entry)
+            except BaseException as error:
+                self._error = error
+
+    def _write_file(
+        self, path: Path, content: bytes | bytearray, content_encoding: Optional[str]
+    ) -> None:
+        if self.uploader is not None:
+            self.uploader.put(path.as_posix(), content, content_encoding)
+            return
+        directory = path.parent
+        if directory not in self._directories:
+            with self._lock:
+                if directory not in self._directories:
+                    directory.mkdir(parents=True, exist_ok=True)
+                    self._directories.add(directory)
+        if self.atomic:
+            write_bytes_atomically(path, content, fsync=self.fsync)
+        else:
+            write_bytes(path, content, fsync=self.fsync)
+        if self.manifest is not None:
+            self.manifest.record(path, content)
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def write(
+        self,
+        path: Path,
+        content: bytes | bytearray,
+        content_encoding: Optional[str] = None,
+    ) -> None:
+        """
+        Queue the file to write, blocking while the queue is full
+
+        The `content_encoding` of the content is only used by uploads.
+        """
+        self._raise_error()
+        self._queue.put((path, content, content_encoding))
+
+    def write_chunk(
+        self,
+        chunk: Chunk,
+        directory: Path,
+        skip_empty: bool = False,
+        compression_level: Optional[int] = None,
+    ) -> bool:
+        """
+        Queue the chunk file, like `Chunk.write_to_directory` does
+
+        Returns
+        -------
+        bool
+            True if the chunk is written, False if it is skipped
+        """
+        if skip_empty and chunk.is_empty:
+            if self.manifest is not None:
+                extension = GZIP_EXTENSION if compression_level is not None else ""
+                self.manifest.record_empty(directory / (chunk.get_name() + extension))
+            return False
+        name, content = chunk.get_file(compression_level)
+        chunk.nb_written_bytes = len(content)
+        if self.uploader is not None and compression_level is not None:
+            # Object stores serve the content encoding given on upload
+            self.write(directory / chunk.get_name(), content, "gzip")
+        else:
+            self.write(directory / name, content)
+        return True
+
+    def close(self) -> None:
+        """Wait for all the queued files to be written"""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._raise_error()
+
+    def __enter__(self) -> "ChunkWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
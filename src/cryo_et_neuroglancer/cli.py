@@ -5,10 +5,13 @@ from typing import Optional
 
 import neuroglancer.cli
 
+from .merge_masks import main as masks_merge
+from .relabel import LabelMapping
 from .state_generation import create_annotation, create_image, create_segmentation
 from .url_creation import combine_json_layers, load_jsonstate_to_browser, viewer_to_url
-from .utils import get_resolution
+from .utils import get_chunk_size, get_resolution
 from .write_annotations import main as annotations_encode
+from .write_image import main as image_encode
 from .write_segmentation import main as segmentation_encode
 
 
@@ -27,16 +30,38 @@ def encode_segmentation(
     block_size: int,
     convert_non_zero: int,
     resolution: Optional[tuple[float, float, float] | list[float]],
+    skip_empty_chunks: bool,
+    workers: int,
+    streaming: bool,
+    read_ahead: int,
+    chunk_size: Optional[list[str]],
+    max_scales: int,
+    sharded: bool,
+    target_shard_size: int,
+    resume: bool,
+    gzip_level: Optional[int],
+    writer_workers: int,
+    fsync: bool,
+    atomic_writes: bool,
+    endpoint: Optional[str],
+    include_mesh: bool,
+    label_statistics: bool,
+    label_mapping: Optional[str],
+    compact_labels: bool,
 ):
     file_path = Path(zarr_path)
     if not file_path.exists():
         print(f"The input ZARR folder {file_path!s} doesn't exist")
         return 1
+    if label_mapping and not Path(label_mapping).exists():
+        print(f"The label mapping file {label_mapping} doesn't exist")
+        return 1
     resolution = get_resolution(resolution)
 
     block_size = int(block_size)
     block_shape = (block_size, block_size, block_size)
-    output_path = Path(output) if output else None
+    # Kept as given, Path would collapse the // of s3:// or gs:// URLs
+    output_path = output or None
     segmentation_encode(
         file_path,
         block_shape,
@@ -44,6 +69,119 @@ def encode_segmentation(
         output_path=output_path,
         resolution=resolution,  # type: ignore
         convert_non_zero_to=convert_non_zero,
+        skip_empty_chunks=skip_empty_chunks,
+        workers=workers,
+        streaming=streaming,
+        read_ahead=read_ahead,
+        chunk_size=get_chunk_size(chunk_size),
+        max_scales=max_scales,
+        sharded=sharded,
+        target_shard_size=target_shard_size * 1_000_000,
+        resume=resume,
+        compression_level=gzip_level,
+        writer_workers=writer_workers,
+        fsync=fsync,
+        atomic_writes=atomic_writes,
+        endpoint=endpoint,
+        include_mesh=include_mesh,
+        collect_label_statistics=label_statistics,
+        label_mapping=(
+            LabelMapping.from_file(Path(label_mapping)) if label_mapping else None
+        ),
+        compact_labels=compact_labels,
+    )
+    return 0
+
+
+def encode_image(
+    zarr_path: str,
+    skip_existing: bool,
+    output: str,
+    resolution: Optional[tuple[float, float, float] | list[float]],
+    workers: int,
+    streaming: bool,
+    read_ahead: int,
+    chunk_size: Optional[list[str]],
+    max_scales: int,
+    writer_workers: int,
+    encoding: str,
+    quantize: bool,
+    contrast_limits: Optional[list[float]],
+    jpeg_quality: int,
+    endpoint: Optional[str],
+):
+    file_path = Path(zarr_path)
+    if not file_path.exists():
+        print(f"The input ZARR folder {file_path!s} doesn't exist")
+        return 1
+    resolution = get_resolution(resolution)
+    image_encode(
+        file_path,
+        delete_existing_output_directory=not skip_existing,
+        # Kept as given, Path would collapse the // of s3:// or gs:// URLs
+        output_path=output or None,
+        resolution=resolution,  # type: ignore
+        workers=workers,
+        streaming=streaming,
+        read_ahead=read_ahead,
+        chunk_size=get_chunk_size(chunk_size),
+        max_scales=max_scales,
+        writer_workers=writer_workers,
+        encoding=encoding,
+        quantize_to_uint8=quantize or encoding == "jpeg",
+        contrast_limits=tuple(contrast_limits) if contrast_limits else None,  # type: ignore
+        jpeg_quality=jpeg_quality,
+        endpoint=endpoint,
+    )
+    return 0
+
+
+def merge_masks(
+    zarr_paths: list[str],
+    skip_existing: bool,
+    output: str,
+    names: Optional[list[str]],
+    rule: str,
+    block_size: int,
+    resolution: Optional[tuple[float, float, float] | list[float]],
+    skip_empty_chunks: bool,
+    workers: int,
+    streaming: bool,
+    read_ahead: int,
+    chunk_size: Optional[list[str]],
+    max_scales: int,
+    sharded: bool,
+    include_mesh: bool,
+    writer_workers: int,
+):
+    file_paths = [Path(p) for p in zarr_paths]
+    for file_path in file_paths:
+        if not file_path.exists():
+            print(f"The input ZARR folder {file_path!s} doesn't exist")
+            return 1
+    if names and len(names) != len(file_paths):
+        print(f"Got {len(names)} names for {len(file_paths)} masks")
+        return 1
+    resolution = get_resolution(resolution)
+
+    block_size = int(block_size)
+    masks_merge(
+        file_paths,
+        output,
+        names=names,
+        rule=rule,
+        block_size=(block_size, block_size, block_size),
+        delete_existing_output_directory=not skip_existing,
+        resolution=resolution,  # type: ignore
+        skip_empty_chunks=skip_empty_chunks,
+        workers=workers,
+        streaming=streaming,
+        read_ahead=read_ahead,
+        chunk_size=get_chunk_size(chunk_size),
+        max_scales=max_scales,
+        sharded=sharded,
+        include_mesh=include_mesh,
+        writer_workers=writer_workers,
     )
     return 0
 
@@ -69,7 +207,7 @@ def parse_args(args):
         "-o",
         "--output",
         required=False,
-        help="Output folder to produce in precomputed format. If not provided, the output will be precomputed_<zarr_path> with the last 5 characters removed if ends with (_zarr) or (.zarr)",
+        help="Output folder to produce in precomputed format, or the URL of an object store destination (s3://, gs://). If not provided, the output will be precomputed_<zarr_path> with the last 5 characters removed if ends with (_zarr) or (.zarr)",
     )
     subcommand.add_argument(
         "-b",
@@ -94,8 +232,338 @@ def parse_args(args):
         const=1,
         help="Force all values > 0 to the specified integer. If the option is used without arguments, all values > 0 are considered as 1.",
     )
+    subcommand.add_argument(
+        "--skip-empty-chunks",
+        default=False,
+        action="store_true",
+        help="Do not write the chunks that only contain background (0). Neuroglancer displays missing chunks as filled with zeros.",
+    )
+    subcommand.add_argument(
+        "-w",
+        "--workers",
+        required=False,
+        type=int,
+        default=1,
+        help="Number of threads encoding and writing chunks in parallel (default: 1)",
+    )
+    subcommand.add_argument(
+        "--streaming",
+        default=False,
+        action="store_true",
+        help="Read the chunks from the ZARR folder while encoding instead of loading the whole volume in memory first",
+    )
+    subcommand.add_argument(
+        "--read-ahead",
+        required=False,
+        type=int,
+        default=2,
+        help="Number of chunks read ahead of the encoding in streaming mode (default: 2)",
+    )
+    subcommand.add_argument(
+        "-c",
+        "--chunk-size",
+        nargs="+",
+        help="Size of the output chunks, either 3 values for X Y Z separated by spaces, a single value used for X Y and Z, or 'auto' to pick a size from the volume shape (default: the chunk size of the input ZARR)",
+    )
+    subcommand.add_argument(
+        "--max-scales",
+        required=False,
+        type=int,
+        default=1,
+        help="Maximum number of scales of the multiscale pyramid, including the full resolution. The resolution levels of the ZARR are used if present, otherwise the labels are downsampled by keeping the most frequent one (default: 1)",
+    )
+    subcommand.add_argument(
+        "--sharded",
+        default=False,
+        action="store_true",
+        help="Gather the chunks in neuroglancer_uint64_sharded_v1 shard files instead of one file per chunk",
+    )
+    subcommand.add_argument(
+        "--target-shard-size",
+        required=False,
+        type=int,
+        default=3500,
+        help="Uncompressed size in MB of the chunks gathered in a shard, used to choose the number of shards (default: 3500)",
+    )
+    subcommand.add_argument(
+        "--resume",
+        default=False,
+        action="store_true",
+        help="Continue an interrupted conversion in the output directory, only converting the chunks that are missing or corrupted",
+    )
+    subcommand.add_argument(
+        "--gzip-level",
+        required=False,
+        type=int,
+        choices=range(10),
+        metavar="{0-9}",
+        default=None,
+        help="Write the chunks gzip compressed at this level, in .gz files to serve with Content-Encoding: gzip from a static file server configured for pre-compressed files (nginx gzip_static, Caddy precompressed). Not compatible with --sharded",
+    )
+    subcommand.add_argument(
+        "--writer-workers",
+        required=False,
+        type=int,
+        default=4,
+        help="Number of threads writing the output files in the background (default: 4)",
+    )
+    subcommand.add_argument(
+        "--fsync",
+        default=False,
+        action="store_true",
+        help="Flush each output file to the disk before considering it written, slower but safe against a crash of the machine",
+    )
+    subcommand.add_argument(
+        "--atomic-writes",
+        default=False,
+        action="store_true",
+        help="Write each output file to a temporary name then rename it, so that no file is ever seen partially written. Always on with --resume",
+    )
+    subcommand.add_argument(
+        "--endpoint",
+        required=False,
+        default=None,
+        help="URL of the S3 compatible store (MinIO, ...) to upload to, for s3:// outputs not on AWS",
+    )
+    subcommand.add_argument(
+        "--include-mesh",
+        default=False,
+        action="store_true",
+        help="Also write the meshes of the labels, computed chunk by chunk by marching cubes, as legacy precomputed meshes. Sharded with --sharded",
+    )
+    subcommand.add_argument(
+        "--label-statistics",
+        default=False,
+        action="store_true",
+        help="Gather the voxel count, bounding box and chunks of each label while encoding, written to label_statistics.json and as neuroglancer segment properties",
+    )
+    subcommand.add_argument(
+        "--label-mapping",
+        required=False,
+        default=None,
+        help="JSON file of source to target labels, or CSV file with one source,target pair per line, applied to each chunk before encoding. The labels not listed are kept, a label mapped to 0 is removed",
+    )
+    subcommand.add_argument(
+        "--compact-labels",
+        default=False,
+        action="store_true",
+        help="Map the labels, after --label-mapping, to the dense range 1..n in a first pass over the volume, for smaller chunks. The mapping is written to label_mapping.json",
+    )
     subcommand.set_defaults(func=encode_segmentation)
 
+    # Image encoding
+    subcommand = subparsers.add_parser(
+        "encode-image", help="Encode a tomogram as a precomputed multiscale image"
+    )
+    subcommand.add_argument("zarr_path", help="Path towards your tomogram ZARR folder")
+    subcommand.add_argument(
+        "--skip-existing",
+        default=False,
+        action="store_true",
+        help="Skips already existing target folders",
+    )
+    subcommand.add_argument(
+        "-o",
+        "--output",
+        required=False,
+        help="Output folder to produce in precomputed format, or the URL of an object store destination (s3://, gs://). If not provided, the output will be precomputed_<zarr_path> with the last 5 characters removed if ends with (_zarr) or (.zarr)",
+    )
+    subcommand.add_argument(
+        "-r",
+        "--resolution",
+        nargs="+",
+        type=float,
+        help="Resolution in nm, must be either 3 values for X Y Z separated by spaces, or a single value that will be set for X Y and Z (default: 1.348)",
+    )
+    subcommand.add_argument(
+        "-w",
+        "--workers",
+        required=False,
+        type=int,
+        default=1,
+        help="Number of threads reading, downsampling and encoding chunks in parallel (default: 1)",
+    )
+    subcommand.add_argument(
+        "--streaming",
+        default=False,
+        action="store_true",
+        help="Read the chunks from the ZARR folder while encoding instead of loading the whole volume in memory first",
+    )
+    subcommand.add_argument(
+        "--read-ahead",
+        required=False,
+        type=int,
+        default=2,
+        help="Number of chunks read ahead of the encoding in streaming mode (default: 2)",
+    )
+    subcommand.add_argument(
+        "-c",
+        "--chunk-size",
+        required=False,
+        nargs="+",
+        default=["auto"],
+        help="Size of the output chunks, either 3 values for X Y Z separated by spaces, a single value used for X Y and Z, or 'auto' to pick a size from the volume shape (default: auto)",
+    )
+    subcommand.add_argument(
+        "--max-scales",
+        required=False,
+        type=int,
+        default=8,
+        help="Maximum number of scales of the multiscale pyramid, including the full resolution. Each scale averages the voxels of the previous one, until the volume fits in one chunk (default: 8)",
+    )
+    subcommand.add_argument(
+        "--writer-workers",
+        required=False,
+        type=int,
+        default=4,
+        help="Number of threads writing the output files in the background (default: 4)",
+    )
+    subcommand.add_argument(
+        "--quantize",
+        default=False,
+        action="store_true",
+        help="Map the values of the contrast window to uint8, four times smaller than float32. The window is recorded in the info file",
+    )
+    subcommand.add_argument(
+        "--contrast-limits",
+        required=False,
+        nargs=2,
+        type=float,
+        metavar=("LOW", "HIGH"),
+        help="Window of the values quantized to uint8 (default: the 5th and 95th percentiles of the middle slices)",
+    )
+    subcommand.add_argument(
+        "--encoding",
+        required=False,
+        choices=["raw", "jpeg"],
+        default="raw",
+        help="Encoding of the chunks, jpeg implies --quantize (default: raw)",
+    )
+    subcommand.add_argument(
+        "--jpeg-quality",
+        required=False,
+        type=int,
+        default=85,
+        help="Quality of the jpeg chunks, from 1 to 100 (default: 85)",
+    )
+    subcommand.add_argument(
+        "--endpoint",
+        required=False,
+        default=None,
+        help="URL of the S3 compatible store (MinIO, ...) to upload to, for s3:// outputs not on AWS",
+    )
+    subcommand.set_defaults(func=encode_image)
+
+    # Mask merging
+    subcommand = subparsers.add_parser(
+        "merge-masks",
+        help="Merge binary masks into one segmentation with a label per mask",
+    )
+    subcommand.add_argument(
+        "zarr_paths",
+        nargs="+",
+        help="Paths towards the binary mask ZARR folders, the i-th mask gets the label i",
+    )
+    subcommand.add_argument(
+        "--skip-existing",
+        default=False,
+        action="store_true",
+        help="Skips already existing target folders",
+    )
+    subcommand.add_argument(
+        "-o",
+        "--output",
+        required=True,
+        help="Output folder to produce in precomputed format, or the URL of an object store destination (s3://, gs://)",
+    )
+    subcommand.add_argument(
+        "--names",
+        nargs="+",
+        required=False,
+        help="Name of each mask, in the same order (default: the ZARR folder names)",
+    )
+    subcommand.add_argument(
+        "--rule",
+        required=False,
+        choices=["priority", "overlap"],
+        default="priority",
+        help="Label of the voxels in several masks: priority gives them to the first mask listed, overlap gives them their own label after the masks (default: priority)",
+    )
+    subcommand.add_argument(
+        "-b",
+        "--block-size",
+        required=False,
+        default=64,
+        help="Block size (default: 64)",
+    )
+    subcommand.add_argument(
+        "-r",
+        "--resolution",
+        nargs="+",
+        type=float,
+        help="Resolution in nm, must be either 3 values for X Y Z separated by spaces, or a single value that will be set for X Y and Z (default: 1.348)",
+    )
+    subcommand.add_argument(
+        "--skip-empty-chunks",
+        default=False,
+        action="store_true",
+        help="Do not write the chunks that only contain background (0). Neuroglancer displays missing chunks as filled with zeros.",
+    )
+    subcommand.add_argument(
+        "-w",
+        "--workers",
+        required=False,
+        type=int,
+        default=1,
+        help="Number of threads merging, encoding and writing chunks in parallel (default: 1)",
+    )
+    subcommand.add_argument(
+        "--streaming",
+        default=False,
+        action="store_true",
+        help="Read the chunks from the ZARR folders while encoding instead of loading the whole masks in memory first",
+    )
+    subcommand.add_argument(
+        "--read-ahead",
+        required=False,
+        type=int,
+        default=2,
+        help="Number of chunks read ahead of the encoding in streaming mode (default: 2)",
+    )
+    subcommand.add_argument(
+        "-c",
+        "--chunk-size",
+        nargs="+",
+        help="Size of the output chunks, either 3 values for X Y Z separated by spaces, a single value used for X Y and Z, or 'auto' to pick a size from the volume shape (default: the chunk size of the merged masks)",
+    )
+    subcommand.add_argument(
+        "--max-scales",
+        required=False,
+        type=int,
+        default=1,
+        help="Maximum number of scales of the multiscale pyramid, including the full resolution, downsampled by keeping the most frequent label (default: 1)",
+    )
+    subcommand.add_argument(
+        "--sharded",
+        default=False,
+        action="store_true",
+        help="Gather the chunks in neuroglancer_uint64_sharded_v1 shard files instead of one file per chunk",
+    )
+    subcommand.add_argument(
+        "--include-mesh",
+        default=False,
+        action="store_true",
+        help="Also write the meshes of the labels as legacy precomputed meshes",
+    )
+    subcommand.add_argument(
+        "--writer-workers",
+        required=False,
+        type=int,
+        default=4,
+        help="Number of threads writing the output files in the background (default: 4)",
+    )
+    subcommand.set_defaults(func=merge_masks)
+
     # Annotation encoding
     subcommand = subparsers.add_parser(
         "encode-annotation", help="Encode annotations file"
@@ -106,7 +574,10 @@ def parse_args(args):
         type=Path,
     )
     subcommand.add_argument(
-        "-o", "--output", required=False, help="Output folder to produce", type=Path
+        "-o",
+        "--output",
+        required=True,
+        help="Output folder to produce, or the URL of an object store destination (s3://, gs://)",
     )
     subcommand.add_argument(
         "-r", "--resolution", required=False, help="Resolution", type=float
@@ -126,6 +597,12 @@ def parse_args(args):
         type=int,
         help="Pass 1 to turn on, or two integers as SHARD_BITS MINISHARD_BITS. Reduces the annotation output from multiple files to a smaller number of sharded files. The default value for the shard bits is 0 (which determines the number of output files) and the default value for the minishard bits is 10 (which determines how many minishards are in a file).",
     )
+    subcommand.add_argument(
+        "--endpoint",
+        required=False,
+        default=None,
+        help="URL of the S3 compatible store (MinIO, ...) to upload to, for s3:// outputs not on AWS",
+    )
     subcommand.set_defaults(func=annotations_encode)
 
     # URL creation
@@ -180,6 +657,20 @@ def parse_args(args):
         help="Resolution in nm, must be either 3 values for X Y Z separated by spaces, or a single value that will be set for X Y and Z (default: 1.348)",
         required=False,
     )
+    subcommand.add_argument(
+        "--precomputed",
+        default=False,
+        action="store_true",
+        help="The source is a precomputed image written by encode-image instead of a ZARR, the ZARR path is still used for the contrast limits",
+    )
+    subcommand.add_argument(
+        "--quantization-window",
+        required=False,
+        nargs=2,
+        type=float,
+        metavar=("LOW", "HIGH"),
+        help="Window quantized to uint8 by encode-image --quantize, the contrast then covers the uint8 range",
+    )
     subcommand.set_defaults(func=create_image)
 
     # Annotation JSON creation
@@ -243,6 +734,12 @@ def parse_args(args):
         type=str,
         help="A hex string followed the name of the color e.g. #ff0000 red",
     )
+    subcommand.add_argument(
+        "--label-names",
+        required=False,
+        type=Path,
+        help="label_names.json table written by merge-masks, all its labels are shown",
+    )
     subcommand.set_defaults(func=create_segmentation)
 
     # JSON combination
@@ -0,0 +1,84 @@
+import json
+import threading
+import zlib
+from pathlib import Path
+from typing import Any
+
+from .io import write_bytes_atomically
+
+MANIFEST_FILENAME = "conversion_manifest.jsonl"
+
+
+class ConversionManifest:
+    """
+    Record the files written by a conversion, to resume it after an interruption
+
+    The manifest is a JSON lines file in the output directory. The first line
+    holds the parameters of the conversion, then each line holds the path,
+    size and CRC32 checksum of a written file. Files are written to a temporary
+    file renamed once complete, and recorded only after the rename, so a file in
+    the manifest is always complete. Chunks skipped because they are empty are
+    recorded with a size of 0.
+    """
+
+    def __init__(self, directory: Path, parameters: dict[str, Any]):
+        self.directory = directory
+        self.path = directory / MANIFEST_FILENAME
+        self.entries: dict[str, tuple[int, int]] = {}
+        self._lock = threading.Lock()
+        parameters = json.loads(json.dumps(parameters))
+        if not self.path.exists():
+            directory.mkdir(parents=True, exist_ok=True)
+            self.path.write_text(json.dumps({"parameters": parameters}) + "\n")
+            return
+        with self.path.open("r", encoding="utf-8") as f:
+            previous_parameters = json.loads(f.readline())["parameters"]
+            if previous_parameters != parameters:
+                raise ValueError(
+                    f"The conversion in {directory} was started with different parameters: {previous_parameters}"
+                )
+            for line in f:
+                # The last line can be incomplete if the process died while writing it
+                if line.endswith("\n"):
+                    entry = json.loads(line)
+                    self.entries[entry["path"]] = (entry["size"], entry["crc32"])
+
+    def _get_key(self, path: Path) -> str:
+        return path.relative_to(self.directory).as_posix()
+
+    def is_done(self, path: Path) -> bool:
+        """Return True if the file is recorded and still matches its size and checksum"""
+        entry = self.entries.get(self._get_key(path))
+        if entry is None:
+            return False
+        size, crc32 = entry
+        if size == 0:
+            return True
+        try:
+            content = path.read_bytes()
+        except FileNotFoundError:
+            return False
+        return len(content) == size and zlib.crc32(content) == crc32
+
+    def record(self, path: Path, content: bytes | bytearray) -> None:
+        """Record a file once completely written"""
+        key = self._get_key(path)
+        size, crc32 = len(content), zlib.crc32(content)
+        entry = {"path": key, "size": size, "crc32": crc32}
+        with self._lock:
+            with self.path.open("a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+            self.entries[key] = (size, crc32)
+
+    def record_empty(self, path: Path) -> None:
+        """Record a file left out because it is empty"""
+        self.record(path, b"")
+
+    def write(self, path: Path, content: bytes | bytearray) -> None:
+        """Write the file atomically, then record it"""
+        write_bytes_atomically(path, content)
+        self.record(path, content)
+
+    def remove(self) -> None:
+        """Remove the manifest once the conversion is complete"""
+        self.path.unlink(missing_ok=True)
@@ -0,0 +1,159 @@
+from math import ceil
+
+import numpy as np
+
+
+def _split_into_windows(data: np.ndarray, factors: tuple[int, int, int]) -> np.ndarray:
+    """
+    Return the downsampling windows of the data with shape (*output_shape, nb_values)
+
+    The data is padded by repeating its last values so that partial windows on
+    the edges only contain values of the data.
+    """
+    output_shape = tuple(ceil(s / f) for s, f in zip(data.shape, factors))
+    padding = [(0, o * f - s) for o, f, s in zip(output_shape, factors, data.shape)]
+    padded = np.pad(data, padding, mode="edge") if any(p for _, p in padding) else data
+    fz, fy, fx = factors
+    oz, oy, ox = output_shape
+    windows = padded.reshape(oz, fz, oy, fy, ox, fx).transpose(0, 2, 4, 1, 3, 5)
+    return windows.reshape(oz, oy, ox, fz * fy * fx)
+
+
+def get_downsampled_shape(
+    data_shape: tuple[int, int, int], factors: tuple[int, int, int]
+) -> tuple[int, int, int]:
+    """Return the shape of the data downsampled by the factors, in z, y, x order"""
+    return (
+        ceil(data_shape[0] / factors[0]),
+        ceil(data_shape[1] / factors[1]),
+        ceil(data_shape[2] / factors[2]),
+    )
+
+
+def get_downsampled_scales(
+    data_shape: tuple[int, int, int], factors: list[tuple[int, int, int]]
+) -> list[tuple[tuple[int, int, int], tuple[int, int, int]]]:
+    """
+    Return the shape of each downsampled scale, with its factor from the full resolution
+
+    `factors` holds the downsampling factors between consecutive scales.
+    """
+    scales = []
+    shape, total_factor = data_shape, (1, 1, 1)
+    for factor in factors:
+        shape = get_downsampled_shape(shape, factor)
+        total_factor = (
+            total_factor[0] * factor[0],
+            total_factor[1] * factor[1],
+            total_factor[2] * factor[2],
+        )
+        scales.append((shape, total_factor))
+    return scales
+
+
+def compute_downsampling_factors(
+    data_shape: tuple[int, int, int],
+    chunk_size: tuple[int, int, int],
+    max_scales: int,
+) -> list[tuple[int, int, int]]:
+    """
+    Return the downsampling factors from each scale to the next one
+
+    Each scale halves the axes that are still larger than one chunk, so the
+    thin axes of anisotropic volumes keep their resolution. The pyramid stops
+    when the whole volume fits in a single chunk, or at `max_scales` scales
+    including the full resolution one.
+
+    Parameters
+    ----------
+    data_shape : tuple[int, int, int]
+        The shape of the full resolution data, in z, y, x order
+    chunk_size : tuple[int, int, int]
+        The size of the output chunks, in z, y, x order
+    max_scales : int
+        The maximum number of scales
+
+    Returns
+    -------
+    list[tuple[int, int, int]]
+        The downsampling factors between consecutive scales
+    """
+    factors: list[tuple[int, int, int]] = []
+    shape = data_shape
+    while len(factors) + 1 < max_scales:
+        factor = (
+            2 if shape[0] > chunk_size[0] else 1,
+            2 if shape[1] > chunk_size[1] else 1,
+            2 if shape[2] > chunk_size[2] else 1,
+        )
+        if factor == (1, 1, 1):
+            break
+        factors.append(factor)
+        shape = get_downsampled_shape(shape, factor)
+    return factors
+
+
+def downsample_labels(data: np.ndarray, factors: tuple[int, int, int]) -> np.ndarray:
+    """
+    Downsample a label volume, keeping the most frequent label of each window
+
+    Unlike averaging, this never creates labels that are not in the data.
+    Ties are resolved in favour of the smallest label. Windows on the edges of
+    the data are completed by repeating the last values.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The labels, in z, y, x order
+    factors : tuple[int, int, int]
+        The downsampling factor along each axis
+
+    Returns
+    -------
+    np.ndarray
+        The downsampled labels, with the same dtype as the data
+    """
+    if factors == (1, 1, 1):
+        return data
+    windows = np.sort(_split_into_windows(data, factors), axis=-1)
+    # The windows are small, comparing all the pairs of values is cheaper
+    # than counting the runs of the sorted values
+    counts = (windows[..., :, np.newaxis] == windows[..., np.newaxis, :]).sum(axis=-1)
+    # On a tie, argmax picks the first, so the smallest, of the sorted values
+    most_frequent = np.argmax(counts, axis=-1)[..., np.newaxis]
+    return np.take_along_axis(windows, most_frequent, axis=-1)[..., 0]
+
+
+def downsample_average(data: np.ndarray, factors: tuple[int, int, int]) -> np.ndarray:
+    """
+    Downsample an image, averaging the values of each window
+
+    Windows on the edges of the data are completed by repeating the last
+    values, so they average the values of the data only. Integer images are
+    rounded to the nearest value.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The image, in z, y, x order
+    factors : tuple[int, int, int]
+        The downsampling factor along each axis
+
+    Returns
+    -------
+    np.ndarray
+        The downsampled image, with the same dtype as the data
+    """
+    if factors == (1, 1, 1):
+        return data
+    windows = _split_into_windows(data, factors)
+    # float32 keeps the precision of float32 images, wider types need float64
+    mean_type = (
+        np.float32
+        if data.dtype.itemsize <= 2 or data.dtype == np.float32
+        else np.float64
+    )
+    mean = windows.mean(axis=-1, dtype=mean_type)
+    if np.issubdtype(data.dtype, np.integer):
+        mean = np.rint(mean)
+    return mean.astype(data.dtype)
@@ -1,27 +1,117 @@
 import json
+import os
+import shutil
+import sys
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable
 
 import dask.array as da
 from ome_zarr.io import parse_url
 from ome_zarr.reader import Reader
 
 
-def load_omezarr_data(input_filepath: Path) -> da.Array:
-    """Load the OME-Zarr data and return a dask array"""
+def _read_omezarr_levels(input_filepath: Path) -> list[da.Array]:
+    """Return the lazy dask arrays of all the resolution levels of the OME-Zarr image"""
     url = parse_url(input_filepath)
     if not url:
         raise ValueError(f"Input file {input_filepath} is not a ZARR file")
     reader = Reader(url)
     nodes = list(reader())
     image_node = nodes[0]
-    dask_data = image_node.data[0]
-    return dask_data.persist()
+    return list(image_node.data)
+
+
+def load_omezarr_data(input_filepath: Path, persist: bool = True) -> da.Array:
+    """
+    Load the OME-Zarr data and return a dask array
+
+    By default the whole volume is loaded in memory. If `persist` is False, the
+    dask array stays lazy and each chunk is read from the Zarr store only when
+    it is computed, so the memory used does not depend on the volume size.
+    """
+    dask_data = _read_omezarr_levels(input_filepath)[0]
+    return dask_data.persist() if persist else dask_data
+
+
+def load_omezarr_levels(input_filepath: Path, persist: bool = True) -> list[da.Array]:
+    """
+    Load all the resolution levels of the OME-Zarr data, from the full resolution
+
+    See `load_omezarr_data` for the `persist` option.
+    """
+    levels = _read_omezarr_levels(input_filepath)
+    return [level.persist() for level in levels] if persist else levels
+
+
+def write_bytes(path: Path, content: bytes | bytearray, fsync: bool = False) -> None:
+    """Write the content to the path, flushed to the disk before returning with `fsync`"""
+    with open(path, "wb") as f:
+        f.write(content)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def write_bytes_atomically(
+    path: Path, content: bytes | bytearray, fsync: bool = False
+) -> None:
+    """
+    Write the content to a temporary file renamed to the path once complete
+
+    The rename is atomic, so the file at `path` is either absent or complete,
+    even if the process dies while writing. See `write_bytes` for `fsync`.
+    """
+    temporary_path = path.with_name(f".{path.name}.tmp")
+    write_bytes(temporary_path, content, fsync)
+    os.replace(temporary_path, path)
+
+
+def get_scale_key(data_directory: str, scale: int) -> str:
+    """Return the directory of the chunks of the given scale"""
+    return data_directory if scale == 0 else f"{data_directory}_{scale}"
+
+
+def is_scale_output(name: str, data_directory: str) -> bool:
+    """Return True if the file or directory name is the info or the chunks of a scale"""
+    return (
+        name == "info"
+        or name == data_directory
+        or name.startswith(f"{data_directory}_")
+    )
 
 
 def write_metadata(metadata: dict[str, Any], output_directory: Path) -> None:
-    """Write the segmentation to the given directory"""
+    """Write the segmentation to the given directory
+
+    The info file is written atomically, a conversion with an info file is complete.
+    """
     metadata_path = output_directory / "info"
+    write_bytes_atomically(metadata_path, json.dumps(metadata, indent=4).encode())
+
+
+def clear_output_directory(
+    output_directory: Path,
+    delete_existing: bool,
+    is_conversion_output: Callable[[str], bool],
+) -> None:
+    """
+    Delete the output directory of a previous conversion before a new one
 
-    with open(metadata_path, "w") as f:
-        json.dump(metadata, f, indent=4)
+    The program exits if the directory exists and `delete_existing` is not
+    set, or if it contains files for which `is_conversion_output` is False.
+    """
+    if not output_directory.exists():
+        return
+    if not delete_existing:
+        print(f"The output directory {output_directory!s} already exists")
+        sys.exit(1)
+    content_names = [c.name for c in output_directory.iterdir()]
+    if any(not is_conversion_output(n) for n in content_names):
+        print(
+            f"The output directory {output_directory!s} exists and contains non-conversion related files, not deleting it"
+        )
+        sys.exit(1)
+    print(
+        f"The output directory {output_directory!s} exists from a previous run, deleting before starting the conversion"
+    )
+    shutil.rmtree(output_directory)
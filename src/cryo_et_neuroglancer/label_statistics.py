@@ -0,0 +1,130 @@
+import threading
+from typing import Any, Optional
+
+import numpy as np
+from scipy.ndimage import find_objects
+
+from .chunk import get_chunk_name
+
+LABEL_STATISTICS_FILENAME = "label_statistics.json"
+LABEL_NAMES_FILENAME = "label_names.json"
+SEGMENT_PROPERTIES_DIRECTORY = "segment_properties"
+
+
+class LabelStatistics:
+    """
+    Gather the voxel count, bounding box and chunks of each label, chunk by chunk
+
+    The statistics of each chunk are computed by the thread encoding it, then
+    merged under a lock, so one instance is shared by all the workers of a
+    conversion. The background, 0, is ignored.
+
+    The bounding boxes are in voxels, in z, y, x order, with an exclusive end.
+    The chunks are listed by their file name.
+    """
+
+    def __init__(self) -> None:
+        self.voxel_counts: dict[int, int] = {}
+        self.bounding_boxes: dict[int, tuple[list[int], list[int]]] = {}
+        self.chunks: dict[int, list[str]] = {}
+        self._lock = threading.Lock()
+
+    def add_chunk(
+        self,
+        data: np.ndarray,
+        dimensions: tuple[tuple[int, int, int], tuple[int, int, int]],
+    ) -> None:
+        """
+        Add the labels of the chunk, in z, y, x order, at the given dimensions
+
+        The labels are listed and counted by their own `np.unique` and
+        `find_objects` pass over the chunk, on top of the sort of the encoder,
+        whose lookup tables hold the labels of each block but not their counts.
+        """
+        labels, inverse, counts = np.unique(
+            data, return_inverse=True, return_counts=True
+        )
+        # find_objects ignores 0, the index of the smallest label
+        bounding_boxes = find_objects(inverse.reshape(data.shape) + 1)
+        # The background is not always the smallest label, with negative ones
+        is_label = labels != 0
+        labels, counts = labels[is_label], counts[is_label]
+        bounding_boxes = [box for box, keep in zip(bounding_boxes, is_label) if keep]
+        start = dimensions[0]
+        name = get_chunk_name(dimensions)
+        with self._lock:
+            for label, count, box in zip(labels.tolist(), counts, bounding_boxes):
+                box_start = [s + b.start for s, b in zip(start, box)]
+                box_end = [s + b.stop for s, b in zip(start, box)]
+                if label not in self.voxel_counts:
+                    self.voxel_counts[label] = int(count)
+                    self.bounding_boxes[label] = (box_start, box_end)
+                    self.chunks[label] = [name]
+                    continue
+                self.voxel_counts[label] += int(count)
+                previous_start, previous_end = self.bounding_boxes[label]
+                self.bounding_boxes[label] = (
+                    [min(a, b) for a, b in zip(previous_start, box_start)],
+                    [max(a, b) for a, b in zip(previous_end, box_end)],
+                )
+                self.chunks[label].append(name)
+
+    @property
+    def labels(self) -> list[int]:
+        return sorted(self.voxel_counts)
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        Return the statistics as the content of the sidecar JSON file
+
+        The bounding boxes are given in x, y, z order, like the sizes of the
+        info file.
+        """
+        return {
+            "labels": {
+                str(label): {
+                    "voxel_count": self.voxel_counts[label],
+                    "bounding_box": {
+                        "start": self.bounding_boxes[label][0][::-1],
+                        "end": self.bounding_boxes[label][1][::-1],
+                    },
+                    "chunks": sorted(self.chunks[label]),
+                }
+                for label in self.labels
+            }
+        }
+
+
+def create_segment_properties(
+    statistics: LabelStatistics, names: Optional[dict[int, str]] = None
+) -> dict[str, Any]:
+    """
+    Create the info file of the neuroglancer segment properties of the labels
+
+    Each label gets its name, or its value if it has no name, and its voxel
+    count, so neuroglancer lists, searches and sorts the segments without
+    reading the volume.
+    """
+    labels = statistics.labels
+    names = names or {}
+    counts = [statistics.voxel_counts[label] for label in labels]
+    fits_uint32 = max(counts, default=0) <= np.iinfo(np.uint32).max
+    return {
+        "@type": "neuroglancer_segment_properties",
+        "inline": {
+            "ids": [str(label) for label in labels],
+            "properties": [
+                {
+                    "id": "label",
+                    "type": "label",
+                    "values": [names.get(label, str(label)) for label in labels],
+                },
+                {
+                    "id": "voxel_count",
+                    "type": "number",
+                    "data_type": "uint32" if fits_uint32 else "float32",
+                    "values": counts,
+                },
+            ],
+        },
+    }
@@ -0,0 +1,134 @@
+from functools import partial
+from pathlib import Path
+from typing import Optional
+
+import dask.array as da
+import numpy as np
+
+from .chunk_writer import DEFAULT_WRITER_WORKERS
+from .io import load_omezarr_data
+from .write_segmentation import main as write_segmentation
+
+# "priority": the first mask listed wins where masks overlap, "overlap": the
+# voxels of several masks get their own label
+OVERLAP_RULES = ("priority", "overlap")
+OVERLAP_LABEL_NAME = "overlap"
+
+
+def get_mask_name(path: Path) -> str:
+    """Return the name of the mask, the name of its ZARR folder without extension"""
+    name = path.name.rstrip("/")
+    return name[:-5] if name.endswith((".zarr", "_zarr")) else name
+
+
+def merge_mask_chunks(*masks: np.ndarray, rule: str = "priority") -> np.ndarray:
+    """
+    Merge the binary masks into one uint32 label chunk, the voxels of the i-th mask getting the label i
+
+    Where masks overlap, the first mask wins with the "priority" rule, and
+    with the "overlap" rule the voxels get the label n + 1, after the n masks.
+    """
+    if rule not in OVERLAP_RULES:
+        raise ValueError(
+            f"Unknown overlap rule {rule}, expected one of {OVERLAP_RULES}"
+        )
+    labels = np.zeros(masks[0].shape, dtype=np.uint32)
+    # Written from the last mask to the first, so the first one wins
+    for label, mask in reversed(list(enumerate(masks, start=1))):
+        labels[mask > 0] = label
+    if rule == "overlap":
+        # Set where a mask was already found, whatever the number of masks
+        is_set = np.zeros(masks[0].shape, dtype=bool)
+        is_overlap = np.zeros(masks[0].shape, dtype=bool)
+        for mask in masks:
+            is_overlap |= is_set & (mask > 0)
+            is_set |= mask > 0
+        labels[is_overlap] = len(masks) + 1
+    return labels
+
+
+def merge_masks(masks: list[da.Array], rule: str = "priority") -> da.Array:
+    """
+    Return the lazy label volume merging the masks, see `merge_mask_chunks`
+
+    The masks are rechunked to the chunks of the first one and merged chunk
+    by chunk, so only one chunk of each mask is in memory per merged chunk.
+    """
+    shapes = {mask.shape for mask in masks}
+    if len(shapes) != 1:
+        raise ValueError(f"The masks must all have the same shape, got {shapes}")
+    masks = [mask.rechunk(masks[0].chunks) for mask in masks]
+    return da.map_blocks(partial(merge_mask_chunks, rule=rule), *masks, dtype=np.uint32)
+
+
+def get_label_names(mask_names: list[str], rule: str = "priority") -> dict[int, str]:
+    """Return the name of each label of the merged volume"""
+    names = dict(enumerate(mask_names, start=1))
+    if rule == "overlap":
+        names[len(mask_names) + 1] = OVERLAP_LABEL_NAME
+    return names
+
+
+def main(
+    filenames: list[Path],
+    output_path: Path | str,
+    names: Optional[list[str]] = None,
+    rule: str = "priority",
+    block_size: tuple[int, int, int] = (64, 64, 64),
+    delete_existing_output_directory: bool = False,
+    resolution: tuple[float, float, float] = (1.0, 1.0, 1.0),
+    skip_empty_chunks: bool = False,
+    workers: int = 1,
+    streaming: bool = False,
+    read_ahead: int = 2,
+    chunk_size: Optional[tuple[int, int, int] | str] = None,
+    max_scales: int = 1,
+    sharded: bool = False,
+    include_mesh: bool = False,
+    writer_workers: int = DEFAULT_WRITER_WORKERS,
+) -> None:
+    """
+    Merge the binary OME-Zarr masks into one segmentation, encoded once
+
+    The voxels of the i-th mask get the label i, with the overlaps resolved
+    by the `rule`, see `merge_mask_chunks`. The masks are merged chunk by
+    chunk while encoding, the merged volume is never written.
+
+    The masks are named by `names`, or by their folder names. The names are
+    written to the label_names.json table and the segment properties of the
+    output, so the merged segmentation can be shown as one layer with a
+    named segment per mask.
+
+    The other parameters are those of `write_segmentation.main`.
+    """
+    if names is not None and len(names) != len(filenames):
+        raise ValueError(f"Got {len(names)} names for {len(filenames)} masks")
+    if rule not in OVERLAP_RULES:
+        raise ValueError(
+            f"Unknown overlap rule {rule}, expected one of {OVERLAP_RULES}"
+        )
+    print(f"Merging {len(filenames)} masks with the {rule} rule")
+    masks = [load_omezarr_data(f, persist=not streaming) for f in filenames]
+    label_names = get_label_names(names or [get_mask_name(f) for f in filenames], rule)
+    for label, name in label_names.items():
+        print(f"  {label}: {name}")
+    write_segmentation(
+        None,
+        block_size,
+        delete_existing_output_directory=delete_existing_output_directory,
+        output_path=output_path,
+        resolution=resolution,
+        skip_empty_chunks=skip_empty_chunks,
+        workers=workers,
+        streaming=streaming,
+        read_ahead=read_ahead,
+        chunk_size=chunk_size,
+        max_scales=max_scales,
+        sharded=sharded,
+        writer_workers=writer_workers,
+        include_mesh=include_mesh,
+        collect_label_statistics=True,
+        dask_data=merge_masks(masks, rule),
+        label_names=label_names,
+        name=f"the {len(filenames)} merged masks",
+    )
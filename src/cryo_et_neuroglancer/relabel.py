@@ -0,0 +1,135 @@
+import json
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+import dask.array as da
+import numpy as np
+
+LABEL_MAPPING_FILENAME = "label_mapping.json"
+
+
+@dataclass
+class LabelMapping:
+    """
+    Map each `source` label to the `target` label at the same position
+
+    The labels missing from the mapping are kept as they are, mapping a
+    label to 0 removes it. A mapping `is_complete` when it maps every label of
+    the volume, its targets are then all the labels of the relabeled volume.
+    """
+
+    source: np.ndarray
+    target: np.ndarray
+    is_complete: bool = False
+
+    def __post_init__(self):
+        self.source = np.asarray(self.source).reshape(-1)
+        self.target = np.asarray(self.target).reshape(-1)
+        if len(self.source) != len(self.target):
+            raise ValueError(
+                f"The mapping has {len(self.source)} source labels but {len(self.target)} target labels"
+            )
+        order = np.argsort(self.source, kind="stable")
+        self.source, self.target = self.source[order], self.target[order]
+        if len(self.source) > 1 and np.any(self.source[1:] == self.source[:-1]):
+            raise ValueError("A label is mapped more than once")
+
+    @classmethod
+    def from_dict(cls, mapping: dict[int, int]) -> "LabelMapping":
+        return cls(
+            np.array(list(mapping.keys()), dtype=np.uint64),
+            np.array(list(mapping.values()), dtype=np.uint64),
+        )
+
+    @classmethod
+    def from_file(cls, path: Path) -> "LabelMapping":
+        """
+        Load the mapping from a JSON object of source to target labels, or a
+        CSV file with one "source,target" pair per line
+        """
+        if path.suffix == ".json":
+            content = json.loads(path.read_text())
+            return cls.from_dict({int(s): int(t) for s, t in content.items()})
+        pairs = np.loadtxt(path, delimiter=",", dtype=np.uint64, ndmin=2)
+        return cls(pairs[:, 0], pairs[:, 1])
+
+    def to_dict(self) -> dict[str, int]:
+        return {str(s): int(t) for s, t in zip(self.source, self.target)}
+
+    def get_checksum(self) -> int:
+        """Return a checksum of the mapping, to tell if two mappings differ"""
+        checksum = zlib.crc32(self.source.astype("<u8").tobytes())
+        return zlib.crc32(self.target.astype("<u8").tobytes(), checksum)
+
+    def apply(self, data: np.ndarray) -> np.ndarray:
+        """
+        Return the relabeled data, without modifying it
+
+        Each voxel is looked up in the sorted source labels with a single
+        `np.searchsorted`, so the cost does not depend on the number of labels
+        mapped. Labels stored as floats or booleans are cast to int64 first,
+        like the encoder casts them to integers.
+        """
+        if len(self.source) == 0:
+            return data
+        if not np.issubdtype(data.dtype, np.integer):
+            data = data.astype(np.int64)
+        # Compare the labels in the data type, mixing signed and unsigned 64-bit
+        # integers would go through float64
+        limits = np.iinfo(data.dtype)
+        in_range = (self.source >= limits.min) & (self.source <= limits.max)
+        source = self.source[in_range].astype(data.dtype)
+        if len(source) == 0:
+            return data
+        dtype = np.promote_types(data.dtype, np.min_scalar_type(int(self.target.max())))
+        if dtype.kind == "f":
+            dtype = np.dtype(np.uint64)
+        target = self.target[in_range].astype(dtype)
+        index = np.searchsorted(source, data)
+        is_mapped = np.take(source, index, mode="clip") == data
+        return np.where(
+            is_mapped,
+            np.take(target, index, mode="clip"),
+            data.astype(dtype, copy=False),
+        )
+
+
+def relabel(
+    data: np.ndarray,
+    label_mapping: Optional[LabelMapping] = None,
+    convert_non_zero_to: Optional[int] = 0,
+) -> np.ndarray:
+    """
+    Apply the relabeling of the conversion to a chunk, returning a new array
+
+    The `label_mapping` is applied first, then if `convert_non_zero_to` is set
+    all the positive labels take this value and the others become background.
+    """
+    if label_mapping is not None:
+        data = label_mapping.apply(data)
+    if convert_non_zero_to:
+        dtype = np.promote_types(data.dtype, np.min_scalar_type(convert_non_zero_to))
+        data = np.where(data > 0, dtype.type(convert_non_zero_to), dtype.type(0))
+    return data
+
+
+def compute_compact_mapping(
+    dask_data: da.Array, label_mapping: Optional[LabelMapping] = None
+) -> LabelMapping:
+    """
+    Return the mapping of the labels of the volume to the dense range 1..n
+
+    The labels are first mapped by `label_mapping` if given, and keep their
+    order. Smaller labels need fewer bytes in the lookup tables of the
+    compressed segmentation blocks, so the chunks get smaller. The labels are
+    listed in a pass over the volume, one chunk at a time.
+    """
+    source = da.unique(dask_data).compute()
+    target = source if label_mapping is None else label_mapping.apply(source)
+    labels = np.unique(target[target != 0])
+    compact = np.searchsorted(labels, target) + 1
+    return LabelMapping(
+        source, np.where(target != 0, compact, 0).astype(np.uint64), is_complete=True
+    )
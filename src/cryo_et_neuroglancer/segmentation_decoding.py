@@ -1,6 +1,5 @@
 import struct
 from ctypes import LittleEndianStructure, c_uint64
-from math import ceil
 
 import numpy as np
 
@@ -51,40 +50,60 @@ class BlockHeader(LittleEndianStructure):
 def _unpack_encoded_values(
     packed_values: bytes | bytearray, bits: int, nb_values: int
 ) -> np.ndarray:
+    """
+    Unpack all the values stored in the packed 32-bit words
+
+    The result contains all the values of the words, including the padding
+    values of the last word, so it can be longer than `nb_values`.
+    """
     assert bits > 0, "Cannot decode packed values encoded using 0 bits by values"
     assert 32 % bits == 0
 
-    values_per_word = 32 // bits
-    mask = (1 << bits) - 1
+    packed_words = np.frombuffer(packed_values, dtype="<I")
+    return unpack_values(packed_words.reshape(1, -1), bits)[0]
 
-    values = (r[0] for r in struct.iter_unpack("<I", packed_values))
-    res: list[int] = []
-    for intval in values:
-        res.extend(
-            (intval >> (shift * bits)) & mask for shift in range(values_per_word)
-        )
-    return np.array(res, dtype="I")
 
+def unpack_values(packed_words: np.ndarray, bits: int) -> np.ndarray:
+    """
+    Unpack the values of several blocks at once
 
-# def ceil_div(a, b):
-#     """Ceil integer division (``ceil(a / b)`` using integer arithmetic)."""
-#     return (a - 1) // b + 1
+    Each bit width has its own kernel working on a byte view of the packed
+    words: the 8, 16 and 32 bit values are read in place, `np.unpackbits`
+    unpacks the 1 bit values, and the 2 and 4 bit values are extracted with in
+    place shifts and masks.
 
+    Parameters
+    ----------
+    packed_words : np.ndarray
+        The packed little endian 32-bit words with shape (nb_blocks, nb_words)
+    bits : int
+        The number of bits used to encode the values, one of 1, 2, 4, 8, 16, 32
 
-# def _unpack_encoded_values(packed_values, bits, num_values):
-#     assert bits > 0
-#     assert 32 % bits == 0
-#     bitmask = (1 << bits) - 1
-#     values_per_32bit = 32 // bits
-#     padded_values = np.empty(
-#         values_per_32bit * ceil_div(num_values, values_per_32bit), dtype="I"
-#     )
-#     packed_values = np.frombuffer(packed_values, dtype="<I")
-#     for shift in range(values_per_32bit):
-#         padded_values[shift::values_per_32bit] = (
-#             packed_values >> (shift * bits)
-#         ) & bitmask
-#     return padded_values[:num_values]
+    Returns
+    -------
+    np.ndarray
+        The unpacked values with shape (nb_blocks, nb_words * 32 // bits),
+        using the smallest unsigned integer type holding `bits` bits.
+        For 8, 16 and 32 bits, this is a view of `packed_words` when it is
+        C-contiguous.
+    """
+    if bits not in ALLOWED_ENCODED_BITS[1:]:
+        raise ValueError(
+            f"The encoded bits must one of {ALLOWED_ENCODED_BITS[1:]} but got {bits}"
+        )
+    packed_words = np.ascontiguousarray(packed_words, dtype="<I")
+    nb_blocks, nb_words = packed_words.shape
+    if bits >= 8:
+        return packed_words.view(f"<u{bits // 8}")
+    packed_bytes = packed_words.view(np.uint8)
+    if bits == 1:
+        return np.unpackbits(packed_bytes, axis=1, bitorder="little")
+    values_per_byte = 8 // bits
+    values = np.empty((nb_blocks, nb_words * 4, values_per_byte), dtype=np.uint8)
+    for index in range(values_per_byte):
+        np.right_shift(packed_bytes, index * bits, out=values[:, :, index])
+    np.bitwise_and(values, (1 << bits) - 1, out=values)
+    return values.reshape(nb_blocks, -1)
 
 
 def _unpad_block(
@@ -107,11 +126,19 @@ def _decode_block_header(block: bytearray, block_offset: int) -> BlockHeader:
 
 
 def _decode_lookup_table(
-    block: bytearray, lookup_table_offset: int, encoded_bits: int
+    block: bytearray,
+    lookup_table_offset: int,
+    encoded_bits: int,
+    data_type: str = "uint32",
 ) -> np.ndarray:
-    lookup_table_start = lookup_table_offset * BYTES_PER_DATA_VALUE
-    lookup_table_end = lookup_table_start + (2**encoded_bits) * BYTES_PER_DATA_VALUE
-    dtype = np.dtype(np.uint32).newbyteorder("<")
+    dtype = np.dtype(data_type).newbyteorder("<")
+    lookup_table_start = lookup_table_offset * OFFSET_BYTES
+    # The lookup table can have less than 2**encoded_bits values,
+    # it then stops at the end of the chunk at the latest
+    nb_values = min(
+        2**encoded_bits, (len(block) - lookup_table_start) // dtype.itemsize
+    )
+    lookup_table_end = lookup_table_start + nb_values * dtype.itemsize
     return np.frombuffer(block[lookup_table_start:lookup_table_end], dtype=dtype)
 
 
@@ -120,7 +147,7 @@ def _extract_encoded_values(
 ) -> np.ndarray:
     block_size = int(np.prod(nb_values))
     values_per_word = 32 // encoded_bits
-    values_per_block = ceil(block_size / values_per_word)
+    values_per_block = -(-block_size // values_per_word)
     encoded_values_end = encoded_values_offset + BYTES_PER_DATA_VALUE * values_per_block
     packed_values = block[encoded_values_offset:encoded_values_end]
     unpacked_encoded_values = _unpack_encoded_values(
@@ -137,7 +164,7 @@ def _decode_encoded_values(
     block_shape: tuple[int, int, int],
 ) -> np.ndarray:
     if encoded_bits == 0:
-        return np.full(block_shape, lookup_table[0], dtype=np.uint32)
+        return np.full(block_shape, lookup_table[0], dtype=lookup_table.dtype)
 
     block_size = int(np.prod(block_shape))
     encoded_values = _extract_encoded_values(
@@ -147,11 +174,14 @@ def _decode_encoded_values(
 
 
 def _decode_block(
-    block: bytearray, block_offset: int, block_shape: tuple[int, int, int]
+    block: bytearray,
+    block_offset: int,
+    block_shape: tuple[int, int, int],
+    data_type: str = "uint32",
 ) -> np.ndarray:
     header: BlockHeader = _decode_block_header(block, block_offset)
     lookup_table = _decode_lookup_table(
-        block, header.lookup_table_offset, header.encoded_bits
+        block, header.lookup_table_offset, header.encoded_bits, data_type
     )
     decoded_values = _decode_encoded_values(
         block,
@@ -167,15 +197,119 @@ def _decode_chunk_header(bytearray_chunk: bytearray):
     return struct.unpack("<I", bytearray_chunk[:4])[0]
 
 
-def decode_chunk(chunk: Chunk, block_size: tuple[int, int, int]) -> np.ndarray:
+def _gather_lookup_table_values(
+    chunk_words: np.ndarray, value_offsets: np.ndarray, data_type: str
+) -> np.ndarray:
+    """
+    Read the lookup table values at the given offsets (in 32-bit words)
+
+    uint64 values are stored on two 32-bit words, least significant first.
+    """
+    if data_type == "uint32":
+        return chunk_words[value_offsets]
+    low = chunk_words[value_offsets].astype(np.uint64)
+    high = chunk_words[value_offsets + 1].astype(np.uint64)
+    return low | (high << np.uint64(32))
+
+
+def _decode_blocks(
+    chunk_words: np.ndarray,
+    block_indices: np.ndarray,
+    nb_values_per_block: int,
+    data_type: str = "uint32",
+) -> np.ndarray:
+    """
+    Decode the given blocks of a chunk at once
+
+    Blocks using the same number of encoding bits are unpacked together, then
+    all their values are gathered from the lookup tables in bulk.
+
+    Parameters
+    ----------
+    chunk_words : np.ndarray
+        The chunk channel data as little endian 32-bit words
+    block_indices : np.ndarray
+        The indices of the blocks to decode (x varying the fastest)
+    nb_values_per_block : int
+        The number of values in each block
+    data_type : str
+        The data type of the segmentation, uint32 or uint64
+
+    Returns
+    -------
+    np.ndarray
+        The decoded values with shape (len(block_indices), nb_values_per_block)
+    """
+    words_per_value = np.dtype(data_type).itemsize // OFFSET_BYTES
+    block_headers = chunk_words[2 * block_indices[:, np.newaxis] + np.arange(2)].astype(
+        np.int64
+    )
+    lookup_table_offsets = block_headers[:, 0] & LEAST_SIGNIFICANT_24_BITS
+    encoded_bits = block_headers[:, 0] >> 24
+    encoded_values_offsets = block_headers[:, 1]
+
+    decoded_values = np.empty((len(block_indices), nb_values_per_block), data_type)
+    for bits in np.unique(encoded_bits):
+        if bits not in ALLOWED_ENCODED_BITS:
+            raise ValueError(
+                f"The encoded bits must one of {ALLOWED_ENCODED_BITS} but got {bits}"
+            )
+        same_bits = np.flatnonzero(encoded_bits == bits)
+        if bits == 0:
+            positions = np.zeros((len(same_bits), 1), dtype=np.int64)
+        else:
+            nb_words = -(-nb_values_per_block * int(bits) // 32)
+            packed_words = chunk_words[
+                encoded_values_offsets[same_bits, np.newaxis] + np.arange(nb_words)
+            ]
+            positions = unpack_values(packed_words, int(bits))[
+                :, :nb_values_per_block
+            ].astype(np.int64)
+        decoded_values[same_bits] = _gather_lookup_table_values(
+            chunk_words,
+            lookup_table_offsets[same_bits, np.newaxis] + words_per_value * positions,
+            data_type,
+        )
+    return decoded_values
+
+
+def _assemble_blocks(
+    decoded_blocks: np.ndarray,
+    grid_size: tuple[int, int, int],
+    block_size: tuple[int, int, int],
+) -> np.ndarray:
+    """
+    Place decoded blocks (x varying the fastest) in a preallocated 3D array
+
+    Returns
+    -------
+    np.ndarray
+        The array of shape (gz * bz, gy * by, gx * bx), including the padding
+    """
+    gz, gy, gx = grid_size
+    bz, by, bx = block_size
+    padded_values = np.empty((gz, bz, gy, by, gx, bx), dtype=decoded_blocks.dtype)
+    padded_values.transpose(0, 2, 4, 1, 3, 5)[...] = decoded_blocks.reshape(
+        gz, gy, gx, bz, by, bx
+    )
+    return padded_values.reshape(gz * bz, gy * by, gx * bx)
+
+
+def decode_chunk(
+    chunk: Chunk, block_size: tuple[int, int, int], data_type: str = "uint32"
+) -> np.ndarray:
     """Decode the given chunk
 
+    All the blocks are decoded in bulk and written into a preallocated array.
+
     Parameters
     ----------
     chunk : np.ndarray
         The chunk to decode
     block_size : tuple[int, int, int]
         The size of each block in the chunk
+    data_type : str
+        The data type of the segmentation, uint32 or uint64
 
     Returns
     -------
@@ -183,20 +317,74 @@ def decode_chunk(chunk: Chunk, block_size: tuple[int, int, int]) -> np.ndarray:
         The decoded chunk
     """
     chunk_shape = chunk.shape
+    grid_size = get_grid_size_from_block_shape(chunk_shape, block_size)
 
-    all_decoded_values = np.zeros(chunk_shape, dtype=np.uint32)
-    gz, gy, gx = get_grid_size_from_block_shape(chunk_shape, block_size)
+    nb_channels = _decode_chunk_header(chunk.buffer)
+    chunk_words = np.frombuffer(chunk.buffer, dtype="<I")[nb_channels:]
+    decoded_blocks = _decode_blocks(
+        chunk_words, np.arange(np.prod(grid_size)), int(np.prod(block_size)), data_type
+    )
+    all_decoded_values = _assemble_blocks(decoded_blocks, grid_size, block_size)
+    return all_decoded_values[: chunk_shape[0], : chunk_shape[1], : chunk_shape[2]]
+
+
+def decode_region(
+    chunk: Chunk,
+    block_size: tuple[int, int, int],
+    bbox: tuple[tuple[int, int, int], tuple[int, int, int]],
+    data_type: str = "uint32",
+) -> np.ndarray:
+    """Decode only a region of the given chunk
+
+    Only the block headers of the blocks intersecting the region are read, and
+    only those blocks are decoded, so the cost is proportional to the region.
+
+    Parameters
+    ----------
+    chunk : Chunk
+        The chunk to decode
+    block_size : tuple[int, int, int]
+        The size of each block in the chunk
+    bbox : tuple[tuple[int, int, int], tuple[int, int, int]]
+        The region to decode as (start, end) in z, y, x order, end excluded.
+        It uses the same coordinates as the chunk dimensions, and must be
+        inside the chunk
+    data_type : str
+        The data type of the segmentation, uint32 or uint64
+
+    Returns
+    -------
+    np.ndarray
+        The decoded region
+    """
+    chunk_start, chunk_end = chunk.dimensions
+    if any(
+        not (chunk_start[i] <= bbox[0][i] < bbox[1][i] <= chunk_end[i])
+        for i in range(3)
+    ):
+        raise ValueError(
+            f"The region {bbox} must be non empty and inside the chunk {chunk.dimensions}"
+        )
+    region_start = np.subtract(bbox[0], chunk_start)
+    region_end = np.subtract(bbox[1], chunk_start)
+    first_block = region_start // block_size
+    last_block = -(-region_end // block_size)
+    gz, gy, gx = get_grid_size_from_block_shape(chunk.shape, block_size)
+    z, y, x = np.meshgrid(
+        *(np.arange(first_block[i], last_block[i]) for i in range(3)), indexing="ij"
+    )
+    block_indices = (x + gx * (y + gy * z)).ravel()
 
     nb_channels = _decode_chunk_header(chunk.buffer)
-    chunk_array = chunk.buffer[nb_channels * BYTES_PER_DATA_VALUE :]
-    for z, y, x in np.ndindex(gz, gy, gx):
-        block_offset = 8 * (x + gx * (y + gy * z))
-        decoded_values = _decode_block(chunk_array, block_offset, block_size)
-        decoded_values = _unpad_block(z, y, x, decoded_values, block_size, chunk_shape)
-        all_decoded_values[
-            z * block_size[0] : (z + 1) * block_size[0],
-            y * block_size[1] : (y + 1) * block_size[1],
-            x * block_size[2] : (x + 1) * block_size[2],
-        ] = decoded_values
-
-    return all_decoded_values
+    chunk_words = np.frombuffer(chunk.buffer, dtype="<I")[nb_channels:]
+    decoded_blocks = _decode_blocks(
+        chunk_words, block_indices, int(np.prod(block_size)), data_type
+    )
+    decoded_values = _assemble_blocks(decoded_blocks, z.shape, block_size)  # type: ignore
+    crop_start = region_start - first_block * block_size
+    crop_end = crop_start + region_end - region_start
+    return decoded_values[
+        crop_start[0] : crop_end[0],
+        crop_start[1] : crop_end[1],
+        crop_start[2] : crop_end[2],
+    ]
@@ -1,12 +1,27 @@
-import functools
 import struct
 from typing import Optional
 
 import numpy as np
 
 from .chunk import Chunk
+from .relabel import relabel
 from .utils import get_grid_size_from_block_shape, number_of_encoding_bits, pad_block
 
+BYTES_PER_WORD = 4
+DATA_TYPES = ("uint32", "uint64")
+ENCODING_BITS = np.array([0, 1, 2, 4, 8, 16, 32])
+PACKING_BITS = (1, 2, 4, 8, 16, 32)
+MAX_VALUES_PER_ENCODING_BITS = np.array([1 << bits for bits in ENCODING_BITS])
+# Above this size, the lookup tables are computed by sorting instead of counting
+MAX_LABEL_PRESENCE_TABLE_SIZE = 1 << 22
+
+
+def _get_lookup_table_dtype(data_type: str) -> np.dtype:
+    """Return the little endian dtype of the lookup table values"""
+    if data_type not in DATA_TYPES:
+        raise ValueError(f"Data type must be one of {DATA_TYPES}, got {data_type}")
+    return np.dtype(data_type).newbyteorder("<")
+
 
 def _get_buffer_position(buffer: bytearray) -> int:
     """Return the current position in the buffer"""
@@ -53,27 +68,72 @@ def _pack_encoded_values(values: np.ndarray, bits: int) -> bytes:
         return bytes()
     assert 32 % bits == 0
     assert np.array_equal(values, values & ((1 << bits) - 1))
-    values_per_32bit = 32 // bits
-    padded_values = np.pad(
-        values.astype("<I", casting="unsafe"),
-        [(0, -len(values) % values_per_32bit)],
-        mode="constant",
-        constant_values=0,
-    )
-    assert len(padded_values) % values_per_32bit == 0
-    packed_values: np.ndarray = functools.reduce(
-        np.bitwise_or,
-        (
-            padded_values[shift::values_per_32bit] << (shift * bits)
-            for shift in range(values_per_32bit)
-        ),
-    )
-    return packed_values.tobytes()
-    # packed_values: int = functools.reduce(
-    #     operator.or_,
-    #     (value << (shift * bits) for shift, value in enumerate(padded_values)),
-    # )
-    # return struct.pack("<I", packed_values)
+    return pack_values(values.reshape(1, -1), bits).tobytes()
+
+
+def pack_values(
+    values: np.ndarray, bits: int, out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Pack the encoded values of several blocks at once
+
+    Each row of `values` holds the encoded values of one block, they are packed
+    following the same layout as `_pack_encoded_values`. Each bit width has its
+    own kernel writing directly into the packed words through a byte view: a
+    plain copy for 8, 16 and 32 bits, `np.packbits` for 1 bit, and in place
+    shifts of the interleaved values for 2 and 4 bits.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        The values to encode, with shape (nb_blocks, nb_values)
+    bits : int
+        The number of bits used to encode the values, one of 1, 2, 4, 8, 16, 32
+    out : Optional[np.ndarray]
+        A C-contiguous little endian uint32 array with shape (nb_blocks, nb_words)
+        to write the packed values into, allocated if not provided
+
+    Returns
+    -------
+    packed_values : np.ndarray
+        The packed values as little endian uint32 with shape (nb_blocks, nb_words)
+    """
+    if bits not in PACKING_BITS:
+        raise ValueError(f"Packing bits must be one of {PACKING_BITS}, got {bits}")
+    nb_blocks, nb_values = values.shape
+    nb_words = -(-nb_values * bits // 32)
+    if out is None:
+        out = np.empty((nb_blocks, nb_words), dtype="<I")
+    elif out.shape != (nb_blocks, nb_words) or out.dtype != np.dtype("<I"):
+        raise ValueError(
+            f"Output must be a little endian uint32 array of shape {(nb_blocks, nb_words)}"
+        )
+    if bits >= 8:
+        packed = out.view(f"<u{bits // 8}")
+        packed[:, :nb_values] = values
+        packed[:, nb_values:] = 0
+        return out
+    packed_bytes = out.view(np.uint8)
+    if bits == 1:
+        nb_bytes = -(-nb_values // 8)
+        # np.packbits is much faster on booleans than on wider integers
+        bits_set = values.astype(bool, copy=False)
+        packed_bytes[:, :nb_bytes] = np.packbits(bits_set, axis=1, bitorder="little")
+        packed_bytes[:, nb_bytes:] = 0
+        return out
+    values_per_byte = 8 // bits
+    packed_bytes[:] = 0
+    shifted = np.empty((nb_blocks, packed_bytes.shape[1]), dtype=np.uint8)
+    for index in range(values_per_byte):
+        interleaved = values[:, index::values_per_byte]
+        length = interleaved.shape[1]
+        np.left_shift(
+            interleaved, index * bits, out=shifted[:, :length], casting="unsafe"
+        )
+        np.bitwise_or(
+            packed_bytes[:, :length], shifted[:, :length], out=packed_bytes[:, :length]
+        )
+    return out
 
 
 def get_back_values_from_buffer(bytes_: bytes) -> tuple[np.ndarray, np.ndarray]:
@@ -140,6 +200,7 @@ def _create_lookup_table(
     buffer: bytearray,
     stored_lookup_tables: dict[bytes, tuple[int, int]],
     unique_values: np.ndarray,
+    data_type: str = "uint32",
 ) -> tuple[int, int]:
     """
     Create a lookup table for the given values
@@ -152,7 +213,9 @@ def _create_lookup_table(
         A dictionary mapping values to their offset in the buffer
     unique_values : np.ndarray
         The values to write to the buffer
-        Must be uint32 or uint64
+    data_type : str
+        The data type of the lookup table values, uint32 or uint64
+        uint64 values are stored on two 32-bit words
 
     Returns
     -------
@@ -161,7 +224,7 @@ def _create_lookup_table(
     encoded_bits : int
         The number of bits used to encode the values
     """
-    unique_values = unique_values.astype(np.uint32)
+    unique_values = unique_values.astype(_get_lookup_table_dtype(data_type))
     values_in_bytes = unique_values.tobytes()
     if values_in_bytes not in stored_lookup_tables:
         lookup_table_offset = _get_buffer_position(buffer)
@@ -207,47 +270,397 @@ def _create_file_chunk_header(number_channels: int = 1) -> bytearray:
     return buf
 
 
+def _split_into_blocks(
+    data: np.ndarray, block_size: tuple[int, int, int]
+) -> tuple[np.ndarray, tuple[int, int, int]]:
+    """
+    Split the data into blocks, one flattened block per row
+
+    The data is padded with zeros up to a multiple of the block size.
+    Blocks are ordered with x varying the fastest, then y, then z, and the
+    values inside each block follow the same order.
+
+    Returns
+    -------
+    blocks : np.ndarray
+        The blocks with shape (gz * gy * gx, bz * by * bx)
+    grid_size : tuple[int, int, int]
+        The number of blocks as gz, gy, gx
+    """
+    bz, by, bx = block_size
+    gz, gy, gx = get_grid_size_from_block_shape(data.shape, block_size)  # type: ignore
+    padded_data = pad_block(data, (gz * bz, gy * by, gx * bx))
+    blocks = (
+        padded_data.reshape(gz, bz, gy, by, gx, bx)
+        .transpose(0, 2, 4, 1, 3, 5)
+        .reshape(gz * gy * gx, bz * by * bx)
+    )
+    return blocks, (gz, gy, gx)
+
+
+def _compute_lookup_tables(
+    blocks: np.ndarray, label_range: Optional[tuple[int, int]] = None
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Compute the lookup tables and the encoded values of all the blocks at once
+
+    This is the batched equivalent of calling
+    `np.unique(block, return_inverse=True)` on each block. When the labels
+    span a small range, the lookup tables are built by counting the labels in
+    linear time, otherwise by sorting the blocks. Both give the same result.
+
+    Parameters
+    ----------
+    blocks : np.ndarray
+        The blocks with shape (nb_blocks, nb_values)
+    label_range : Optional[tuple[int, int]]
+        The minimum and maximum labels in the blocks, computed if not provided
+
+    Returns
+    -------
+    lookup_tables : np.ndarray
+        The sorted unique values of each block, concatenated block after block
+    table_lengths : np.ndarray
+        The number of unique values in each block
+    positions : np.ndarray
+        The position of each value in the lookup table of its block,
+        with the same shape as `blocks`
+    """
+    if blocks.size == 0 or not np.issubdtype(blocks.dtype, np.integer):
+        return _compute_lookup_tables_by_sorting(blocks)
+    min_label, max_label = label_range or (blocks.min(), blocks.max())
+    nb_labels = int(max_label) - int(min_label) + 1
+    # Past one label per value, scanning the presence table costs more than sorting
+    too_many_labels = nb_labels > blocks.shape[1]
+    if too_many_labels or len(blocks) * nb_labels > MAX_LABEL_PRESENCE_TABLE_SIZE:
+        return _compute_lookup_tables_by_sorting(blocks)
+    return _compute_lookup_tables_by_counting(blocks, int(min_label), nb_labels)
+
+
+def _compute_lookup_tables_by_sorting(
+    blocks: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Sort-based kernel of `_compute_lookup_tables`, O(n log n) per block"""
+    order = np.argsort(blocks, axis=1)
+    sorted_blocks = np.take_along_axis(blocks, order, axis=1)
+    is_new_value = np.empty(blocks.shape, dtype=bool)
+    is_new_value[:, 0] = True
+    np.not_equal(sorted_blocks[:, 1:], sorted_blocks[:, :-1], out=is_new_value[:, 1:])
+    sorted_positions = np.cumsum(is_new_value, axis=1, dtype=np.uint32) - 1
+    positions = np.empty_like(sorted_positions)
+    np.put_along_axis(positions, order, sorted_positions, axis=1)
+    table_lengths = sorted_positions[:, -1].astype(np.int64) + 1
+    return sorted_blocks[is_new_value], table_lengths, positions
+
+
+def _compute_lookup_tables_by_counting(
+    blocks: np.ndarray, min_label: int, nb_labels: int
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Counting kernel of `_compute_lookup_tables`, linear in the number of values
+
+    A (nb_blocks, nb_labels) table marks which labels are present in each
+    block. Its cumulative sum along the labels gives the position of each label
+    in the lookup table of the block.
+    """
+    nb_blocks = len(blocks)
+    # Subtracted modulo 2**64, the difference of signed labels overflows their
+    # type but is always smaller than nb_labels
+    offset = np.uint64(min_label % 2**64)
+    label_indices = (blocks.astype(np.uint64) - offset).astype(np.intp)
+    is_present = np.zeros((nb_blocks, nb_labels), dtype=bool)
+    is_present[np.arange(nb_blocks)[:, np.newaxis], label_indices] = True
+    label_positions = np.cumsum(is_present, axis=1, dtype=np.uint32) - 1
+    positions = np.take_along_axis(label_positions, label_indices, axis=1)
+    table_lengths = label_positions[:, -1].astype(np.int64) + 1
+    _, present_labels = np.nonzero(is_present)
+    lookup_tables = (present_labels.astype(np.uint64) + offset).astype(blocks.dtype)
+    return lookup_tables, table_lengths, positions
+
+
+def _compute_lookup_tables_skipping_uniform_blocks(
+    blocks: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Compute the lookup tables of all the blocks, sorting only non-uniform blocks
+
+    Uniform blocks (a single label, e.g. background) are detected with a
+    min == max reduction, their lookup table is their only value and they
+    don't need any encoded values.
+
+    Parameters
+    ----------
+    blocks : np.ndarray
+        The blocks with shape (nb_blocks, nb_values)
+
+    Returns
+    -------
+    lookup_tables : np.ndarray
+        The sorted unique values of each block, concatenated block after block
+    table_lengths : np.ndarray
+        The number of unique values in each block
+    mixed_indices : np.ndarray
+        The indices of the non-uniform blocks
+    positions : np.ndarray
+        The position of each value in the lookup table of its block,
+        only for the non-uniform blocks
+    """
+    block_min, block_max = blocks.min(axis=1), blocks.max(axis=1)
+    is_uniform = block_min == block_max
+    mixed_indices = np.flatnonzero(~is_uniform)
+    label_range = (
+        (block_min[mixed_indices].min(), block_max[mixed_indices].max())
+        if len(mixed_indices)
+        else None
+    )
+    mixed_tables, mixed_lengths, positions = _compute_lookup_tables(
+        blocks[mixed_indices], label_range
+    )
+
+    table_lengths = np.ones(len(blocks), dtype=np.int64)
+    table_lengths[mixed_indices] = mixed_lengths
+    table_ends = np.cumsum(table_lengths)
+    lookup_tables = np.empty(table_ends[-1], dtype=blocks.dtype)
+    lookup_tables[table_ends[is_uniform] - 1] = blocks[is_uniform, 0]
+    mixed_table_shifts = (table_ends - table_lengths)[mixed_indices] - (
+        np.cumsum(mixed_lengths) - mixed_lengths
+    )
+    lookup_tables[
+        np.repeat(mixed_table_shifts, mixed_lengths) + np.arange(len(mixed_tables))
+    ] = mixed_tables
+    return lookup_tables, table_lengths, mixed_indices, positions
+
+
+def _number_of_encoding_bits_per_block(table_lengths: np.ndarray) -> np.ndarray:
+    """Vectorized version of `number_of_encoding_bits`"""
+    if np.any(table_lengths > MAX_VALUES_PER_ENCODING_BITS[-1]):
+        raise ValueError("Too many unique values in block")
+    return ENCODING_BITS[np.searchsorted(MAX_VALUES_PER_ENCODING_BITS, table_lengths)]
+
+
+def _find_first_occurrences(values: bytes, lengths: np.ndarray) -> np.ndarray:
+    """
+    Return for each item the index of the first item with the same bytes
+
+    Parameters
+    ----------
+    values : bytes
+        The items, concatenated one after the other
+    lengths : np.ndarray
+        The length in bytes of each item
+
+    Returns
+    -------
+    np.ndarray
+        The index of the first identical item, for each item
+    """
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    stored_items: dict[bytes, int] = {}
+    first_occurrences = np.empty(len(lengths), dtype=np.int64)
+    for index, (start, end) in enumerate(zip(starts, ends)):
+        first_occurrences[index] = stored_items.setdefault(values[start:end], index)
+    return first_occurrences
+
+
+def _find_first_lookup_tables(
+    lookup_tables: np.ndarray, table_lengths: np.ndarray
+) -> np.ndarray:
+    """
+    Return for each block the index of the first block with the same lookup table
+
+    Identical lookup tables are only written once in the chunk, the blocks
+    using them after the first one point to the already written table.
+    The lookup tables must already have their final data type.
+    """
+    return _find_first_occurrences(
+        lookup_tables.tobytes(), table_lengths * lookup_tables.itemsize
+    )
+
+
+def _pack_and_deduplicate_blocks(
+    positions: np.ndarray,
+    block_indices: np.ndarray,
+    encoded_bits: np.ndarray,
+    deduplicate_blocks: bool = True,
+) -> tuple[np.ndarray, list[tuple[np.ndarray, np.ndarray]]]:
+    """
+    Pack the encoded values of the given blocks, and find identical packed blocks
+
+    The blocks using the same number of bits are packed together. Identical
+    packed values are only written once, the block headers of the following
+    identical blocks point to the already written values.
+
+    Parameters
+    ----------
+    positions : np.ndarray
+        The values of the blocks to pack, one block per row
+    block_indices : np.ndarray
+        The index of each block to pack in the chunk
+    encoded_bits : np.ndarray
+        The number of bits used to encode each block to pack
+    deduplicate_blocks : bool
+        Whether to look for identical packed blocks
+
+    Returns
+    -------
+    first_packed_blocks : np.ndarray
+        For each packed block, the index in the chunk of the first block
+        with the same packed values
+    packed_values : list[tuple[np.ndarray, np.ndarray]]
+        The indices in the chunk of the blocks to write, with their packed values
+    """
+    first_packed_blocks = block_indices.copy()
+    packed_values = []
+    for bits in np.unique(encoded_bits):
+        same_bits = encoded_bits == bits
+        same_bits_indices = block_indices[same_bits]
+        packed_blocks = pack_values(positions[same_bits], bits)
+        if deduplicate_blocks:
+            first_occurrences = _find_first_occurrences(
+                packed_blocks.tobytes(),
+                np.full(len(packed_blocks), packed_blocks[0].nbytes),
+            )
+            first_packed_blocks[same_bits] = same_bits_indices[first_occurrences]
+            is_new_block = first_occurrences == np.arange(len(packed_blocks))
+            same_bits_indices = same_bits_indices[is_new_block]
+            packed_blocks = packed_blocks[is_new_block]
+        packed_values.append((same_bits_indices, packed_blocks))
+    return first_packed_blocks, packed_values
+
+
+def _allocate_chunk_buffer(nb_words: int) -> tuple[bytearray, np.ndarray]:
+    """
+    Allocate the buffer of a one channel chunk holding `nb_words` 32-bit words
+
+    Returns
+    -------
+    buffer : bytearray
+        The buffer, starting with the file chunk header
+    words : np.ndarray
+        A writable uint32 view on the channel data of the buffer,
+        offsets in the block headers are relative to its start
+    """
+    header = _create_file_chunk_header()
+    buffer = bytearray(len(header) + nb_words * BYTES_PER_WORD)
+    buffer[: len(header)] = header
+    words = np.frombuffer(memoryview(buffer)[len(header) :], dtype="<I")
+    return buffer, words
+
+
+def _create_background_chunk(
+    grid_size: tuple[int, int, int],
+    dimensions: tuple[tuple[int, int, int], tuple[int, int, int]],
+    data_type: str = "uint32",
+) -> Chunk:
+    """
+    Create a chunk where all the blocks are background (0)
+
+    All the block headers point to the same one-value lookup table, placed
+    right after the headers, and use 0 encoding bits.
+    """
+    nb_blocks = grid_size[0] * grid_size[1] * grid_size[2]
+    lookup_table_offset = 2 * nb_blocks
+    table_words = _get_lookup_table_dtype(data_type).itemsize // BYTES_PER_WORD
+    buffer, words = _allocate_chunk_buffer(lookup_table_offset + table_words)
+    words[0:lookup_table_offset:2] = lookup_table_offset
+    words[1:lookup_table_offset:2] = lookup_table_offset + table_words
+    words[lookup_table_offset:] = 0
+    return Chunk(buffer, dimensions, is_empty=True)
+
+
 def create_segmentation_chunk(
     data: np.ndarray,
     dimensions: tuple[tuple[int, int, int], tuple[int, int, int]],
     block_size: tuple[int, int, int] = (8, 8, 8),
     convert_non_zero_to: Optional[int] = 0,
+    data_type: str = "uint32",
+    deduplicate_blocks: bool = True,
 ) -> Chunk:
-    """Convert data in a dask array to a neuroglancer segmentation chunk"""
-    bz, by, bx = block_size
+    """Convert data in a dask array to a neuroglancer segmentation chunk
+
+    The lookup tables are written with the given data type, either uint32 or
+    uint64 (stored as two 32-bit words), the data itself is never cast.
+
+    The lookup tables, encoded values and number of encoding bits of all the
+    blocks are computed in batch. Uniform blocks and chunks that only contain
+    background take a faster path as they don't need any sorting.
+    The exact size of the chunk is then computed from the lookup tables and
+    encoding bits to fill a single preallocated buffer.
+
+    Identical lookup tables are always written once. If `deduplicate_blocks`
+    is set, identical packed values are also written once and shared by all
+    the identical blocks.
+    """
     if len(data.shape) != 3:
         raise ValueError("Data must be 3-dimensional")
     if convert_non_zero_to:
-        data[data > 0] = convert_non_zero_to
-        data[data < 0] = 0
-    gz, gy, gx = get_grid_size_from_block_shape(data.shape, block_size)  # type: ignore
-    stored_lookup_tables: dict[bytes, tuple[int, int]] = {}
-
-    # big enough to hold the 64-bit starting block headers
-    buffer = bytearray(gx * gy * gz * 8)
-
-    # data = np.moveaxis(data, (0, 1, 2), (2, 1, 0))
-    for z, y, x in np.ndindex((gz, gy, gx)):
-        block = data[
-            z * bz : (z + 1) * bz, y * by : (y + 1) * by, x * bx : (x + 1) * bx
-        ]
-        unique_values, encoded_values = np.unique(block, return_inverse=True)
-        if block.shape != block_size:
-            block = pad_block(block, block_size)
-
-        lookup_table_offset, encoded_bits = _create_lookup_table(
-            buffer, stored_lookup_tables, unique_values
-        )
-        encoded_values_offset = _create_encoded_values(
-            buffer, encoded_values, encoded_bits
-        )
-        block_offset = 8 * (x + gx * (y + gy * z))
-        _create_block_header(
-            buffer,
-            lookup_table_offset,
-            encoded_bits,
-            encoded_values_offset,
-            block_offset,
-        )
+        data = relabel(data, convert_non_zero_to=convert_non_zero_to)
+    if not data.any():
+        grid_size = get_grid_size_from_block_shape(data.shape, block_size)  # type: ignore
+        return _create_background_chunk(grid_size, dimensions, data_type)
+    lookup_table_dtype = _get_lookup_table_dtype(data_type)
+    words_per_value = lookup_table_dtype.itemsize // BYTES_PER_WORD
+    blocks, _ = _split_into_blocks(data, block_size)
+    nb_blocks, nb_values_per_block = blocks.shape
+    (
+        lookup_tables,
+        table_lengths,
+        mixed_indices,
+        positions,
+    ) = _compute_lookup_tables_skipping_uniform_blocks(blocks)
+    encoded_bits = np.zeros(nb_blocks, dtype=np.int64)
+    encoded_bits[mixed_indices] = _number_of_encoding_bits_per_block(
+        table_lengths[mixed_indices]
+    )
+
+    lookup_tables = lookup_tables.astype(lookup_table_dtype)
+    first_packed_blocks = np.arange(nb_blocks)
+    (
+        first_packed_blocks[mixed_indices],
+        packed_values,
+    ) = _pack_and_deduplicate_blocks(
+        positions, mixed_indices, encoded_bits[mixed_indices], deduplicate_blocks
+    )
 
-    return Chunk(_create_file_chunk_header() + buffer, dimensions)
+    # Each block is written as its lookup table (if not already written)
+    # followed by its encoded values (if not already written),
+    # after all the 64-bit block headers
+    first_table_blocks = _find_first_lookup_tables(lookup_tables, table_lengths)
+    is_new_table = first_table_blocks == np.arange(nb_blocks)
+    is_new_packed_block = first_packed_blocks == np.arange(nb_blocks)
+    table_words = np.where(is_new_table, table_lengths * words_per_value, 0)
+    encoded_words = np.where(
+        is_new_packed_block, (nb_values_per_block * encoded_bits + 31) // 32, 0
+    )
+    block_words = table_words + encoded_words
+    block_starts = 2 * nb_blocks + np.cumsum(block_words) - block_words
+    lookup_table_offsets = block_starts[first_table_blocks]
+    encoded_values_offsets = (block_starts + table_words)[first_packed_blocks]
+
+    buffer, words = _allocate_chunk_buffer(2 * nb_blocks + int(block_words.sum()))
+    words[0 : 2 * nb_blocks : 2] = lookup_table_offsets | (encoded_bits << 24)
+    words[1 : 2 * nb_blocks : 2] = encoded_values_offsets
+
+    new_table_values = np.repeat(is_new_table, table_lengths)
+    table_value_positions = words_per_value * (
+        np.arange(len(lookup_tables))
+        - np.repeat(np.cumsum(table_lengths) - table_lengths, table_lengths)
+    ) + np.repeat(lookup_table_offsets, table_lengths)
+    words[
+        table_value_positions[new_table_values, np.newaxis] + np.arange(words_per_value)
+    ] = lookup_tables[new_table_values].view("<I").reshape(-1, words_per_value)
+
+    for block_indices, packed_blocks in packed_values:
+        words[
+            encoded_values_offsets[block_indices, np.newaxis]
+            + np.arange(packed_blocks.shape[1])
+        ] = packed_blocks
+
+    return Chunk(
+        buffer,
+        dimensions,
+        nb_packed_blocks=len(mixed_indices),
+        nb_deduplicated_blocks=len(mixed_indices)
+        - sum(len(p[0]) for p in packed_values),
+    )
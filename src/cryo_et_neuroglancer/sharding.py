@@ -66,7 +66,10 @@ def gzip_compress(content, compresslevel=None):
         compresslevel = 9
 
     stringio = BytesIO()
-    gzip_obj = gzip.GzipFile(mode="wb", fileobj=stringio, compresslevel=compresslevel)
+    # A fixed modification time keeps the output reproducible
+    gzip_obj = gzip.GzipFile(
+        mode="wb", fileobj=stringio, compresslevel=compresslevel, mtime=0
+    )
     gzip_obj.write(content)
     gzip_obj.close()
     return stringio.getvalue()
@@ -53,6 +53,10 @@ class ImageJSONGenerator(RenderingJSONGenerator):
     resolution: tuple[float, float, float]
     contrast_limits: tuple[float, float] = (-64, 64)
     middle_slices: tuple[int, int, int] = (0, 0, 0)
+    # The source is a precomputed image written by encode-image, not a ZARR
+    precomputed: bool = False
+    # Window of the original values quantized to uint8 by encode-image
+    quantization_window: Optional[tuple[float, float]] = None
 
     def __post_init__(self):
         self._type = RenderingTypes.IMAGE
@@ -72,15 +76,18 @@ class ImageJSONGenerator(RenderingJSONGenerator):
         for dim, resolution in zip("zyx", self.resolution[::-1]):
             make_transform(original, dim, resolution)
 
-        source = {
+        source: dict | str = {
             "url": f"zarr://{self.source}",
             "transform": {
                 "outputDimensions": transform,
                 "inputDimensions": original,
             },
         }
+        if self.precomputed:
+            # The resolution is in the info file of the precomputed image
+            source = f"precomputed://{self.source}"
 
-        return {
+        state = {
             "type": self.layer_type,
             "name": self.name,
             "source": source,
@@ -88,6 +95,9 @@ class ImageJSONGenerator(RenderingJSONGenerator):
             "tab": "rendering",
             "_non_neuroglancer_middle": self.middle_slices,
         }
+        if self.quantization_window is not None:
+            state["_non_neuroglancer_contrast_limits"] = self.quantization_window
+        return state
 
 
 @dataclass
@@ -95,6 +105,8 @@ class SegmentationJSONGenerator(RenderingJSONGenerator):
     """Generates a JSON file for Neuroglancer to read."""
 
     color: tuple[str, str]
+    # Name of each label, as written by merge-masks, all the labels are then shown
+    label_names: Optional[dict[int, str]] = None
 
     def __post_init__(self):
         self._type = RenderingTypes.SEGMENTATION
@@ -108,9 +120,7 @@ class SegmentationJSONGenerator(RenderingJSONGenerator):
             "tab": "rendering",
             "selectedAlpha": 1,
             "hoverHighlight": False,
-            "segments": [
-                1,
-            ],
+            "segments": sorted(self.label_names) if self.label_names else [1],
             "segmentDefaultColor": self.color[0],
         }
 
@@ -212,17 +222,24 @@ def create_image(
     resolution: Optional[float | tuple[float, float, float]],
     url: Optional[str],
     output: Optional[Path],
+    precomputed: bool = False,
+    quantization_window: Optional[tuple[float, float]] = None,
 ) -> int:
     source, name, url, output, zarr_path, resolution = setup_creation(
         source, name, url, output, zarr_path, resolution
     )
     contrast_limits, middles = compute_contrast_limits(Path(zarr_path))
+    if quantization_window is not None:
+        # The window is already mapped to the full uint8 range
+        contrast_limits = (0, 255)
     json_generator = ImageJSONGenerator(
         source=source,
         name=name,
         resolution=resolution,
         contrast_limits=contrast_limits,
         middle_slices=middles,
+        precomputed=precomputed,
+        quantization_window=quantization_window,
     )
     json_generator.to_json(output)
     return 0
@@ -261,13 +278,17 @@ def create_segmentation(
     url: Optional[str],
     output: Optional[Path],
     color: Optional[str],
+    label_names: Optional[Path] = None,
 ) -> int:
     source, name, url, output, _, _ = setup_creation(
         source, name, url, output, None, None
     )
     color_tuple = process_color(color)
+    names = None
+    if label_names is not None:
+        names = {int(k): v for k, v in json.loads(label_names.read_text()).items()}
     json_generator = SegmentationJSONGenerator(
-        source=source, name=name, color=color_tuple
+        source=source, name=name, color=color_tuple, label_names=names
     )
     json_generator.to_json(output)
     return 0
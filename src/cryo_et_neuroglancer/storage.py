@@ -0,0 +1,126 @@
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+from cloudfiles import CloudFiles
+
+from .utils import parallel_map
+
+DEFAULT_MAX_RETRIES = 5
+# Delay before the first retry, doubled for each following one
+DEFAULT_RETRY_DELAY = 0.5
+LOCAL_PROTOCOL = "file://"
+
+
+def is_remote(path: str | Path) -> bool:
+    """Return True if the path is the URL of an object store, like s3:// or gs://"""
+    path = str(path)
+    return "://" in path and not path.startswith(LOCAL_PROTOCOL)
+
+
+def get_local_path(path: str | Path) -> Path:
+    """Return the local path of a path, possibly given as a file:// URL"""
+    path = str(path)
+    return Path(
+        path[len(LOCAL_PROTOCOL) :] if path.startswith(LOCAL_PROTOCOL) else path
+    )
+
+
+class Uploader:
+    """
+    Upload files to an object store, retrying the failed uploads
+
+    The destination is a cloud-files URL, like s3://bucket/path, gs://bucket/path,
+    or mem://bucket/path for tests. cloud-files keeps a pool of connections
+    per bucket, shared by the threads, so concurrent uploads from a pool of
+    threads, as done by `ChunkWriter`, reuse the connections. With an
+    `endpoint`, any S3 compatible store, like MinIO, can be used.
+
+    A failed upload is retried `max_retries` times, waiting `retry_delay`
+    seconds before the first retry and twice as long before each next one.
+    """
+
+    def __init__(
+        self,
+        cloudpath: str,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        retry_delay: float = DEFAULT_RETRY_DELAY,
+        endpoint: Optional[str] = None,
+    ):
+        self.cloudpath = cloudpath
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.cloudfiles = CloudFiles(cloudpath, endpoint=endpoint)
+
+    def put(
+        self,
+        key: str,
+        content: bytes | bytearray,
+        content_encoding: Optional[str] = None,
+    ) -> None:
+        """
+        Upload the content under the key, relative to the destination
+
+        With a `content_encoding`, like "gzip", the content is already
+        compressed and is served with the matching Content-Encoding.
+        """
+        for retry in range(self.max_retries + 1):
+            try:
+                self.cloudfiles.put(
+                    key, bytes(content), compress=content_encoding, raw=True
+                )
+                return
+            except Exception:
+                if retry == self.max_retries:
+                    raise
+                time.sleep(self.retry_delay * 2**retry)
+
+    def list_keys(self) -> list[str]:
+        """Return the keys of all the files at the destination"""
+        return list(self.cloudfiles.list())
+
+    def exists(self, key: str) -> bool:
+        return bool(self.cloudfiles.exists(key))
+
+    def delete(self, keys: list[str]) -> None:
+        self.cloudfiles.delete(keys)
+
+    def upload_directory(self, directory: Path, workers: int = 4) -> None:
+        """Upload all the files of the local directory, keeping their relative paths"""
+        paths = [path for path in directory.rglob("*") if path.is_file()]
+
+        def upload(path: Path) -> None:
+            self.put(path.relative_to(directory).as_posix(), path.read_bytes())
+
+        for _ in parallel_map(upload, paths, workers):
+            pass
+
+
+def clear_remote_output(
+    uploader: Uploader,
+    delete_existing: bool,
+    is_conversion_output: Callable[[str], bool],
+) -> None:
+    """
+    Delete the output of a previous conversion at the destination, if allowed
+
+    Like `io.clear_output_directory`, the program exits if the destination
+    is not empty and `delete_existing` is not set, or if it contains files
+    for which `is_conversion_output` of their top-level name is False.
+    """
+    keys = uploader.list_keys()
+    if not keys:
+        return
+    if not delete_existing:
+        print(f"The output {uploader.cloudpath} already exists")
+        sys.exit(1)
+    if any(not is_conversion_output(k.split("/")[0]) for k in keys):
+        print(
+            f"The output {uploader.cloudpath} exists and contains non-conversion related files, not deleting it"
+        )
+        sys.exit(1)
+    print(
+        f"The output {uploader.cloudpath} exists from a previous run, deleting before starting the conversion"
+    )
+    uploader.delete(keys)
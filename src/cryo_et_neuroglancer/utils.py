@@ -1,14 +1,29 @@
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import lru_cache
 from math import ceil
 from pathlib import Path
-from typing import Iterator, Optional
+from queue import Full, Queue
+from typing import Any, Callable, Iterable, Iterator, Optional, TypeVar
 
 import dask.array as da
 import numpy as np
+from dask.array.core import normalize_chunks
+from tqdm import tqdm
 
 from .io import load_omezarr_data
 
 
+# Number of voxels of the automatically sized output chunks, as many as 64^3
+DEFAULT_CHUNK_NB_VOXELS = 64**3
+# Number of voxels of the tiles read to build a pyramid in one pass, as many as 256^3
+DEFAULT_MAX_TILE_NB_VOXELS = 256**3
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
 class DotDict(dict):
     """dot.notation access to dictionary attributes"""
 
@@ -50,11 +65,22 @@ def compute_contrast_limits(
     middle_z_slice = data.shape[0] // 2
     middle_y_slice = data.shape[1] // 2
     middle_x_slice = data.shape[2] // 2
+    limits = compute_data_contrast_limits(data)
+    return limits, (middle_z_slice, middle_y_slice, middle_x_slice)
+
+
+def compute_data_contrast_limits(data: da.Array) -> tuple[float, float]:
+    """
+    Compute the contrast limits from random samples of the middle z slices
+
+    Only the few middle slices are read, so the data can be loaded lazily.
+    """
+    middle_z_slice = data.shape[0] // 2
     z_start = max(middle_z_slice - 2, 0)
     z_end = min(middle_z_slice + 2, data.shape[0])
     sample_data = get_random_samples(data[z_start:z_end], 1500)
-    limits = np.percentile(sample_data, (5.0, 95.0))
-    return np.round(limits, 2), (middle_z_slice, middle_y_slice, middle_x_slice)
+    low, high = np.round(np.percentile(sample_data, (5.0, 95.0)), 2)
+    return float(low), float(high)
 
 
 def get_random_samples(dask_array: da.Array, size: int) -> np.ndarray:
@@ -102,15 +128,23 @@ def pad_block(block: np.ndarray, block_size: tuple[int, int, int]) -> np.ndarray
 
 def iterate_chunks(
     dask_data: da.Array,
+    chunk_size: Optional[tuple[int, int, int]] = None,
 ) -> Iterator[tuple[da.Array, tuple[tuple[int, int, int], tuple[int, int, int]]]]:
-    """Iterate over the chunks in the dask array"""
-    chunk_layout = dask_data.chunks
+    """
+    Iterate over the chunks in the dask array
+
+    If `chunk_size` is given, in z, y, x order, the array is cut in chunks of
+    that size instead of its own chunks. Each chunk is a lazy slice of the
+    array, computing it only reads the input chunks it overlaps.
+    """
+    if chunk_size is None:
+        chunk_layout = dask_data.chunks
+    else:
+        chunk_layout = normalize_chunks(chunk_size, dask_data.shape)
 
     for zi, z in enumerate(chunk_layout[0]):
         for yi, y in enumerate(chunk_layout[1]):
             for xi, x in enumerate(chunk_layout[2]):
-                chunk = dask_data.blocks[zi, yi, xi]
-
                 # Calculate the chunk dimensions
                 start = (
                     sum(chunk_layout[0][:zi]),
@@ -119,9 +153,293 @@ def iterate_chunks(
                 )
                 end = (start[0] + z, start[1] + y, start[2] + x)
                 dimensions = (start, end)
+                if chunk_size is None:
+                    chunk = dask_data.blocks[zi, yi, xi]
+                else:
+                    chunk = dask_data[
+                        start[0] : end[0], start[1] : end[1], start[2] : end[2]
+                    ]
                 yield chunk, dimensions
 
 
+def get_chunk_dimensions(
+    start: tuple[int, int, int],
+    end: tuple[int, int, int],
+    chunk_size: Optional[tuple[int, int, int]],
+) -> list[tuple[tuple[int, int, int], tuple[int, int, int]]]:
+    """Return the dimensions of the chunks covering the region, a single one without chunk size"""
+    if chunk_size is None:
+        return [(start, end)]
+    shape = (end[0] - start[0], end[1] - start[1], end[2] - start[2])
+    dimensions = []
+    for index in np.ndindex(get_grid_size_from_block_shape(shape, chunk_size)):
+        chunk_start = (
+            start[0] + index[0] * chunk_size[0],
+            start[1] + index[1] * chunk_size[1],
+            start[2] + index[2] * chunk_size[2],
+        )
+        chunk_end = (
+            min(chunk_start[0] + chunk_size[0], end[0]),
+            min(chunk_start[1] + chunk_size[1], end[1]),
+            min(chunk_start[2] + chunk_size[2], end[2]),
+        )
+        dimensions.append((chunk_start, chunk_end))
+    return dimensions
+
+
+def split_into_chunks(
+    data: np.ndarray,
+    start: tuple[int, int, int],
+    chunk_size: Optional[tuple[int, int, int]],
+) -> Iterator[tuple[np.ndarray, tuple[tuple[int, int, int], tuple[int, int, int]]]]:
+    """Yield the chunks of the data, with their dimensions in the volume"""
+    end = (start[0] + data.shape[0], start[1] + data.shape[1], start[2] + data.shape[2])
+    for chunk_start, chunk_end in get_chunk_dimensions(start, end, chunk_size):
+        chunk = data[
+            chunk_start[0] - start[0] : chunk_end[0] - start[0],
+            chunk_start[1] - start[1] : chunk_end[1] - start[1],
+            chunk_start[2] - start[2] : chunk_end[2] - start[2],
+        ]
+        yield chunk, (chunk_start, chunk_end)
+
+
+def get_tile_chunk_dimensions(
+    dimensions: tuple[tuple[int, int, int], tuple[int, int, int]],
+    chunk_size: Optional[tuple[int, int, int]],
+    downsampling_factors: list[tuple[int, int, int]],
+) -> list[tuple[int, tuple[tuple[int, int, int], tuple[int, int, int]]]]:
+    """Return the scale and dimensions of all the chunks created from a tile"""
+    start, end = dimensions
+    chunks: list[tuple[int, tuple[tuple[int, int, int], tuple[int, int, int]]]] = []
+    for scale in range(len(downsampling_factors) + 1):
+        if scale > 0:
+            f = downsampling_factors[scale - 1]
+            start = (start[0] // f[0], start[1] // f[1], start[2] // f[2])
+            end = (-(-end[0] // f[0]), -(-end[1] // f[1]), -(-end[2] // f[2]))
+        chunks.extend(
+            (scale, chunk) for chunk in get_chunk_dimensions(start, end, chunk_size)
+        )
+    return chunks
+
+
+def get_tile_size(
+    chunk_size: Optional[tuple[int, int, int]],
+    downsampling_factors: list[tuple[int, int, int]],
+) -> Optional[tuple[int, int, int]]:
+    """
+    Return the size of the tiles of data covering one chunk of the lowest scale
+
+    Each tile is read once, then downsampled scale after scale, so the
+    pyramid is built in a single pass over the data.
+    """
+    if not downsampling_factors or chunk_size is None:
+        return chunk_size
+    total_factor = np.prod(downsampling_factors, axis=0)
+    return (
+        chunk_size[0] * int(total_factor[0]),
+        chunk_size[1] * int(total_factor[1]),
+        chunk_size[2] * int(total_factor[2]),
+    )
+
+
+def split_downsampling_factors(
+    chunk_size: tuple[int, int, int],
+    downsampling_factors: list[tuple[int, int, int]],
+    max_tile_nb_voxels: int = DEFAULT_MAX_TILE_NB_VOXELS,
+) -> list[list[tuple[int, int, int]]]:
+    """
+    Split the downsampling factors into passes whose tiles have at most `max_tile_nb_voxels`
+
+    The tiles of a pass cover one chunk of its lowest scale, see
+    `get_tile_size`, so they grow with each factor, up to the whole volume.
+    Each pass gets at least one factor, and the passes after the first one
+    downsample the lowest scale of the previous one.
+    """
+    passes: list[list[tuple[int, int, int]]] = []
+    for factor in downsampling_factors:
+        if passes:
+            pass_factor = np.prod(passes[-1] + [factor])
+            if np.prod(chunk_size) * pass_factor <= max_tile_nb_voxels:
+                passes[-1].append(factor)
+                continue
+        passes.append([factor])
+    return passes or [[]]
+
+
+def compute_chunk_size(
+    data_shape: tuple[int, int, int],
+    block_size: tuple[int, int, int],
+    nb_voxels: int = DEFAULT_CHUNK_NB_VOXELS,
+) -> tuple[int, int, int]:
+    """
+    Return an output chunk size holding about `nb_voxels` voxels for the data
+
+    The chunks are as cubic as possible, but an axis thinner than the cube
+    side, like the Z axis of a thin tomogram, is covered by a single chunk and
+    its share of the volume goes to the other axes. The other sizes are rounded
+    to multiples of the block size. All the shapes are in z, y, x order.
+    """
+    chunk_size = list(data_shape)
+    remaining_axes = [0, 1, 2]
+    remaining_nb_voxels = float(nb_voxels)
+    while remaining_axes:
+        side = remaining_nb_voxels ** (1 / len(remaining_axes))
+        thin_axes = [axis for axis in remaining_axes if data_shape[axis] <= side]
+        if not thin_axes:
+            for axis in remaining_axes:
+                nb_blocks = max(round(side / block_size[axis]), 1)
+                max_nb_blocks = ceil(data_shape[axis] / block_size[axis])
+                chunk_size[axis] = min(nb_blocks, max_nb_blocks) * block_size[axis]
+            break
+        for axis in thin_axes:
+            remaining_nb_voxels /= max(data_shape[axis], 1)
+            remaining_axes.remove(axis)
+    return chunk_size[0], chunk_size[1], chunk_size[2]
+
+
+def get_chunk_size(
+    chunk_size: Optional[list[str]],
+) -> Optional[tuple[int, int, int] | str]:
+    """
+    Parse the chunk size given in X Y Z order, as a single value, or as "auto"
+
+    Returns
+    -------
+    Optional[tuple[int, int, int] | str]
+        None if no chunk size is given, "auto" for an automatic chunk size,
+        or the chunk size in z, y, x order
+    """
+    if not chunk_size:
+        return None
+    if list(chunk_size) == ["auto"]:
+        return "auto"
+    sizes = [int(size) for size in chunk_size]
+    if len(sizes) == 1:
+        sizes = sizes * 3
+    if len(sizes) != 3:
+        raise ValueError("Chunk size must have 3 values, a single value, or be auto")
+    if any(size <= 0 for size in sizes):
+        raise ValueError("Chunk size component has to be > 0")
+    return sizes[2], sizes[1], sizes[0]
+
+
+def parallel_map(
+    function: Callable[[T], R],
+    items: Iterable[T],
+    workers: int = 1,
+    max_in_flight: Optional[int] = None,
+) -> Iterator[R]:
+    """
+    Apply the function to the items with a pool of threads, yielding the results in order
+
+    NumPy and the I/O release the GIL, so threads encode and write chunks in
+    parallel without copying them to other processes. At most `max_in_flight`
+    items (twice the number of workers by default) are submitted ahead of the
+    result being yielded, which bounds the memory used. An exception raised by
+    the function is re-raised when its result is reached, and the pending items
+    are cancelled.
+    """
+    if workers <= 1:
+        yield from map(function, items)
+        return
+    max_in_flight = max(max_in_flight or 2 * workers, 1)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    in_flight: deque[Future[R]] = deque()
+    try:
+        for item in items:
+            if len(in_flight) >= max_in_flight:
+                yield in_flight.popleft().result()
+            in_flight.append(executor.submit(function, item))
+        while in_flight:
+            yield in_flight.popleft().result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def prefetch(items: Iterable[T], read_ahead: int) -> Iterator[T]:
+    """
+    Consume the items in a background thread, up to `read_ahead` items ahead of the caller
+
+    Used on a lazy iterator, the work done to produce each item, like reading a
+    chunk from the disk, overlaps with the work of the caller on the previous
+    items. An exception raised while producing an item is re-raised when that
+    item is reached.
+    """
+    if read_ahead <= 0:
+        yield from items
+        return
+    queue: Queue[tuple[Any, Optional[BaseException]]] = Queue(maxsize=read_ahead)
+    end_of_items = object()
+    stopped = threading.Event()
+
+    def put(entry: tuple[Any, Optional[BaseException]]) -> bool:
+        while not stopped.is_set():
+            try:
+                queue.put(entry, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def produce() -> None:
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((end_of_items, None))
+        except BaseException as error:
+            put((None, error))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if error is not None:
+                raise error
+            if item is end_of_items:
+                return
+            yield item
+    finally:
+        stopped.set()
+        producer.join()
+
+
+def process_tiles(
+    tiles: Iterable[tuple[da.Array, T]],
+    process: Callable[[tuple[np.ndarray, T]], list[R]],
+    workers: int = 1,
+    max_in_flight: Optional[int] = None,
+    read_ahead: int = 0,
+    total: Optional[int] = None,
+    desc: str = "Processing chunks",
+) -> Iterator[R]:
+    """
+    Load the lazy tiles and process them, yielding the results in the order of the tiles
+
+    Each tile comes with its dimensions, given to `process` with the loaded
+    data. The tiles are loaded and processed by a pool of `workers` threads,
+    see `parallel_map`. With `read_ahead`, a background thread loads up to
+    `read_ahead` tiles ahead of the processing instead, see `prefetch`.
+    """
+    # The pool already runs one tile per thread, dask must not add its own
+    scheduler = "synchronous" if workers > 1 else None
+
+    def load(tile: tuple[da.Array, T]) -> tuple[np.ndarray, T]:
+        data, dimensions = tile
+        return np.asarray(data.compute(scheduler=scheduler)), dimensions
+
+    if read_ahead > 0:
+        loaded = prefetch(map(load, tiles), read_ahead)
+        processed = parallel_map(process, loaded, workers, max_in_flight)
+    else:
+        processed = parallel_map(
+            lambda tile: process(load(tile)), tiles, workers, max_in_flight
+        )
+    for results in tqdm(processed, desc=desc, total=total):
+        yield from results
+
+
 def make_transform(input_dict: dict, dim: str, resolution: float):
     input_dict[dim] = [resolution * 10e-10, "m"]
 
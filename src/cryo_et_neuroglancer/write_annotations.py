@@ -1,6 +1,7 @@
 import json
+import tempfile
 from pathlib import Path
-from typing import Any
+from typing import Any, Optional
 
 import ndjson
 from neuroglancer import AnnotationPropertySpec, CoordinateSpace
@@ -8,6 +9,7 @@ from neuroglancer.server import sys
 from neuroglancer.write_annotations import AnnotationWriter
 
 from cryo_et_neuroglancer.sharding import ShardingSpecification, jsonify
+from cryo_et_neuroglancer.storage import Uploader, get_local_path, is_remote
 from cryo_et_neuroglancer.utils import parse_color
 
 
@@ -122,26 +124,45 @@ def _shard_by_id_index(directory: Path, shard_bits: int, minishard_bits: int):
 
 def main(
     json_path: Path,
-    output: Path,
+    output: Path | str,
     resolution: float,
     color: list[str],
     shard_by_id: tuple[int, int] = (0, 10),
+    endpoint: Optional[str] = None,
 ) -> None:
     """For each path set, load the data and write the combined annotations."""
     annotations = load_data(json_path, json_path.with_suffix(".ndjson"))
     if len(annotations) == 0:
         print(f"No annotation found in {json_path.with_suffix('.ndjson')!s}")
         sys.exit(-1)
-    process_annotation(annotations, output, resolution, color, shard_by_id)
+    process_annotation(annotations, output, resolution, color, shard_by_id, endpoint)
 
 
 def process_annotation(
     annotations: tuple[dict[str, Any], list[dict[str, Any]]],
-    output: Path,
+    output: Path | str,
     resolution: float,
     color: list[str],
     shard_by_id: tuple[int, int] = (0, 10),
+    endpoint: Optional[str] = None,
 ) -> None:
+    """
+    Write the annotations to the output directory, or object store URL
+
+    The annotation writer only writes to a local directory, so for an object
+    store the annotations are written to a temporary directory then uploaded.
+    """
+    if output is None:
+        raise ValueError("An output directory or object store URL is required")
+    if is_remote(output):
+        with tempfile.TemporaryDirectory() as directory:
+            process_annotation(
+                annotations, Path(directory), resolution, color, shard_by_id
+            )
+            Uploader(str(output), endpoint=endpoint).upload_directory(Path(directory))
+        print("Uploaded annotations to", output)
+        return
+    output = get_local_path(output)
     if shard_by_id and len(shard_by_id) < 2:
         shard_by_id = (0, 10)
 
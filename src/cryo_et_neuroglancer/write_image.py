@@ -0,0 +1,420 @@
+import json
+from contextlib import nullcontext
+from functools import partial
+from io import BytesIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Iterator, Optional
+
+import dask.array as da
+import numpy as np
+import zarr
+from PIL import Image
+
+from .chunk import Chunk
+from .chunk_writer import DEFAULT_WRITER_WORKERS, ChunkWriter
+from .downsampling import (
+    compute_downsampling_factors,
+    downsample_average,
+    get_downsampled_scales,
+)
+from .io import (
+    clear_output_directory,
+    get_scale_key,
+    is_scale_output,
+    load_omezarr_data,
+    write_metadata,
+)
+from .storage import Uploader, clear_remote_output, get_local_path, is_remote
+from .utils import (
+    DEFAULT_MAX_TILE_NB_VOXELS,
+    compute_chunk_size,
+    compute_data_contrast_limits,
+    get_grid_size_from_block_shape,
+    get_tile_size,
+    iterate_chunks,
+    process_tiles,
+    split_downsampling_factors,
+    split_into_chunks,
+)
+
+# Data types of the precomputed image format
+DATA_TYPES = (
+    "uint8",
+    "int8",
+    "uint16",
+    "int16",
+    "uint32",
+    "int32",
+    "uint64",
+    "float32",
+)
+ENCODINGS = ("raw", "jpeg")
+# The auto chunk size is not constrained by an encoding block size
+IMAGE_BLOCK_SIZE = (1, 1, 1)
+DEFAULT_JPEG_QUALITY = 85
+# Key of the info file recording the window quantized to uint8, ignored by neuroglancer
+CONTRAST_LIMITS_KEY = "_non_neuroglancer_contrast_limits"
+
+
+def _create_metadata(
+    chunk_size: tuple[int, int, int],
+    data_size: tuple[int, int, int],
+    data_directory: str,
+    resolution: tuple[float, float, float] = (1.0, 1.0, 1.0),
+    data_type: str = "float32",
+    lower_scales: Optional[
+        list[tuple[tuple[int, int, int], tuple[int, int, int]]]
+    ] = None,
+    encoding: str = "raw",
+    contrast_limits: Optional[tuple[float, float]] = None,
+) -> dict[str, Any]:
+    """
+    Create the metadata for the image
+
+    `lower_scales` holds the size of each downsampled scale, with its
+    downsampling factor from the full resolution, in z, y, x order.
+    `contrast_limits` is the window of the values quantized to uint8.
+    """
+    scales = [(data_size, (1, 1, 1))] + (lower_scales or [])
+    metadata: dict[str, Any] = {
+        "@type": "neuroglancer_multiscale_volume",
+        "data_type": data_type,
+        "num_channels": 1,
+        "scales": [
+            {
+                "chunk_sizes": [chunk_size[::-1]],
+                "encoding": encoding,
+                "resolution": tuple(
+                    r * f for r, f in zip(resolution, factor[::-1])
+                ),  # the resolution is in X-Y-Z order
+                "key": get_scale_key(data_directory, scale),
+                "size": size[::-1],  # reverse the data size to pass from Z-Y-X to X-Y-Z
+                "voxel_offset": (0, 0, 0),
+            }
+            for scale, (size, factor) in enumerate(scales)
+        ],
+        "type": "image",
+    }
+    if contrast_limits is not None:
+        metadata[CONTRAST_LIMITS_KEY] = [float(limit) for limit in contrast_limits]
+    return metadata
+
+
+def _get_data_type(dtype: np.dtype) -> str:
+    """Return the precomputed data type storing the values of the image"""
+    if dtype.name in DATA_TYPES:
+        return dtype.name
+    if np.issubdtype(dtype, np.floating):
+        return "float32"
+    if dtype == np.bool_:
+        return "uint8"
+    raise ValueError(f"The {dtype} data type is not supported by the image format")
+
+
+def quantize(data: np.ndarray, contrast_limits: tuple[float, float]) -> np.ndarray:
+    """
+    Map the values of the contrast window linearly to uint8, clipping the values outside
+
+    The lower limit becomes 0 and the upper limit 255.
+    """
+    low, high = contrast_limits
+    scale = 255 / (high - low) if high > low else 0.0
+    scaled = (data.astype(np.float32) - np.float32(low)) * np.float32(scale)
+    return np.rint(np.clip(scaled, 0, 255)).astype(np.uint8)
+
+
+def create_image_chunk(
+    data: np.ndarray,
+    dimensions: tuple[tuple[int, int, int], tuple[int, int, int]],
+    data_type: str = "float32",
+    encoding: str = "raw",
+    jpeg_quality: int = DEFAULT_JPEG_QUALITY,
+) -> Chunk:
+    """
+    Encode the data, in z, y, x order, as a precomputed image chunk
+
+    The raw encoding stores the little endian values with x varying fastest,
+    the C order of the z, y, x data. The jpeg encoding, for uint8 data only,
+    stores the chunk as a single grayscale JPEG image of x columns and y * z
+    rows, at the given quality.
+    """
+    if encoding == "jpeg":
+        if data_type != "uint8":
+            raise ValueError(f"The jpeg encoding needs uint8 data, not {data_type}")
+        shape_z, shape_y, shape_x = data.shape
+        rows = np.ascontiguousarray(data, dtype=np.uint8).reshape(
+            shape_z * shape_y, shape_x
+        )
+        output = BytesIO()
+        Image.fromarray(rows, mode="L").save(
+            output, format="JPEG", quality=jpeg_quality
+        )
+        return Chunk(bytearray(output.getvalue()), dimensions)
+    values = np.ascontiguousarray(data, dtype=np.dtype(data_type).newbyteorder("<"))
+    return Chunk(bytearray(values.tobytes()), dimensions)
+
+
+def create_image(
+    dask_data: da.Array,
+    data_type: str = "float32",
+    workers: int = 1,
+    max_in_flight: Optional[int] = None,
+    output_directories: Optional[list[Path]] = None,
+    read_ahead: int = 0,
+    chunk_size: Optional[tuple[int, int, int]] = None,
+    downsampling_factors: Optional[list[tuple[int, int, int]]] = None,
+    chunk_writer: Optional[ChunkWriter] = None,
+    encoding: str = "raw",
+    contrast_limits: Optional[tuple[float, float]] = None,
+    jpeg_quality: int = DEFAULT_JPEG_QUALITY,
+    encode_first_scale: bool = True,
+    lowest_scale_output: Optional[zarr.Array] = None,
+) -> Iterator[Chunk]:
+    """
+    Yield the precomputed image chunks of all the scales
+
+    The chunks are read, downsampled and encoded like in
+    `write_segmentation.create_segmentation`: the data is read in tiles
+    covering one chunk of the lowest scale, by a pool of `workers` threads,
+    and each tile is averaged down scale after scale. The chunks of scale `n`
+    are written in `output_directories[n]`, through the `chunk_writer` if given.
+
+    With `contrast_limits`, each scale is averaged from the original values
+    of the previous one, then quantized to uint8, see `quantize`.
+
+    Without `encode_first_scale`, only the downsampled scales are encoded, the
+    first one being the lowest scale of a previous pass. With
+    `lowest_scale_output`, the original values of the lowest scale are also
+    written to this Zarr array, for the next pass.
+    """
+    factors = downsampling_factors or []
+    if chunk_size is None:
+        chunk_size = dask_data.chunksize  # type: ignore
+    tile_size: tuple[int, int, int] = get_tile_size(chunk_size, factors)  # type: ignore
+
+    def encode(
+        data_and_dimensions: tuple[np.ndarray, tuple[tuple[int, int, int], ...]],
+    ) -> list[Chunk]:
+        data, (start, _) = data_and_dimensions
+        encoded_chunks = []
+        for scale in range(len(factors) + 1):
+            if scale > 0:
+                factor = factors[scale - 1]
+                data = downsample_average(data, factor)
+                start = (
+                    start[0] // factor[0],
+                    start[1] // factor[1],
+                    start[2] // factor[2],
+                )
+            if scale == 0 and not encode_first_scale:
+                continue
+            values = (
+                data if contrast_limits is None else quantize(data, contrast_limits)
+            )
+            for chunk, dimensions in split_into_chunks(values, start, chunk_size):
+                encoded = create_image_chunk(
+                    chunk, dimensions, data_type, encoding, jpeg_quality
+                )
+                encoded.scale = scale
+                if chunk_writer is not None and output_directories is not None:
+                    chunk_writer.write_chunk(encoded, output_directories[scale])
+                elif output_directories is not None:
+                    encoded.write_to_directory(output_directories[scale])
+                encoded_chunks.append(encoded)
+        if lowest_scale_output is not None:
+            lowest_scale_output[
+                start[0] : start[0] + data.shape[0],
+                start[1] : start[1] + data.shape[1],
+                start[2] : start[2] + data.shape[2],
+            ] = data
+        return encoded_chunks
+
+    num_iters = int(np.prod(get_grid_size_from_block_shape(dask_data.shape, tile_size)))
+    yield from process_tiles(
+        iterate_chunks(dask_data, tile_size),
+        encode,
+        workers,
+        max_in_flight,
+        read_ahead,
+        num_iters,
+    )
+
+
+def main(
+    filename: Path,
+    data_directory: str = "data",
+    delete_existing_output_directory: bool = False,
+    output_path: Optional[Path | str] = None,
+    resolution: tuple[float, float, float] = (1.0, 1.0, 1.0),
+    workers: int = 1,
+    streaming: bool = False,
+    read_ahead: int = 2,
+    chunk_size: Optional[tuple[int, int, int] | str] = "auto",
+    max_scales: int = 8,
+    max_tile_nb_voxels: int = DEFAULT_MAX_TILE_NB_VOXELS,
+    writer_workers: int = DEFAULT_WRITER_WORKERS,
+    encoding: str = "raw",
+    quantize_to_uint8: bool = False,
+    contrast_limits: Optional[tuple[float, float]] = None,
+    jpeg_quality: int = DEFAULT_JPEG_QUALITY,
+    endpoint: Optional[str] = None,
+) -> None:
+    """
+    Convert the given OME-Zarr tomogram to a precomputed multiscale image
+
+    The values are written as raw chunks of the `chunk_size` shape, in
+    z, y, x order, computed from the volume shape with "auto", or following
+    the input chunking if not given. Each scale averages 2 x 2 x 2 voxels of
+    the previous one, or fewer on the axes already fitting in one chunk, so
+    zooming out only loads a few chunks. The pyramid stops when the volume
+    fits in a single chunk, or at `max_scales` scales. Like for the
+    segmentation, the pyramid is built in several passes when the tiles read
+    would have more than `max_tile_nb_voxels`, each pass downsampling the
+    lowest scale of the previous one, staged on the disk.
+
+    The data is read, downsampled and encoded by `workers` threads, in
+    `streaming` mode reading the chunks from the Zarr store as they are
+    encoded, `read_ahead` chunks in advance. The files are written in the
+    background by `writer_workers` threads.
+
+    With `quantize_to_uint8`, the values of the `contrast_limits` window,
+    estimated on the middle slices by `compute_data_contrast_limits` if not
+    given, are mapped to uint8, four times smaller than float32. The window
+    is recorded in the info file. The chunks are then written in the `encoding`
+    "raw", or "jpeg" at `jpeg_quality` for even smaller chunks.
+
+    Like for the segmentation, the `output_path` can be the URL of an object
+    store, s3://bucket/path or gs://bucket/path, the files are then uploaded
+    as they are written. `endpoint` selects an S3 compatible store other
+    than AWS.
+    """
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unknown encoding {encoding}, expected one of {ENCODINGS}")
+    if encoding == "jpeg" and not quantize_to_uint8:
+        raise ValueError("The jpeg encoding needs the values quantized to uint8")
+    print(f"Converting {filename} to neuroglancer precomputed image format")
+    dask_data = load_omezarr_data(filename, persist=not streaming)
+    if len(dask_data.shape) != 3:
+        raise ValueError(f"Expected 3 dimensions, got {len(dask_data.shape)}")
+    remove_ending = filename.stem.endswith(".zarr") or filename.stem.endswith("_zarr")
+    output_name = filename.stem[:-5] if remove_ending else filename.stem
+    is_conversion_output = partial(is_scale_output, data_directory=data_directory)
+    uploader = None
+    if output_path is not None and is_remote(output_path):
+        uploader = Uploader(str(output_path), endpoint=endpoint)
+        clear_remote_output(
+            uploader, delete_existing_output_directory, is_conversion_output
+        )
+        # The paths of the files are their keys, relative to the destination
+        output_directory = Path()
+    else:
+        output_directory = (
+            get_local_path(output_path)
+            if output_path
+            else filename.parent / f"precomputed-{output_name}"
+        )
+        clear_output_directory(
+            output_directory, delete_existing_output_directory, is_conversion_output
+        )
+        output_directory.mkdir(parents=True, exist_ok=True)
+    data_type = _get_data_type(dask_data.dtype)
+    if quantize_to_uint8:
+        if contrast_limits is None:
+            contrast_limits = compute_data_contrast_limits(dask_data)
+        low, high = float(contrast_limits[0]), float(contrast_limits[1])
+        contrast_limits = (low, high)
+        print(f"Quantizing the window ({low}, {high}) to uint8")
+        data_type = "uint8"
+    else:
+        contrast_limits = None
+    if isinstance(chunk_size, str):
+        chunk_size = compute_chunk_size(dask_data.shape, IMAGE_BLOCK_SIZE)
+    output_chunk_size: tuple[int, int, int] = chunk_size or dask_data.chunksize  # type: ignore
+    print(f"Writing chunks of size {output_chunk_size[::-1]} (X, Y, Z)")
+    downsampling_factors = compute_downsampling_factors(
+        dask_data.shape, output_chunk_size, max_scales
+    )
+    lower_scales = get_downsampled_scales(dask_data.shape, downsampling_factors)
+    print(f"Writing {len(lower_scales) + 1} scales")
+    # The tiles cover one chunk of the lowest scale of their pass, the upper
+    # scales are downsampled from the previous pass so they stay small
+    passes = split_downsampling_factors(
+        output_chunk_size, downsampling_factors, max_tile_nb_voxels
+    )
+    if len(passes) > 1:
+        print(f"Downsampling in {len(passes)} passes")
+    scale_directories = [
+        output_directory / get_scale_key(data_directory, scale)
+        for scale in range(len(lower_scales) + 1)
+    ]
+
+    staging = None
+    if len(passes) > 1:
+        # The lowest scale of each pass waits on the disk for the next one
+        staging = TemporaryDirectory(
+            prefix=f"{data_directory}_staging_",
+            dir=None if uploader is not None else output_directory,
+        )
+
+    chunk_writer = ChunkWriter(writer_workers, uploader=uploader)
+    nb_chunks, nb_bytes = 0, 0
+    with chunk_writer, staging or nullcontext():
+        data, first_scale = dask_data, 0
+        for i, factors in enumerate(passes):
+            lowest_scale = None
+            if i + 1 < len(passes):
+                assert staging is not None
+                lowest_scale = zarr.open_array(
+                    store=str(
+                        Path(staging.name) / f"scale_{first_scale + len(factors)}"
+                    ),
+                    mode="w",
+                    shape=lower_scales[first_scale + len(factors) - 1][0],
+                    chunks=output_chunk_size,
+                    dtype=dask_data.dtype,
+                )
+            for c in create_image(
+                data,
+                data_type,
+                workers=workers,
+                output_directories=scale_directories[first_scale:],
+                read_ahead=read_ahead if streaming else 0,
+                chunk_size=output_chunk_size,
+                downsampling_factors=factors,
+                chunk_writer=chunk_writer,
+                encoding=encoding,
+                contrast_limits=contrast_limits,
+                jpeg_quality=jpeg_quality,
+                encode_first_scale=i == 0,
+                lowest_scale_output=lowest_scale,
+            ):
+                nb_chunks += 1
+                nb_bytes += len(c.buffer)
+            if lowest_scale is not None:
+                data = da.from_zarr(lowest_scale)
+            first_scale += len(factors)
+    # Size of all the scales in the data type of the input
+    nb_input_bytes = dask_data.dtype.itemsize * sum(
+        int(np.prod(size)) for size, _ in [(dask_data.shape, None)] + lower_scales
+    )
+    print(
+        f"Wrote {nb_chunks} chunks, {nb_bytes} bytes, "
+        f"{nb_input_bytes / max(nb_bytes, 1):.1f} times smaller than the input"
+    )
+
+    metadata = _create_metadata(
+        output_chunk_size,
+        dask_data.shape,
+        data_directory,
+        resolution,
+        data_type,
+        lower_scales,
+        encoding,
+        contrast_limits,
+    )
+    if uploader is not None:
+        uploader.put("info", json.dumps(metadata, indent=4).encode())
+    else:
+        write_metadata(metadata, output_directory)
+    print(f"Wrote image to {output_path or output_directory}")
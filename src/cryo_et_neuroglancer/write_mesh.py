@@ -0,0 +1,323 @@
+import json
+from collections import defaultdict
+from dataclasses import dataclass
+from math import ceil, log2
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Iterator, Optional
+
+import dask.array as da
+import numpy as np
+from scipy.ndimage import find_objects
+from skimage.measure import marching_cubes
+
+from .chunk import get_chunk_name
+from .chunk_sharding import DEFAULT_SHARD_NB_BYTES, get_sharding_metadata
+from .chunk_writer import ChunkWriter
+from .relabel import LabelMapping, relabel
+from .sharding import ShardingSpecification, synthesize_shard_file
+from .utils import (
+    iterate_chunks,
+    process_tiles,
+)
+
+MESH_DIRECTORY = "mesh"
+LEGACY_MESH_TYPE = "neuroglancer_legacy_mesh"
+
+
+@dataclass
+class MeshFragment:
+    """The legacy precomputed mesh of a label in one tile"""
+
+    label: int
+    name: str
+    buffer: bytes
+
+
+def encode_mesh(vertices: np.ndarray, faces: np.ndarray) -> bytes:
+    """
+    Encode the mesh in the legacy precomputed format
+
+    The number of vertices as uint32, the x, y, z float32 positions of the
+    vertices, then the uint32 vertex indices of the triangles, all little endian.
+    """
+    return (
+        np.uint32(len(vertices)).astype("<u4").tobytes()
+        + np.asarray(vertices, dtype="<f4").tobytes()
+        + np.asarray(faces, dtype="<u4").tobytes()
+    )
+
+
+def decode_mesh(content: bytes) -> tuple[np.ndarray, np.ndarray]:
+    """Decode a legacy precomputed mesh into its vertices and triangles"""
+    nb_vertices = int(np.frombuffer(content[:4], dtype="<u4")[0])
+    end = 4 + nb_vertices * 3 * 4
+    vertices = np.frombuffer(content[4:end], dtype="<f4").reshape(-1, 3)
+    faces = np.frombuffer(content[end:], dtype="<u4").reshape(-1, 3)
+    return vertices, faces
+
+
+def merge_meshes(
+    meshes: list[tuple[np.ndarray, np.ndarray]],
+) -> tuple[np.ndarray, np.ndarray]:
+    """Concatenate the meshes into one, the vertices on the tile borders stay duplicated"""
+    offsets = np.cumsum([0] + [len(vertices) for vertices, _ in meshes[:-1]])
+    vertices = np.concatenate([v for v, _ in meshes]).reshape(-1, 3)
+    faces = np.concatenate([f + o for (_, f), o in zip(meshes, offsets)]).reshape(-1, 3)
+    return vertices, faces.astype(np.uint32)
+
+
+def compute_tile_meshes(
+    data: np.ndarray,
+    dimensions: tuple[tuple[int, int, int], tuple[int, int, int]],
+    volume_shape: tuple[int, ...],
+) -> Iterator[tuple[int, np.ndarray, np.ndarray]]:
+    """
+    Yield the label, vertices and triangles of the surface of each label in the tile
+
+    The tile, in z, y, x order, covers the `dimensions` of the volume plus one
+    voxel of overlap with the next tiles, so the surfaces of neighbouring
+    tiles join. On the borders of the volume, it is padded with background so
+    the surfaces are closed. The vertices are in voxels, in z, y, x order,
+    with the voxel centers on the integer positions.
+    """
+    start, end = dimensions
+    pad_before = [1 if s == 0 else 0 for s in start]
+    pad_after = [1 if e == volume else 0 for e, volume in zip(end, volume_shape)]
+    padded = np.pad(data, list(zip(pad_before, pad_after)))
+    origin = np.array(start) - np.array(pad_before)
+    labels, compact = np.unique(padded, return_inverse=True)
+    compact = compact.reshape(padded.shape)
+    # find_objects ignores 0, the first label may not be the background
+    for index, bounding_box in enumerate(find_objects(compact + 1)):
+        label = int(labels[index])
+        if label == 0 or bounding_box is None:
+            continue
+        # Keep one voxel of margin around the label so its surface is closed in the crop
+        crop = tuple(
+            slice(max(s.start - 1, 0), min(s.stop + 1, size))
+            for s, size in zip(bounding_box, padded.shape)
+        )
+        mask = compact[crop] == index
+        if mask.all():
+            # The label fills the crop, its surface is in other tiles
+            continue
+        vertices, faces, _, _ = marching_cubes(
+            mask.astype(np.float32), level=0.5, allow_degenerate=False
+        )
+        if len(faces) == 0:
+            continue
+        vertices += origin + np.array([s.start for s in crop])
+        yield label, vertices.astype(np.float32), faces.astype(np.uint32)
+
+
+def create_meshes(
+    dask_data: da.Array,
+    tile_size: tuple[int, int, int],
+    resolution: tuple[float, float, float] = (1.0, 1.0, 1.0),
+    convert_non_zero_to: Optional[int] = 0,
+    label_mapping: Optional[LabelMapping] = None,
+    workers: int = 1,
+    max_in_flight: Optional[int] = None,
+    read_ahead: int = 0,
+    output_directory: Optional[Path] = None,
+    chunk_writer: Optional[ChunkWriter] = None,
+) -> Iterator[MeshFragment]:
+    """
+    Yield the mesh fragments of the labels, tile by tile
+
+    The surfaces are extracted by marching cubes on tiles of `tile_size`, read
+    from the dask array with one voxel of overlap, by a pool of `workers`
+    threads, with at most `max_in_flight` tiles in memory. With a
+    `chunk_writer`, the fragments are queued to be written in
+    `output_directory`. The tiles are relabeled like the segmentation, see
+    `relabel`.
+
+    The vertices are in nm, in x, y, z order, placed so that the voxel i
+    spans from i to i + 1 times the resolution, as neuroglancer displays it.
+    """
+
+    def mesh(
+        data_and_dimensions: tuple[
+            np.ndarray, tuple[tuple[int, int, int], tuple[int, int, int]]
+        ],
+    ) -> list[MeshFragment]:
+        data, dimensions = data_and_dimensions
+        data = relabel(data, label_mapping, convert_non_zero_to)
+        tile_name = get_chunk_name(dimensions)
+        fragments = []
+        tile_meshes = compute_tile_meshes(data, dimensions, dask_data.shape)
+        for label, vertices, faces in tile_meshes:
+            # From voxel indices in z, y, x order to nm in x, y, z order
+            positions = (vertices[:, ::-1] + 0.5) * np.array(
+                resolution, dtype=np.float32
+            )
+            fragment = MeshFragment(
+                label, f"{label}:0:{tile_name}", encode_mesh(positions, faces)
+            )
+            if chunk_writer is not None and output_directory is not None:
+                chunk_writer.write(output_directory / fragment.name, fragment.buffer)
+            fragments.append(fragment)
+        return fragments
+
+    # The tiles are read with one voxel of overlap, for the surfaces between tiles
+    tiles = [
+        (
+            dask_data[
+                start[0] : end[0] + 1, start[1] : end[1] + 1, start[2] : end[2] + 1
+            ],
+            (start, end),
+        )
+        for _, (start, end) in iterate_chunks(dask_data, tile_size)
+    ]
+    yield from process_tiles(
+        tiles,
+        mesh,
+        workers,
+        max_in_flight,
+        read_ahead,
+        len(tiles),
+        desc="Meshing chunks",
+    )
+
+
+def compute_mesh_sharding_specification(
+    max_label: int,
+    nb_bytes: int,
+    target_shard_nb_bytes: int = DEFAULT_SHARD_NB_BYTES,
+) -> ShardingSpecification:
+    """
+    Choose the sharding of the meshes from the largest label and their total size
+
+    The meshes are keyed by their label, without hashing, so neighbouring
+    labels share a minishard and the shards hold about `target_shard_nb_bytes`
+    bytes of meshes each.
+    """
+    nb_label_bits = max(ceil(log2(max_label + 1)), 1)
+    nb_shards = max(nb_bytes / target_shard_nb_bytes, 1)
+    shard_bits = min(ceil(log2(nb_shards)), nb_label_bits)
+    minishard_bits = min(nb_label_bits - shard_bits, 3)
+    return ShardingSpecification(
+        type="neuroglancer_uint64_sharded_v1",
+        preshift_bits=0,
+        hash="identity",
+        minishard_bits=minishard_bits,
+        shard_bits=shard_bits,
+        minishard_index_encoding="gzip",
+        data_encoding="gzip",
+    )
+
+
+def _write_shards(
+    fragments_directory: Path,
+    fragment_names: dict[int, list[str]],
+    output_directory: Path,
+    specification: ShardingSpecification,
+    chunk_writer: ChunkWriter,
+) -> int:
+    """
+    Merge the fragments of each label and write them in shards, keyed by label
+
+    Only the meshes of one shard are in memory at a time.
+
+    Returns
+    -------
+    int
+        The number of shards written
+    """
+    shards: dict[str, list[int]] = defaultdict(list)
+    for label in fragment_names:
+        shards[specification.compute_shard_location(label).shard_number].append(label)
+    for shard_number, labels in shards.items():
+        meshes = {}
+        for label in labels:
+            merged = merge_meshes(
+                [
+                    decode_mesh((fragments_directory / name).read_bytes())
+                    for name in fragment_names[label]
+                ]
+            )
+            meshes[label] = encode_mesh(*merged)
+        chunk_writer.write(
+            output_directory / f"{shard_number}.shard",
+            synthesize_shard_file(specification, meshes),
+        )
+    return len(shards)
+
+
+def write_meshes(
+    dask_data: da.Array,
+    tile_size: tuple[int, int, int],
+    output_directory: Path,
+    chunk_writer: ChunkWriter,
+    resolution: tuple[float, float, float] = (1.0, 1.0, 1.0),
+    mesh_directory: str = MESH_DIRECTORY,
+    convert_non_zero_to: Optional[int] = 0,
+    label_mapping: Optional[LabelMapping] = None,
+    workers: int = 1,
+    read_ahead: int = 0,
+    sharded: bool = False,
+    target_shard_size: int = DEFAULT_SHARD_NB_BYTES,
+    staging_directory: Optional[Path] = None,
+) -> None:
+    """
+    Write the legacy precomputed meshes of the labels in `mesh_directory`
+
+    The meshes are at full resolution, with a single level of detail: the
+    legacy format has no levels of detail, and the multi-resolution format
+    needs a Draco encoder. Each label gets one fragment per tile it appears
+    in, listed in its "<label>:0" manifest.
+
+    If `sharded` is set, the fragments of each label are merged into one mesh
+    and the meshes are gathered in neuroglancer_uint64_sharded_v1 shard files
+    keyed by label. The fragments are then first written to a temporary
+    directory, in `staging_directory` if given, so the memory used stays
+    bounded by the size of a shard.
+    """
+    directory = output_directory / mesh_directory
+    fragment_names: dict[int, list[str]] = defaultdict(list)
+    nb_bytes = 0
+
+    def create_fragments(fragments_directory: Path, writer: ChunkWriter) -> None:
+        nonlocal nb_bytes
+        for fragment in create_meshes(
+            dask_data,
+            tile_size,
+            resolution,
+            convert_non_zero_to,
+            label_mapping,
+            workers=workers,
+            read_ahead=read_ahead,
+            output_directory=fragments_directory,
+            chunk_writer=writer,
+        ):
+            fragment_names[fragment.label].append(fragment.name)
+            nb_bytes += len(fragment.buffer)
+
+    if sharded:
+        with TemporaryDirectory(
+            prefix=f"{mesh_directory}_staging_", dir=staging_directory
+        ) as staging:
+            # The staged fragments are read back, so they are always written locally
+            with ChunkWriter() as staging_writer:
+                create_fragments(Path(staging), staging_writer)
+            specification = compute_mesh_sharding_specification(
+                max(fragment_names, default=0), nb_bytes, target_shard_size
+            )
+            _write_shards(
+                Path(staging), fragment_names, directory, specification, chunk_writer
+            )
+            info = {
+                "@type": LEGACY_MESH_TYPE,
+                "sharding": get_sharding_metadata(specification),
+            }
+            chunk_writer.write(directory / "info", json.dumps(info).encode())
+    else:
+        create_fragments(directory, chunk_writer)
+        for label, names in fragment_names.items():
+            chunk_writer.write(
+                directory / f"{label}:0", json.dumps({"fragments": names}).encode()
+            )
+        info = {"@type": LEGACY_MESH_TYPE}
+        chunk_writer.write(directory / "info", json.dumps(info).encode())
+    print(f"Wrote the meshes of {len(fragment_names)} labels")
@@ -1,16 +1,73 @@
+import json
 import shutil
-import sys
+from contextlib import nullcontext
+from functools import partial
 from pathlib import Path
-from typing import Any, Iterator, Optional
+from tempfile import TemporaryDirectory
+from typing import Any, Callable, Iterable, Iterator, Optional
 
 import dask.array as da
 import numpy as np
-from tqdm import tqdm
+import zarr
 
-from .chunk import Chunk
-from .io import load_omezarr_data, write_metadata
+from .chunk import GZIP_EXTENSION, Chunk, get_chunk_name
+from .chunk_sharding import (
+    DEFAULT_SHARD_NB_BYTES,
+    ShardedChunkWriter,
+    compute_sharding_specification,
+    get_sharding_metadata,
+)
+from .chunk_writer import DEFAULT_WRITER_WORKERS, ChunkWriter
+from .conversion_manifest import MANIFEST_FILENAME, ConversionManifest
+from .downsampling import (
+    compute_downsampling_factors,
+    downsample_labels,
+    get_downsampled_scales,
+)
+from .io import (
+    clear_output_directory,
+    get_scale_key,
+    is_scale_output,
+    load_omezarr_data,
+    load_omezarr_levels,
+    write_metadata,
+)
+from .label_statistics import (
+    LABEL_NAMES_FILENAME,
+    LABEL_STATISTICS_FILENAME,
+    SEGMENT_PROPERTIES_DIRECTORY,
+    LabelStatistics,
+    create_segment_properties,
+)
+from .relabel import (
+    LABEL_MAPPING_FILENAME,
+    LabelMapping,
+    compute_compact_mapping,
+    relabel,
+)
 from .segmentation_encoding import create_segmentation_chunk
-from .utils import iterate_chunks
+from .storage import Uploader, clear_remote_output, get_local_path, is_remote
+from .utils import (
+    DEFAULT_MAX_TILE_NB_VOXELS,
+    compute_chunk_size,
+    get_grid_size_from_block_shape,
+    get_tile_chunk_dimensions,
+    get_tile_size,
+    iterate_chunks,
+    process_tiles,
+    split_downsampling_factors,
+    split_into_chunks,
+)
+from .write_mesh import (
+    MESH_DIRECTORY,
+    write_meshes,
+)
+
+
+# Tells if the chunk of the given scale and dimensions was already converted
+ChunkDoneFunction = Callable[
+    [int, tuple[tuple[int, int, int], tuple[int, int, int]]], bool
+]
 
 
 def _create_metadata(
@@ -19,93 +76,666 @@ def _create_metadata(
     data_size: tuple[int, int, int],
     data_directory: str,
     resolution: tuple[float, float, float] = (1.0, 1.0, 1.0),
+    data_type: str = "uint32",
+    lower_scales: Optional[
+        list[tuple[tuple[int, int, int], tuple[int, int, int]]]
+    ] = None,
+    sharding: Optional[list[dict[str, Any]]] = None,
+    mesh_directory: Optional[str] = None,
+    segment_properties_directory: Optional[str] = None,
 ) -> dict[str, Any]:
-    """Create the metadata for the segmentation"""
-    metadata = {
+    """
+    Create the metadata for the segmentation
+
+    `lower_scales` holds the size of each downsampled scale, with its
+    downsampling factor from the full resolution, in z, y, x order.
+    `sharding` holds the sharding specification of each scale, for sharded output.
+    `mesh_directory` is the directory of the meshes, and
+    `segment_properties_directory` the one of the segment properties, if any.
+    """
+    scales = [(data_size, (1, 1, 1))] + (lower_scales or [])
+    metadata: dict[str, Any] = {
         "@type": "neuroglancer_multiscale_volume",
-        "data_type": "uint32",
+        "data_type": data_type,
         "num_channels": 1,
         "scales": [
             {
                 "chunk_sizes": [chunk_size[::-1]],
                 "encoding": "compressed_segmentation",
                 "compressed_segmentation_block_size": block_size[::-1],
-                "resolution": resolution,
-                "key": data_directory,
-                "size": data_size[
-                    ::-1
-                ],  # reverse the data size to pass from Z-Y-X to X-Y-Z
+                "resolution": tuple(
+                    r * f for r, f in zip(resolution, factor[::-1])
+                ),  # the resolution is in X-Y-Z order
+                "key": get_scale_key(data_directory, scale),
+                "size": size[::-1],  # reverse the data size to pass from Z-Y-X to X-Y-Z
             }
+            for scale, (size, factor) in enumerate(scales)
         ],
         "type": "segmentation",
     }
+    for scale_metadata, specification in zip(metadata["scales"], sharding or []):
+        scale_metadata["sharding"] = specification
+    if mesh_directory is not None:
+        metadata["mesh"] = mesh_directory
+    if segment_properties_directory is not None:
+        metadata["segment_properties"] = segment_properties_directory
     return metadata
 
 
+def _get_data_type(
+    dask_data: da.Array,
+    convert_non_zero_to: Optional[int] = 0,
+    label_mapping: Optional[LabelMapping] = None,
+) -> str:
+    """
+    Return the smallest segmentation data type, uint32 or uint64, that holds the labels
+
+    Labels stored on 32 bits or less always fit in uint32, for 64-bit labels the
+    maximum label is computed chunk by chunk, without casting the data. With a
+    `label_mapping`, the maximum is the one of the relabeled labels, read from
+    the mapping without another pass over the data if it is complete.
+    """
+    uint32_max = np.iinfo(np.uint32).max
+    if convert_non_zero_to:
+        return "uint32" if convert_non_zero_to <= uint32_max else "uint64"
+    if label_mapping is not None and len(label_mapping.target) > 0:
+        if int(label_mapping.target.max()) > uint32_max:
+            return "uint64"
+        if label_mapping.is_complete:
+            return "uint32"
+        if dask_data.dtype.itemsize > 4:
+            labels = label_mapping.apply(da.unique(dask_data).compute())
+            return "uint32" if labels.max() <= uint32_max else "uint64"
+    if dask_data.dtype.itemsize <= 4:
+        return "uint32"
+    return "uint32" if dask_data.max().compute() <= uint32_max else "uint64"
+
+
+def _get_grid_size(
+    dask_data: da.Array, chunk_size: Optional[tuple[int, int, int]] = None
+) -> tuple[int, int, int]:
+    """Return the number of output chunks along each axis"""
+    if chunk_size is None:
+        return dask_data.numblocks
+    return get_grid_size_from_block_shape(dask_data.shape, chunk_size)
+
+
+def _is_conversion_output(name: str, data_directory: str) -> bool:
+    """Return True if the file or directory name is written by the conversion"""
+    return (
+        is_scale_output(name, data_directory)
+        or name == MANIFEST_FILENAME
+        or name == MESH_DIRECTORY
+        or name.startswith(f"{MESH_DIRECTORY}_")
+        or name == LABEL_STATISTICS_FILENAME
+        or name == LABEL_MAPPING_FILENAME
+        or name == LABEL_NAMES_FILENAME
+        or name == SEGMENT_PROPERTIES_DIRECTORY
+    )
+
+
+def _get_downsampling_factor(
+    data_shape: tuple[int, ...], downsampled_shape: tuple[int, ...]
+) -> tuple[int, int, int]:
+    """Return the downsampling factor between two resolution levels"""
+    factor = [max(round(s / d), 1) for s, d in zip(data_shape, downsampled_shape)]
+    return factor[0], factor[1], factor[2]
+
+
 def create_segmentation(
     dask_data: da.Array,
     block_size: tuple[int, int, int],
     convert_non_zero_to: Optional[int] = 0,
+    data_type: str = "uint32",
+    workers: int = 1,
+    max_in_flight: Optional[int] = None,
+    output_directories: Optional[list[Path]] = None,
+    skip_empty_chunks: bool = False,
+    read_ahead: int = 0,
+    chunk_size: Optional[tuple[int, int, int]] = None,
+    downsampling_factors: Optional[list[tuple[int, int, int]]] = None,
+    chunk_writer: Optional[ChunkWriter] = None,
+    is_chunk_done: Optional[ChunkDoneFunction] = None,
+    compression_level: Optional[int] = None,
+    label_statistics: Optional[LabelStatistics] = None,
+    label_mapping: Optional[LabelMapping] = None,
+    encode_first_scale: bool = True,
+    lowest_scale_output: Optional[zarr.Array] = None,
 ) -> Iterator[Chunk]:
-    """Yield the neuroglancer segmentation format chunks"""
-    to_iterate = iterate_chunks(dask_data)
-    num_iters = np.prod(dask_data.numblocks)
-    for chunk, dimensions in tqdm(
-        to_iterate, desc="Processing chunks", total=num_iters
-    ):
-        yield create_segmentation_chunk(
-            chunk.compute(),
-            dimensions,
-            block_size,
-            convert_non_zero_to=convert_non_zero_to,
-        )
+    """
+    Yield the neuroglancer segmentation format chunks
+
+    With more than one worker, the chunks are loaded, encoded and, if
+    `output_directories` are given, written by a pool of threads. The chunks
+    are still yielded in order, with at most `max_in_flight` of them in memory.
+
+    Each tile is relabeled before being encoded, by the `label_mapping` then
+    `convert_non_zero_to`, see `relabel`.
+
+    If `read_ahead` is set, a background thread loads up to `read_ahead` chunks
+    ahead of the encoding, overlapping the reads of a lazy dask array with
+    the encoding.
+
+    The output chunks have the `chunk_size` shape, or the shape of the dask
+    chunks if not given.
+
+    With `downsampling_factors`, the lower scales of the pyramid are created
+    in the same pass. The data is read in tiles covering one chunk of the
+    lowest scale, each tile is encoded at full resolution, then downsampled
+    and encoded scale after scale. The memory used grows with the tile size.
+    The chunks of scale `n` are written in `output_directories[n]`.
+
+    With a `compression_level`, the chunks are written gzip compressed by the
+    workers, see `Chunk.write_to_directory`.
+
+    With a `chunk_writer`, the workers queue the chunk files to the writer
+    instead of writing them, see `ChunkWriter`.
+
+    To resume a conversion, the tiles whose chunks are all done according to
+    `is_chunk_done(scale, dimensions)` are skipped.
+
+    With `label_statistics`, the statistics of the labels of the full
+    resolution chunks are gathered in the same pass, see `LabelStatistics`.
+    The tiles already done are then still read for their statistics, but not
+    encoded again.
+
+    Without `encode_first_scale`, only the downsampled scales are encoded, the
+    first one being the lowest scale of a previous pass. With
+    `lowest_scale_output`, the lowest scale is also written to this Zarr
+    array, for the next pass, including for the tiles already done.
+    """
+    factors = downsampling_factors or []
+    if factors and chunk_size is None:
+        chunk_size = dask_data.chunksize  # type: ignore
+    tile_size = get_tile_size(chunk_size, factors)
+
+    def encode(
+        data_and_dimensions: tuple[np.ndarray, tuple[tuple[int, int, int], ...]],
+    ) -> list[Chunk]:
+        data, (start, _) = data_and_dimensions
+        is_done = start in done_tiles
+        data = relabel(data, label_mapping, convert_non_zero_to)
+        if label_statistics is not None:
+            for chunk, dimensions in split_into_chunks(data, start, chunk_size):
+                label_statistics.add_chunk(chunk, dimensions)
+        if is_done and lowest_scale_output is None:
+            return []
+        encoded_chunks = []
+        for scale in range(len(factors) + 1):
+            if scale > 0:
+                factor = factors[scale - 1]
+                data = downsample_labels(data, factor)
+                start = (
+                    start[0] // factor[0],
+                    start[1] // factor[1],
+                    start[2] // factor[2],
+                )
+            if is_done or (scale == 0 and not encode_first_scale):
+                continue
+            for chunk, dimensions in split_into_chunks(data, start, chunk_size):
+                encoded = create_segmentation_chunk(
+                    chunk, dimensions, block_size, data_type=data_type
+                )
+                encoded.scale = scale
+                if chunk_writer is not None and output_directories is not None:
+                    chunk_writer.write_chunk(
+                        encoded,
+                        output_directories[scale],
+                        skip_empty_chunks,
+                        compression_level,
+                    )
+                elif output_directories is not None:
+                    encoded.write_to_directory(
+                        output_directories[scale],
+                        skip_empty=skip_empty_chunks,
+                        compression_level=compression_level,
+                    )
+                encoded_chunks.append(encoded)
+        if lowest_scale_output is not None:
+            lowest_scale_output[
+                start[0] : start[0] + data.shape[0],
+                start[1] : start[1] + data.shape[1],
+                start[2] : start[2] + data.shape[2],
+            ] = data
+        return encoded_chunks
+
+    to_iterate: Iterable = iterate_chunks(dask_data, tile_size)
+    num_iters = int(np.prod(_get_grid_size(dask_data, tile_size)))
+    # Start of the tiles already converted, only read for their statistics
+    done_tiles: set[tuple[int, int, int]] = set()
+    if is_chunk_done is not None:
+        tiles = []
+        for tile, dimensions in to_iterate:
+            if all(
+                is_chunk_done(scale, chunk)
+                for scale, chunk in get_tile_chunk_dimensions(
+                    dimensions, chunk_size, factors
+                )
+                if scale > 0 or encode_first_scale
+            ):
+                done_tiles.add(dimensions[0])
+                if label_statistics is None and lowest_scale_output is None:
+                    continue
+            tiles.append((tile, dimensions))
+        if done_tiles:
+            print(f"Skipping {len(done_tiles)} tiles already converted")
+        to_iterate, num_iters = tiles, len(tiles)
+    yield from process_tiles(
+        to_iterate, encode, workers, max_in_flight, read_ahead, num_iters
+    )
 
 
 def main(
-    filename: Path,
+    filename: Optional[Path],
     block_size: tuple[int, int, int] = (64, 64, 64),
     data_directory: str = "data",
     delete_existing_output_directory: bool = False,
-    output_path: Optional[Path] = None,
+    output_path: Optional[Path | str] = None,
     resolution: tuple[float, float, float] = (1.0, 1.0, 1.0),
     convert_non_zero_to: Optional[int] = 0,
+    skip_empty_chunks: bool = False,
+    data_type: Optional[str] = None,
+    workers: int = 1,
+    streaming: bool = False,
+    read_ahead: int = 2,
+    chunk_size: Optional[tuple[int, int, int] | str] = None,
+    max_scales: int = 1,
+    max_tile_nb_voxels: int = DEFAULT_MAX_TILE_NB_VOXELS,
+    sharded: bool = False,
+    target_shard_size: int = DEFAULT_SHARD_NB_BYTES,
+    resume: bool = False,
+    compression_level: Optional[int] = None,
+    writer_workers: int = DEFAULT_WRITER_WORKERS,
+    fsync: bool = False,
+    atomic_writes: bool = False,
+    endpoint: Optional[str] = None,
+    include_mesh: bool = False,
+    collect_label_statistics: bool = False,
+    label_mapping: Optional[LabelMapping] = None,
+    compact_labels: bool = False,
+    dask_data: Optional[da.Array] = None,
+    label_names: Optional[dict[int, str]] = None,
+    name: Optional[str] = None,
 ) -> None:
-    """Convert the given OME-Zarr file to neuroglancer segmentation format with the given block size"""
-    print(f"Converting {filename} to neuroglancer compressed segmentation format")
-    dask_data = load_omezarr_data(filename)
-    remove_ending = filename.stem.endswith(".zarr") or filename.stem.endswith("_zarr")
-    output_name = filename.stem[:-5] if remove_ending else filename.stem
-    output_directory = output_path or filename.parent / f"precomputed-{output_name}"
-    if delete_existing_output_directory and output_directory.exists():
-        contents = list(output_directory.iterdir())
-        content_names = sorted([c.name for c in contents])
-        if content_names and content_names != ["data", "info"]:
-            print(
-                f"The output directory {output_directory!s} exists and contains non-conversion related files, not deleting it"
+    """Convert the given OME-Zarr file to neuroglancer segmentation format with the given block size
+
+    If `skip_empty_chunks` is set, the chunks that only contain background (0)
+    are not written. Neuroglancer considers missing chunks as filled with zeros
+    so the rendering is the same, with fewer files to write and upload.
+
+    The segmentation is written as uint32 if all the labels fit, as uint64
+    otherwise, unless `data_type` is given.
+
+    The chunks are encoded and written by `workers` threads.
+
+    In `streaming` mode, the volume is not loaded in memory first: the chunks
+    are read from the Zarr store as they are encoded, `read_ahead` chunks in
+    advance, so the memory used depends on the number of chunks in flight
+    instead of the volume size.
+
+    The output chunks have the `chunk_size` shape, in z, y, x order, whatever
+    the chunking of the input Zarr. With "auto", the chunk size is computed
+    from the volume shape, so thin tomograms get flat chunks of a reasonable
+    size. If not given, the input chunking is kept.
+
+    With `max_scales` above 1, a multiscale pyramid is written. The resolution
+    levels of the OME-Zarr are used if there are some, otherwise the lower
+    scales are downsampled from the full resolution, keeping the most frequent
+    label, in the same pass over the data. The tiles read cover one chunk of
+    the lowest scale, so when they would have more than `max_tile_nb_voxels`
+    the pyramid is built in several passes, the upper scales being
+    downsampled from the lowest scale of the previous pass, staged on the disk.
+
+    If `sharded` is set, the chunks of each scale are gathered in
+    neuroglancer_uint64_sharded_v1 shard files, keyed by the compressed Morton
+    code of the chunks. The number of shards is chosen so that the
+    uncompressed chunks of a shard weigh about `target_shard_size` bytes.
+    The encoded chunks of the shards not complete yet are staged on the disk,
+    in the output directory, so the memory used is bounded by one shard.
+
+    With `resume`, an interrupted conversion continues where it stopped. The
+    written chunks, or shards, are recorded with their size and checksum in a
+    manifest in the output directory, and are not converted again if they are
+    still intact. Files are written to a temporary name then renamed, and the
+    info file is written last, so a conversion with an info file is complete.
+
+    With a `compression_level`, from 0 to 9, the chunk files are gzip
+    compressed at this level and get a ".gz" extension. Static file servers
+    configured for pre-compressed files (nginx "gzip_static always", Caddy
+    "precompressed gzip") send them as is with "Content-Encoding: gzip" when
+    neuroglancer requests the chunk name. Shards are read with range requests
+    so cannot be compressed this way.
+
+    The files are written in the background by `writer_workers` threads. With
+    `fsync`, each file is flushed to the disk before being considered written,
+    and with `atomic_writes` it is written to a temporary name then renamed.
+    Both are slower, and only needed to survive a crash of the machine, or if
+    other processes read the output during the conversion.
+
+    The `output_path` can also be the URL of an object store, like
+    s3://bucket/path or gs://bucket/path, the files are then uploaded as they
+    are written, without a local copy. `endpoint` selects an S3 compatible
+    store other than AWS.
+
+    With `include_mesh`, the surface of each label is meshed chunk by chunk by
+    marching cubes, in a second pass over the data, and written as legacy
+    precomputed meshes, sharded if `sharded` is set, see
+    `write_mesh.write_meshes`. The meshes are regenerated when a conversion is
+    resumed.
+
+    With `collect_label_statistics`, the voxel count, bounding box and chunks
+    of each label are gathered while encoding the full resolution, and
+    written to a label_statistics.json sidecar file and as neuroglancer
+    segment properties, so they are known without reading the volume again.
+
+    The labels are relabeled chunk by chunk before being encoded: by the
+    `label_mapping` if given, then by `convert_non_zero_to`. With
+    `compact_labels`, the labels are listed in a first pass and mapped to the
+    dense range 1..n, keeping their order. The mapping used is written to a
+    label_mapping.json sidecar file.
+
+    With `dask_data`, this volume, described by `name` in the messages, is
+    converted instead of the OME-Zarr `filename`, which can then be omitted if
+    the `output_path` is given. The `label_names` are written to a
+    label_names.json table, and name the segment properties.
+    """
+    if output_path is None:
+        if filename is None:
+            raise ValueError(
+                "An output path is needed to convert data without a filename"
             )
-            sys.exit(1)
+        remove_ending = filename.stem.endswith((".zarr", "_zarr"))
+        output_name = filename.stem[:-5] if remove_ending else filename.stem
+        output_path = filename.parent / f"precomputed-{output_name}"
+    if compression_level is not None and not 0 <= compression_level <= 9:
+        raise ValueError(
+            f"The gzip compression level must be between 0 and 9, got {compression_level}"
+        )
+    if compression_level is not None and sharded:
+        raise ValueError(
+            "Sharded output cannot be gzip compressed, shards are read with range requests"
+        )
+    print(
+        f"Converting {name or filename} to neuroglancer compressed segmentation format"
+    )
+    if dask_data is not None:
+        levels = [dask_data]
+    elif filename is None:
+        raise ValueError("Either a filename or the data to convert is needed")
+    elif max_scales > 1:
+        levels = load_omezarr_levels(filename, persist=not streaming)[:max_scales]
+    else:
+        levels = [load_omezarr_data(filename, persist=not streaming)]
+    dask_data = levels[0]
+    uploader = None
+    if output_path is not None and is_remote(output_path):
+        if resume:
+            raise ValueError("Only the conversions to a local directory can be resumed")
+        uploader = Uploader(str(output_path), endpoint=endpoint)
+        clear_remote_output(
+            uploader,
+            delete_existing_output_directory,
+            partial(_is_conversion_output, data_directory=data_directory),
+        )
+        # The paths of the files are their keys, relative to the destination
+        output_directory = Path()
+    else:
+        output_directory = get_local_path(output_path)
+        if resume and (output_directory / "info").exists():
+            print(f"The conversion to {output_directory!s} is already complete")
+            return
+        if resume and output_directory.exists():
+            print(f"Resuming the conversion in {output_directory!s}")
+            # The staged chunks of the interrupted conversion are encoded again
+            for staging_path in output_directory.glob(f"{data_directory}_staging_*"):
+                shutil.rmtree(staging_path)
         else:
-            print(
-                f"The output directory {output_directory!s} exists from a previous run, deleting before starting the conversion"
+            clear_output_directory(
+                output_directory,
+                delete_existing_output_directory,
+                partial(_is_conversion_output, data_directory=data_directory),
             )
-            shutil.rmtree(output_directory)
-    elif not delete_existing_output_directory and output_directory.exists():
-        print(f"The output directory {output_directory!s} already exists")
-        sys.exit(1)
-    output_directory.mkdir(parents=True, exist_ok=True)
-    for c in create_segmentation(
-        dask_data, block_size, convert_non_zero_to=convert_non_zero_to
-    ):
-        c.write_to_directory(output_directory / data_directory)
-
+        output_directory.mkdir(parents=True, exist_ok=True)
+    if compact_labels:
+        print("Listing the labels to compact them")
+        label_mapping = compute_compact_mapping(dask_data, label_mapping)
+    data_type = data_type or _get_data_type(
+        dask_data, convert_non_zero_to, label_mapping
+    )
     if len(dask_data.chunksize) != 3:
         raise ValueError(f"Expected 3 chunk dimensions, got {len(dask_data.chunksize)}")
+    if isinstance(chunk_size, str):
+        chunk_size = compute_chunk_size(dask_data.shape, block_size)
+    output_chunk_size: tuple[int, int, int] = chunk_size or dask_data.chunksize  # type: ignore
+    print(f"Writing chunks of size {output_chunk_size[::-1]} (X, Y, Z)")
+    # The volume of each pass, None for the lowest scale of the previous pass
+    to_convert: list[
+        tuple[Optional[da.Array], int, Optional[list[tuple[int, int, int]]]]
+    ]
+    if len(levels) > 1:
+        lower_scales = [
+            (level.shape, _get_downsampling_factor(dask_data.shape, level.shape))
+            for level in levels[1:]
+        ]
+        # The resolution levels are already computed, each one is converted on its own
+        to_convert = [(level, scale, None) for scale, level in enumerate(levels)]
+    else:
+        downsampling_factors = compute_downsampling_factors(
+            dask_data.shape, output_chunk_size, max_scales
+        )
+        lower_scales = get_downsampled_scales(dask_data.shape, downsampling_factors)
+        # The tiles cover one chunk of the lowest scale of their pass, the
+        # upper scales are downsampled from the previous pass so they stay small
+        passes = split_downsampling_factors(
+            output_chunk_size, downsampling_factors, max_tile_nb_voxels
+        )
+        to_convert, first_scale = [], 0
+        for i, pass_factors in enumerate(passes):
+            to_convert.append(
+                (dask_data if i == 0 else None, first_scale, pass_factors)
+            )
+            first_scale += len(pass_factors)
+        if len(passes) > 1:
+            print(f"Downsampling in {len(passes)} passes")
+    if lower_scales:
+        print(f"Writing {len(lower_scales) + 1} scales")
+    scale_directories = [
+        output_directory / get_scale_key(data_directory, scale)
+        for scale in range(len(lower_scales) + 1)
+    ]
+    manifest = None
+    if resume:
+        parameters = {
+            "shape": [int(s) for s in dask_data.shape],
+            "block_size": [int(b) for b in block_size],
+            "chunk_size": [int(c) for c in output_chunk_size],
+            "data_directory": data_directory,
+            "convert_non_zero_to": convert_non_zero_to,
+            "skip_empty_chunks": skip_empty_chunks,
+            "data_type": data_type,
+            "nb_scales": len(scale_directories),
+            "sharded": sharded,
+            "target_shard_size": target_shard_size if sharded else None,
+            "compression_level": compression_level,
+            "label_mapping": label_mapping.get_checksum() if label_mapping else None,
+        }
+        manifest = ConversionManifest(output_directory, parameters)
+    chunk_writer = ChunkWriter(
+        writer_workers, None, fsync, atomic_writes, manifest, uploader
+    )
+    sharded_writers = []
+    staging = None
+    if sharded or len(to_convert) > 1 and len(levels) == 1:
+        # The chunks of the shards not complete yet, and the lowest scale of
+        # each pass, wait on the disk, not in memory. Named like a scale
+        # directory, so it is recognised as a conversion output if a crash
+        # leaves it behind
+        staging = TemporaryDirectory(
+            prefix=f"{data_directory}_staging_",
+            dir=None if uploader is not None else output_directory,
+        )
+    if sharded and staging is not None:
+        chunk_nb_bytes = int(np.prod(output_chunk_size)) * np.dtype(data_type).itemsize
+        for scale, (directory, size) in enumerate(
+            zip(scale_directories, [dask_data.shape] + [s for s, _ in lower_scales])
+        ):
+            grid_size = get_grid_size_from_block_shape(size, output_chunk_size)
+            specification = compute_sharding_specification(
+                grid_size, chunk_nb_bytes, target_shard_size
+            )
+            sharded_writers.append(
+                ShardedChunkWriter(
+                    directory,
+                    specification,
+                    output_chunk_size,
+                    grid_size,
+                    manifest,
+                    chunk_writer,
+                    Path(staging.name) / str(scale),
+                )
+            )
+
+    def is_chunk_done(
+        first_scale: int,
+        scale: int,
+        dimensions: tuple[tuple[int, int, int], tuple[int, int, int]],
+    ) -> bool:
+        if sharded:
+            return sharded_writers[first_scale + scale].is_chunk_done(dimensions)
+        name = get_chunk_name(dimensions)
+        if compression_level is not None:
+            name += GZIP_EXTENSION
+        path = scale_directories[first_scale + scale] / name
+        return manifest is not None and manifest.is_done(path)
+
+    label_statistics = LabelStatistics() if collect_label_statistics else None
+    nb_chunks, nb_skipped_chunks, nb_skipped_bytes = 0, 0, 0
+    nb_packed_blocks, nb_deduplicated_blocks = 0, 0
+    nb_uncompressed_bytes, nb_compressed_bytes = 0, 0
+    # The queued files are all written once the writer is closed
+    with chunk_writer, staging or nullcontext():
+        lowest_scale = None
+        for i, (data, first_scale, factors) in enumerate(to_convert):
+            is_upper_pass = data is None
+            if data is None:
+                # Already relabeled when the previous pass stored it
+                data = da.from_zarr(lowest_scale)
+            lowest_scale = None
+            if i + 1 < len(to_convert) and to_convert[i + 1][0] is None:
+                assert staging is not None and factors
+                lowest_scale = zarr.open_array(
+                    store=str(
+                        Path(staging.name) / f"scale_{first_scale + len(factors)}"
+                    ),
+                    mode="w",
+                    shape=lower_scales[first_scale + len(factors) - 1][0],
+                    chunks=output_chunk_size,
+                    dtype=data_type,
+                )
+            for c in create_segmentation(
+                data,
+                block_size,
+                convert_non_zero_to=0 if is_upper_pass else convert_non_zero_to,
+                data_type=data_type,
+                workers=workers,
+                # The shards are written once all their chunks are encoded
+                output_directories=None if sharded else scale_directories[first_scale:],
+                skip_empty_chunks=skip_empty_chunks,
+                read_ahead=read_ahead if streaming else 0,
+                chunk_size=output_chunk_size,
+                downsampling_factors=factors,
+                chunk_writer=chunk_writer,
+                is_chunk_done=partial(is_chunk_done, first_scale) if resume else None,
+                compression_level=compression_level,
+                label_statistics=label_statistics if first_scale == 0 else None,
+                label_mapping=None if is_upper_pass else label_mapping,
+                encode_first_scale=not is_upper_pass,
+                lowest_scale_output=lowest_scale,
+            ):
+                if sharded:
+                    sharded_writers[first_scale + c.scale].add(c, skip_empty_chunks)
+                nb_chunks += 1
+                nb_packed_blocks += c.nb_packed_blocks
+                nb_deduplicated_blocks += c.nb_deduplicated_blocks
+                if skip_empty_chunks and c.is_empty:
+                    nb_skipped_chunks += 1
+                    nb_skipped_bytes += len(c.buffer)
+                elif compression_level is not None:
+                    nb_uncompressed_bytes += len(c.buffer)
+                    nb_compressed_bytes += c.nb_written_bytes
+        for writer in sharded_writers:
+            writer.close()
+        if include_mesh:
+            write_meshes(
+                dask_data,
+                output_chunk_size,
+                output_directory,
+                chunk_writer,
+                resolution,
+                convert_non_zero_to=convert_non_zero_to,
+                label_mapping=label_mapping,
+                workers=workers,
+                read_ahead=read_ahead if streaming else 0,
+                sharded=sharded,
+                target_shard_size=target_shard_size,
+                # Staged next to the output, unless it is uploaded
+                staging_directory=None if uploader is not None else output_directory,
+            )
+        if label_mapping is not None:
+            chunk_writer.write(
+                output_directory / LABEL_MAPPING_FILENAME,
+                json.dumps(label_mapping.to_dict()).encode(),
+            )
+        if label_names is not None:
+            chunk_writer.write(
+                output_directory / LABEL_NAMES_FILENAME,
+                json.dumps({str(k): v for k, v in label_names.items()}).encode(),
+            )
+        if label_statistics is not None:
+            chunk_writer.write(
+                output_directory / LABEL_STATISTICS_FILENAME,
+                json.dumps(label_statistics.to_dict()).encode(),
+            )
+            segment_properties = create_segment_properties(
+                label_statistics, label_names
+            )
+            chunk_writer.write(
+                output_directory / SEGMENT_PROPERTIES_DIRECTORY / "info",
+                json.dumps(segment_properties).encode(),
+            )
+            print(f"Gathered the statistics of {len(label_statistics.labels)} labels")
+    if sharded:
+        nb_shards = sum(writer.nb_written_shards for writer in sharded_writers)
+        print(f"Wrote {nb_chunks} chunks in {nb_shards} shards")
+    if skip_empty_chunks:
+        print(
+            f"Skipped {nb_skipped_chunks} empty chunks out of {nb_chunks}, saving {nb_skipped_bytes} bytes"
+        )
+    if nb_compressed_bytes:
+        print(
+            f"Compressed the chunks from {nb_uncompressed_bytes} to {nb_compressed_bytes} bytes (ratio {nb_uncompressed_bytes / nb_compressed_bytes:.2f})"
+        )
+    if nb_packed_blocks:
+        print(
+            f"Deduplicated {nb_deduplicated_blocks} out of {nb_packed_blocks} non-uniform blocks ({nb_deduplicated_blocks / nb_packed_blocks:.1%} hit rate)"
+        )
+
     metadata = _create_metadata(
-        dask_data.chunksize,
+        output_chunk_size,
         block_size,
         dask_data.shape,
         data_directory,
         resolution,  # type: ignore
+        data_type,
+        lower_scales,
+        [get_sharding_metadata(w.specification) for w in sharded_writers] or None,
+        MESH_DIRECTORY if include_mesh else None,
+        SEGMENT_PROPERTIES_DIRECTORY if collect_label_statistics else None,
     )
-    write_metadata(metadata, output_directory)
-    print(f"Wrote segmentation to {output_directory}")
+    if uploader is not None:
+        uploader.put("info", json.dumps(metadata, indent=4).encode())
+    else:
+        write_metadata(metadata, output_directory)
+    if manifest is not None:
+        manifest.remove()
+    print(f"Wrote segmentation to {output_path or output_directory}")
@@ -0,0 +1,68 @@
+"""
+Micro-benchmarks of the bit packing kernels against shift-and-reduce packing
+
+Run from the src folder with:
+
+    python -m tests.benchmark_bit_packing
+"""
+
+import timeit
+
+import numpy as np
+
+from cryo_et_neuroglancer.segmentation_decoding import unpack_values
+from cryo_et_neuroglancer.segmentation_encoding import pack_values
+
+NB_BLOCKS = 512
+NB_VALUES = 512
+
+
+def shifted_pack_values(values: np.ndarray, bits: int) -> np.ndarray:
+    """Packing through one shifted temporary per value of a word"""
+    values_per_32bit = 32 // bits
+    nb_blocks, nb_values = values.shape
+    padded_values = np.zeros(
+        (nb_blocks, nb_values + (-nb_values % values_per_32bit)), dtype="<I"
+    )
+    padded_values[:, :nb_values] = values
+    shifts = np.arange(0, 32, bits, dtype="<I")
+    shifted_values = padded_values.reshape(nb_blocks, -1, values_per_32bit) << shifts
+    return np.bitwise_or.reduce(shifted_values, axis=2)
+
+
+def shifted_unpack_values(packed_words: np.ndarray, bits: int) -> np.ndarray:
+    """Unpacking through shifts and masks of the whole words"""
+    nb_blocks, nb_words = packed_words.shape
+    shifts = np.arange(0, 32, bits, dtype=np.uint32)
+    mask = np.uint32((1 << bits) - 1)
+    values = (packed_words[:, :, np.newaxis] >> shifts) & mask
+    return values.reshape(nb_blocks, nb_words * len(shifts))
+
+
+def mean_time(function, number: int = 20) -> float:
+    return timeit.timeit(function, number=number) / number
+
+
+def main() -> None:
+    rng = np.random.default_rng(0)
+    print(f"Packing {NB_BLOCKS} blocks of {NB_VALUES} values")
+    print(
+        f"{'bits':<6}{'shift pack (ms)':>17}{'pack (ms)':>12}{'speedup':>10}"
+        f"{'shift unpack (ms)':>19}{'unpack (ms)':>14}{'speedup':>10}"
+    )
+    for bits in (1, 2, 4, 8, 16, 32):
+        values = rng.integers(0, 2**bits, size=(NB_BLOCKS, NB_VALUES), dtype=np.uint32)
+        packed = pack_values(values, bits)
+        out = np.empty_like(packed)
+        shift_pack = mean_time(lambda: shifted_pack_values(values, bits))
+        pack = mean_time(lambda: pack_values(values, bits, out=out))
+        shift_unpack = mean_time(lambda: shifted_unpack_values(packed, bits))
+        unpack = mean_time(lambda: unpack_values(packed, bits))
+        print(
+            f"{bits:<6}{shift_pack * 1e3:>17.3f}{pack * 1e3:>12.3f}{shift_pack / pack:>9.1f}x"
+            f"{shift_unpack * 1e3:>19.3f}{unpack * 1e3:>14.3f}{shift_unpack / unpack:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Benchmarks of the segmentation decoder against the block-by-block reference
+
+Run from the src folder with:
+
+    python -m tests.benchmark_segmentation_decoding
+"""
+
+import timeit
+from typing import Callable
+
+import numpy as np
+
+from cryo_et_neuroglancer.chunk import Chunk
+from cryo_et_neuroglancer.segmentation_decoding import decode_chunk
+from cryo_et_neuroglancer.segmentation_encoding import create_segmentation_chunk
+
+from .reference_decoding import reference_decode_chunk
+
+BLOCK_SIZE = (8, 8, 8)
+
+
+def encoded_chunk(shape: tuple[int, int, int], nb_labels: int) -> Chunk:
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, nb_labels, size=shape, dtype=np.uint32)
+    return create_segmentation_chunk(data, ((0, 0, 0), shape), BLOCK_SIZE)
+
+
+def time_decoder(decoder: Callable, chunk: Chunk, number: int = 3) -> float:
+    return timeit.timeit(lambda: decoder(chunk, BLOCK_SIZE), number=number) / number
+
+
+def main() -> None:
+    chunks = {
+        "64^3, 2 labels": encoded_chunk((64, 64, 64), 2),
+        "64^3, 300 labels": encoded_chunk((64, 64, 64), 300),
+        "128^3, 4 labels": encoded_chunk((128, 128, 128), 4),
+    }
+    print(f"Decoding chunks with {BLOCK_SIZE} blocks")
+    print(f"{'chunk':<25}{'reference (ms)':>16}{'decoder (ms)':>16}{'speedup':>10}")
+    for name, chunk in chunks.items():
+        reference = time_decoder(reference_decode_chunk, chunk, number=1)
+        optimized = time_decoder(decode_chunk, chunk)
+        print(
+            f"{name:<25}{reference * 1e3:>16.2f}{optimized * 1e3:>16.2f}{reference / optimized:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
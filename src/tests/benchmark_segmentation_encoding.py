@@ -0,0 +1,116 @@
+"""
+Benchmarks of the segmentation encoder against the block-by-block reference
+
+Run from the src folder with:
+
+    python -m tests.benchmark_segmentation_encoding
+"""
+
+import timeit
+from typing import Callable
+
+import numpy as np
+
+from cryo_et_neuroglancer.segmentation_encoding import (
+    _compute_lookup_tables_by_counting,
+    _compute_lookup_tables_by_sorting,
+    _split_into_blocks,
+    create_segmentation_chunk,
+)
+
+from .reference_encoding import reference_create_segmentation_chunk
+
+CHUNK_SHAPE = (64, 64, 64)
+BLOCK_SIZE = (8, 8, 8)
+
+
+def dense_volume(nb_labels: int) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    return rng.integers(0, nb_labels, size=CHUNK_SHAPE, dtype=np.uint32)
+
+
+def instance_volume(nb_labels: int, instance_size: int = 4) -> np.ndarray:
+    """Small cubic instances with labels drawn from a large range"""
+    rng = np.random.default_rng(0)
+    grid = tuple(s // instance_size for s in CHUNK_SHAPE)
+    labels = rng.integers(0, nb_labels, size=grid, dtype=np.uint32)
+    return np.kron(labels, np.ones((instance_size,) * 3, dtype=np.uint32))
+
+
+def sparse_mask(thickness: float = 2.0) -> np.ndarray:
+    """A membrane-like spherical shell, most blocks are only background"""
+    z, y, x = np.indices(CHUNK_SHAPE)
+    center = np.array(CHUNK_SHAPE) / 2
+    radius = np.sqrt((z - center[0]) ** 2 + (y - center[1]) ** 2 + (x - center[2]) ** 2)
+    return (np.abs(radius - CHUNK_SHAPE[0] / 3) < thickness).astype(np.uint32)
+
+
+def background() -> np.ndarray:
+    return np.zeros(CHUNK_SHAPE, dtype=np.uint32)
+
+
+def time_encoder(encoder: Callable, data: np.ndarray, number: int = 5) -> float:
+    dimensions = ((0, 0, 0), data.shape)
+    return (
+        timeit.timeit(lambda: encoder(data, dimensions, BLOCK_SIZE), number=number)
+        / number
+    )
+
+
+def compare_encoders(volumes: dict[str, np.ndarray]) -> None:
+    print(f"Encoding a {CHUNK_SHAPE} chunk with {BLOCK_SIZE} blocks")
+    print(f"{'volume':<25}{'reference (ms)':>16}{'encoder (ms)':>16}{'speedup':>10}")
+    for name, data in volumes.items():
+        reference = time_encoder(reference_create_segmentation_chunk, data)
+        optimized = time_encoder(create_segmentation_chunk, data)
+        print(
+            f"{name:<25}{reference * 1e3:>16.2f}{optimized * 1e3:>16.2f}{reference / optimized:>9.1f}x"
+        )
+
+
+def compare_lookup_table_kernels(volumes: dict[str, np.ndarray]) -> None:
+    print("Computing the lookup tables of all the blocks of a chunk")
+    print(f"{'volume':<25}{'sorting (ms)':>16}{'counting (ms)':>16}{'speedup':>10}")
+    for name, data in volumes.items():
+        blocks, _ = _split_into_blocks(data, BLOCK_SIZE)
+        min_label, max_label = int(blocks.min()), int(blocks.max())
+        sorting = (
+            timeit.timeit(lambda: _compute_lookup_tables_by_sorting(blocks), number=5)
+            / 5
+        )
+        counting = (
+            timeit.timeit(
+                lambda: _compute_lookup_tables_by_counting(
+                    blocks, min_label, max_label - min_label + 1
+                ),
+                number=5,
+            )
+            / 5
+        )
+        print(
+            f"{name:<25}{sorting * 1e3:>16.2f}{counting * 1e3:>16.2f}{sorting / counting:>9.1f}x"
+        )
+
+
+def main() -> None:
+    compare_encoders(
+        {
+            "binary": dense_volume(2),
+            "small k (10 labels)": dense_volume(10),
+            "large instances": instance_volume(100_000),
+            "sparse membrane mask": sparse_mask(),
+            "background": background(),
+        }
+    )
+    print()
+    compare_lookup_table_kernels(
+        {
+            "binary": dense_volume(2),
+            "small k (10 labels)": dense_volume(10),
+            "medium k (1000 labels)": dense_volume(1000),
+        }
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Reference block-by-block implementation of the segmentation decoder
+
+This is the straightforward decoder that unpacks the values word by word and
+decodes each block one after the other. It is kept as a reference to compare
+the speed of the vectorized decoder in the benchmarks.
+"""
+
+import struct
+
+import numpy as np
+
+from cryo_et_neuroglancer.chunk import Chunk
+from cryo_et_neuroglancer.segmentation_decoding import (
+    BYTES_PER_DATA_VALUE,
+    OFFSET_BYTES,
+    _decode_block_header,
+    _decode_chunk_header,
+    _decode_lookup_table,
+    _unpad_block,
+)
+from cryo_et_neuroglancer.utils import get_grid_size_from_block_shape
+
+
+def _reference_unpack_encoded_values(
+    packed_values: bytes | bytearray, bits: int
+) -> np.ndarray:
+    values_per_word = 32 // bits
+    mask = (1 << bits) - 1
+    res: list[int] = []
+    for (intval,) in struct.iter_unpack("<I", packed_values):
+        res.extend(
+            (intval >> (shift * bits)) & mask for shift in range(values_per_word)
+        )
+    return np.array(res, dtype="I")
+
+
+def _reference_decode_block(
+    block: bytearray,
+    block_offset: int,
+    block_shape: tuple[int, int, int],
+    data_type: str = "uint32",
+) -> np.ndarray:
+    header = _decode_block_header(block, block_offset)
+    lookup_table = _decode_lookup_table(
+        block, header.lookup_table_offset, header.encoded_bits, data_type
+    )
+    if header.encoded_bits == 0:
+        return np.full(block_shape, lookup_table[0], dtype=lookup_table.dtype)
+    block_size = int(np.prod(block_shape))
+    values_per_word = 32 // header.encoded_bits
+    encoded_values_offset = header.encoded_values_offset * OFFSET_BYTES
+    encoded_values_end = encoded_values_offset + BYTES_PER_DATA_VALUE * (
+        -(-block_size // values_per_word)
+    )
+    encoded_values = _reference_unpack_encoded_values(
+        block[encoded_values_offset:encoded_values_end], header.encoded_bits
+    )
+    return lookup_table[encoded_values[:block_size]].reshape(block_shape)
+
+
+def reference_decode_chunk(
+    chunk: Chunk, block_size: tuple[int, int, int], data_type: str = "uint32"
+) -> np.ndarray:
+    chunk_shape = chunk.shape
+    all_decoded_values = np.zeros(chunk_shape, dtype=data_type)
+    gz, gy, gx = get_grid_size_from_block_shape(chunk_shape, block_size)
+    nb_channels = _decode_chunk_header(chunk.buffer)
+    chunk_array = chunk.buffer[nb_channels * BYTES_PER_DATA_VALUE :]
+    for z, y, x in np.ndindex(gz, gy, gx):
+        block_offset = 8 * (x + gx * (y + gy * z))
+        decoded_values = _reference_decode_block(
+            chunk_array, block_offset, block_size, data_type
+        )
+        decoded_values = _unpad_block(z, y, x, decoded_values, block_size, chunk_shape)
+        all_decoded_values[
+            z * block_size[0] : (z + 1) * block_size[0],
+            y * block_size[1] : (y + 1) * block_size[1],
+            x * block_size[2] : (x + 1) * block_size[2],
+        ] = decoded_values
+    return all_decoded_values
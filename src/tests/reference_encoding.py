@@ -0,0 +1,52 @@
+"""
+Reference block-by-block implementation of the segmentation encoder
+
+This is the straightforward encoder that processes each block one after the
+other. It is kept as a reference to check that the optimized encoder produces
+the same bytes, and to compare their speed in the benchmarks.
+"""
+
+import numpy as np
+
+from cryo_et_neuroglancer.chunk import Chunk
+from cryo_et_neuroglancer.segmentation_encoding import (
+    _create_block_header,
+    _create_encoded_values,
+    _create_file_chunk_header,
+    _create_lookup_table,
+)
+from cryo_et_neuroglancer.utils import get_grid_size_from_block_shape, pad_block
+
+
+def reference_create_segmentation_chunk(
+    data: np.ndarray,
+    dimensions: tuple[tuple[int, int, int], tuple[int, int, int]],
+    block_size: tuple[int, int, int] = (8, 8, 8),
+    data_type: str = "uint32",
+) -> Chunk:
+    bz, by, bx = block_size
+    gz, gy, gx = get_grid_size_from_block_shape(data.shape, block_size)  # type: ignore
+    stored_lookup_tables: dict[bytes, tuple[int, int]] = {}
+    buffer = bytearray(gx * gy * gz * 8)
+    for z, y, x in np.ndindex((gz, gy, gx)):
+        block = data[
+            z * bz : (z + 1) * bz, y * by : (y + 1) * by, x * bx : (x + 1) * bx
+        ]
+        if block.shape != block_size:
+            block = pad_block(block, block_size)
+        unique_values, encoded_values = np.unique(block.ravel(), return_inverse=True)
+        lookup_table_offset, encoded_bits = _create_lookup_table(
+            buffer, stored_lookup_tables, unique_values, data_type
+        )
+        encoded_values_offset = _create_encoded_values(
+            buffer, encoded_values, encoded_bits
+        )
+        block_offset = 8 * (x + gx * (y + gy * z))
+        _create_block_header(
+            buffer,
+            lookup_table_offset,
+            encoded_bits,
+            encoded_values_offset,
+            block_offset,
+        )
+    return Chunk(_create_file_chunk_header() + buffer, dimensions)
@@ -0,0 +1,44 @@
+import gzip
+
+import numpy as np
+
+from cryo_et_neuroglancer.chunk import Chunk
+from cryo_et_neuroglancer.segmentation_encoding import create_segmentation_chunk
+
+
+def test__get_name():
+    chunk = Chunk(bytearray(), ((0, 64, 128), (32, 128, 192)))
+    assert chunk.get_name() == "128-192_64-128_0-32"
+
+
+def test__write_to_directory(tmp_path):
+    chunk = Chunk(bytearray(b"data"), ((0, 0, 0), (8, 8, 8)))
+
+    assert chunk.write_to_directory(tmp_path / "data")
+    assert (tmp_path / "data" / "0-8_0-8_0-8").read_bytes() == b"data"
+
+
+def test__write_to_directory__gzip(tmp_path):
+    chunk = Chunk(bytearray(b"data" * 100), ((0, 0, 0), (8, 8, 8)))
+
+    assert chunk.write_to_directory(tmp_path, compression_level=6)
+    assert not (tmp_path / "0-8_0-8_0-8").exists()
+    content = (tmp_path / "0-8_0-8_0-8.gz").read_bytes()
+    assert gzip.decompress(content) == b"data" * 100
+    assert chunk.nb_written_bytes == len(content) < 400
+
+
+def test__write_to_directory__skip_empty(tmp_path):
+    dimensions = ((0, 0, 0), (16, 16, 16))
+    empty_chunk = create_segmentation_chunk(np.zeros((16, 16, 16)), dimensions)
+    data = np.zeros((16, 16, 16))
+    data[4, 4, 4] = 1
+    chunk = create_segmentation_chunk(data, dimensions)
+
+    assert empty_chunk.is_empty
+    assert not chunk.is_empty
+    assert not empty_chunk.write_to_directory(tmp_path, skip_empty=True)
+    assert not (tmp_path / empty_chunk.get_name()).exists()
+    assert empty_chunk.write_to_directory(tmp_path, skip_empty=False)
+    assert (tmp_path / empty_chunk.get_name()).exists()
+    assert chunk.write_to_directory(tmp_path / "other", skip_empty=True)
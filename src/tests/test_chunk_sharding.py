@@ -0,0 +1,106 @@
+import gzip
+
+import numpy as np
+import pytest
+
+from cryo_et_neuroglancer.chunk import Chunk
+from cryo_et_neuroglancer.chunk_sharding import (
+    ShardedChunkWriter,
+    compressed_morton_code,
+    compute_sharding_specification,
+)
+
+
+def read_sharded_chunk(directory, specification, key):
+    """Minimal reader of a chunk in a neuroglancer_uint64_sharded_v1 shard"""
+    location = specification.compute_shard_location(key)
+    path = directory / f"{location.shard_number}.shard"
+    if not path.exists():
+        return None
+    content = path.read_bytes()
+    index_length = specification.index_length()
+    fixed_index = np.frombuffer(content[:index_length], dtype="<u8").reshape(-1, 2)
+    start, end = fixed_index[location.minishard_number]
+    minishard_index = gzip.decompress(
+        content[index_length + start : index_length + end]
+    )
+    key_deltas, offset_deltas, sizes = np.frombuffer(
+        minishard_index, dtype="<u8"
+    ).reshape(3, -1)
+    chunk_key, offset = 0, 0
+    for key_delta, offset_delta, size in zip(key_deltas, offset_deltas, sizes):
+        chunk_key += int(key_delta)
+        offset += int(offset_delta)
+        if chunk_key == key:
+            return content[index_length + offset : index_length + offset + int(size)]
+        offset += int(size)
+    return None
+
+
+@pytest.mark.parametrize(
+    "position, grid_size, expected",
+    [
+        ((0, 0, 1), (4, 4, 4), 1),
+        ((0, 1, 0), (4, 4, 4), 2),
+        ((1, 0, 0), (4, 4, 4), 4),
+        ((1, 1, 1), (4, 4, 4), 7),
+        ((0, 0, 2), (4, 4, 4), 8),
+        ((0, 1, 5), (1, 2, 8), 0b1011),
+    ],
+)
+def test_compressed_morton_code(position, grid_size, expected):
+    assert compressed_morton_code(np.array([position]), grid_size)[0] == expected
+
+
+def test_compute_sharding_specification():
+    specification = compute_sharding_specification((8, 8, 8), 2**20, 64 * 2**20)
+
+    assert specification.preshift_bits == 3
+    assert specification.minishard_bits == 3
+    assert specification.shard_bits == 3
+
+
+def test_compute_sharding_specification__single_shard():
+    specification = compute_sharding_specification((2, 3, 1), 2**20, 64 * 2**20)
+
+    assert specification.preshift_bits == 3
+    assert specification.minishard_bits == 0
+    assert specification.shard_bits == 0
+
+
+@pytest.mark.parametrize("staged", [False, True])
+def test_sharded_chunk_writer(tmp_path, staged):
+    grid_size, chunk_size = (3, 4, 2), (8, 8, 8)
+    specification = compute_sharding_specification(grid_size, 1, 4)
+    staging = tmp_path.parent / f"{tmp_path.name}_staging" if staged else None
+    writer = ShardedChunkWriter(
+        tmp_path, specification, chunk_size, grid_size, staging_directory=staging
+    )
+    chunks = {}
+    for position in np.ndindex(grid_size):
+        start = tuple(p * c for p, c in zip(position, chunk_size))
+        end = tuple(s + c for s, c in zip(start, chunk_size))
+        chunk = Chunk(bytearray(str(position).encode()), (start, end))
+        chunk.is_empty = position == (0, 0, 0)
+        writer.add(chunk, skip_empty=True)
+        key = int(compressed_morton_code(np.array([position]), grid_size)[0])
+        chunks[key] = None if chunk.is_empty else bytes(chunk.buffer)
+        if staged:
+            # The chunks of the incomplete shards are not kept in memory
+            assert not writer.shards
+    writer.close()
+
+    assert writer.nb_written_shards == len(list(tmp_path.iterdir())) > 1
+    for key, expected in chunks.items():
+        assert read_sharded_chunk(tmp_path, specification, key) == expected
+    if staged:
+        assert list(staging.iterdir()) == []
+
+
+def test_sharded_chunk_writer__missing_chunks(tmp_path):
+    specification = compute_sharding_specification((1, 1, 2), 1, 1)
+    writer = ShardedChunkWriter(tmp_path, specification, (8, 8, 8), (1, 1, 2))
+    writer.add(Chunk(bytearray(b"data"), ((0, 0, 0), (8, 8, 8))))
+
+    with pytest.raises(ValueError):
+        writer.close()
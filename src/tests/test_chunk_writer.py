@@ -0,0 +1,51 @@
+import pytest
+
+from cryo_et_neuroglancer.chunk import Chunk
+from cryo_et_neuroglancer.chunk_writer import ChunkWriter
+from cryo_et_neuroglancer.conversion_manifest import (
+    MANIFEST_FILENAME,
+    ConversionManifest,
+)
+
+
+@pytest.mark.parametrize("fsync", [False, True])
+@pytest.mark.parametrize("atomic", [False, True])
+def test_chunk_writer(tmp_path, fsync, atomic):
+    chunks = [
+        Chunk(bytearray([i] * 10), ((i * 8, 0, 0), ((i + 1) * 8, 8, 8)))
+        for i in range(20)
+    ]
+
+    with ChunkWriter(workers=3, max_queued=2, fsync=fsync, atomic=atomic) as writer:
+        for chunk in chunks:
+            assert writer.write_chunk(chunk, tmp_path / "data")
+
+    for chunk in chunks:
+        assert (tmp_path / "data" / chunk.get_name()).read_bytes() == chunk.buffer
+    assert len(list((tmp_path / "data").iterdir())) == len(chunks)
+
+
+def test_chunk_writer__manifest(tmp_path):
+    manifest = ConversionManifest(tmp_path, {})
+    empty = Chunk(bytearray(b"0000"), ((0, 0, 0), (8, 8, 8)), is_empty=True)
+    full = Chunk(bytearray(b"1111"), ((8, 0, 0), (16, 8, 8)))
+
+    with ChunkWriter(manifest=manifest) as writer:
+        assert not writer.write_chunk(empty, tmp_path / "data", skip_empty=True)
+        assert writer.write_chunk(full, tmp_path / "data", skip_empty=True)
+
+    assert sorted(p.name for p in (tmp_path / "data").iterdir()) == [full.get_name()]
+    reloaded = ConversionManifest(tmp_path, {})
+    assert reloaded.is_done(tmp_path / "data" / empty.get_name())
+    assert reloaded.is_done(tmp_path / "data" / full.get_name())
+    assert (tmp_path / MANIFEST_FILENAME).exists()
+
+
+def test_chunk_writer__error(tmp_path):
+    (tmp_path / "file").write_bytes(b"")
+    writer = ChunkWriter(workers=2)
+    # The parent of the chunk is a file, the directory can not be created
+    writer.write(tmp_path / "file" / "chunk", b"data")
+
+    with pytest.raises(OSError):
+        writer.close()
@@ -0,0 +1,47 @@
+import pytest
+
+from cryo_et_neuroglancer.conversion_manifest import (
+    MANIFEST_FILENAME,
+    ConversionManifest,
+)
+
+
+def test_manifest__write_and_reload(tmp_path):
+    manifest = ConversionManifest(tmp_path, {"block_size": (8, 8, 8)})
+    manifest.write(tmp_path / "a", b"content")
+    manifest.record_empty(tmp_path / "b")
+
+    reloaded = ConversionManifest(tmp_path, {"block_size": (8, 8, 8)})
+    assert reloaded.is_done(tmp_path / "a")
+    assert reloaded.is_done(tmp_path / "b")
+    assert not reloaded.is_done(tmp_path / "c")
+    assert not list(tmp_path.glob(".*.tmp"))
+
+
+def test_manifest__corrupted_file(tmp_path):
+    manifest = ConversionManifest(tmp_path, {})
+    manifest.write(tmp_path / "a", b"content")
+    manifest.write(tmp_path / "b", b"content")
+    (tmp_path / "a").write_bytes(b"CONTENT")
+    (tmp_path / "b").unlink()
+
+    reloaded = ConversionManifest(tmp_path, {})
+    assert not reloaded.is_done(tmp_path / "a")
+    assert not reloaded.is_done(tmp_path / "b")
+
+
+def test_manifest__incomplete_last_line(tmp_path):
+    manifest = ConversionManifest(tmp_path, {})
+    manifest.write(tmp_path / "a", b"content")
+    with (tmp_path / MANIFEST_FILENAME).open("a") as f:
+        f.write('{"path": "b", "si')
+
+    reloaded = ConversionManifest(tmp_path, {})
+    assert reloaded.is_done(tmp_path / "a")
+    assert not reloaded.is_done(tmp_path / "b")
+
+
+def test_manifest__different_parameters(tmp_path):
+    ConversionManifest(tmp_path, {"block_size": (8, 8, 8)})
+    with pytest.raises(ValueError):
+        ConversionManifest(tmp_path, {"block_size": (16, 16, 16)})
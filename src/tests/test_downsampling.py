@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+from cryo_et_neuroglancer.downsampling import (
+    compute_downsampling_factors,
+    downsample_average,
+    downsample_labels,
+    get_downsampled_scales,
+)
+
+
+def test__downsample_labels():
+    data = np.zeros((2, 4, 4), dtype=np.uint32)
+    data[:, :2, :2] = 3
+    data[0, :2, 2:] = 5
+    data[1, 0, 2] = 7
+    data[0, 2:, :2] = [[1, 2], [1, 2]]
+    data[1, 2:, :2] = [[2, 1], [2, 1]]
+
+    result = downsample_labels(data, (2, 2, 2))
+
+    assert result.dtype == np.uint32
+    assert np.array_equal(result, [[[3, 5], [1, 0]]])
+
+
+def test__downsample_labels__partial_windows():
+    data = np.arange(3 * 3 * 3, dtype=np.uint64).reshape(3, 3, 3)
+
+    result = downsample_labels(data, (2, 2, 1))
+
+    assert result.shape == (2, 2, 3)
+    assert np.array_equal(result[1, 1], data[2, 2])
+
+
+def test__downsample_labels__no_new_labels():
+    rng = np.random.default_rng(0)
+    data = rng.choice([0, 10, 1000], size=(16, 16, 16)).astype(np.uint32)
+
+    result = downsample_labels(data, (2, 2, 2))
+
+    assert set(np.unique(result)) <= {0, 10, 1000}
+
+
+@pytest.mark.parametrize(
+    "data_shape, max_scales, expected",
+    [
+        ((256, 256, 256), 1, []),
+        ((256, 256, 256), 3, [(2, 2, 2), (2, 2, 2)]),
+        ((256, 256, 256), 10, [(2, 2, 2), (2, 2, 2)]),
+        ((40, 256, 128), 10, [(1, 2, 2), (1, 2, 1)]),
+    ],
+)
+def test__compute_downsampling_factors(data_shape, max_scales, expected):
+    assert (
+        compute_downsampling_factors(data_shape, (64, 64, 64), max_scales) == expected
+    )
+
+
+def test__get_downsampled_scales():
+    scales = get_downsampled_scales((40, 255, 128), [(1, 2, 2), (1, 2, 1)])
+
+    assert scales == [((40, 128, 64), (1, 2, 2)), ((40, 64, 64), (1, 4, 2))]
+
+
+def test__downsample_average():
+    data = np.arange(2 * 4 * 4, dtype=np.float32).reshape(2, 4, 4)
+
+    result = downsample_average(data, (2, 2, 2))
+
+    assert result.dtype == np.float32
+    assert result.shape == (1, 2, 2)
+    assert result[0, 0, 0] == np.mean(data[:, :2, :2])
+    assert result[0, 1, 1] == np.mean(data[:, 2:, 2:])
+
+
+def test__downsample_average__integers_and_partial_windows():
+    data = np.array([[[0, 1, 7]]], dtype=np.uint8)
+
+    result = downsample_average(data, (1, 1, 2))
+
+    assert result.dtype == np.uint8
+    assert np.array_equal(result, [[[0, 7]]])
@@ -0,0 +1,60 @@
+import numpy as np
+
+from cryo_et_neuroglancer.label_statistics import (
+    LabelStatistics,
+    create_segment_properties,
+)
+from cryo_et_neuroglancer.utils import split_into_chunks
+
+
+def test_label_statistics():
+    data = np.zeros((8, 12, 16), dtype=np.uint32)
+    data[1:3, 2:10, 3:5] = 4
+    data[5:8, 0:2, 10:16] = 9
+    statistics = LabelStatistics()
+
+    for chunk, dimensions in split_into_chunks(data, (0, 0, 0), (4, 6, 8)):
+        statistics.add_chunk(chunk, dimensions)
+
+    assert statistics.labels == [4, 9]
+    assert statistics.voxel_counts == {4: 2 * 8 * 2, 9: 3 * 2 * 6}
+    assert statistics.bounding_boxes[4] == ([1, 2, 3], [3, 10, 5])
+    assert statistics.bounding_boxes[9] == ([5, 0, 10], [8, 2, 16])
+    content = statistics.to_dict()["labels"]
+    assert content["4"]["bounding_box"] == {"start": [3, 2, 1], "end": [5, 10, 3]}
+    assert content["4"]["chunks"] == ["0-8_0-6_0-4", "0-8_6-12_0-4"]
+    assert content["9"]["chunks"] == ["8-16_0-6_4-8"]
+
+
+def test_label_statistics__no_background():
+    statistics = LabelStatistics()
+
+    statistics.add_chunk(np.full((2, 2, 2), 3), ((4, 0, 0), (6, 2, 2)))
+
+    assert statistics.voxel_counts == {3: 8}
+    assert statistics.bounding_boxes[3] == ([4, 0, 0], [6, 2, 2])
+
+
+def test_label_statistics__negative_labels():
+    statistics = LabelStatistics()
+    data = np.array([[[-5, 0, 0, 2]]], dtype=np.int16)
+
+    statistics.add_chunk(data, ((0, 0, 0), (1, 1, 4)))
+
+    assert statistics.voxel_counts == {-5: 1, 2: 1}
+    assert statistics.bounding_boxes[-5] == ([0, 0, 0], [1, 1, 1])
+    assert statistics.bounding_boxes[2] == ([0, 0, 3], [1, 1, 4])
+
+
+def test_create_segment_properties():
+    statistics = LabelStatistics()
+    statistics.add_chunk(np.array([[[0, 1, 2, 2]]]), ((0, 0, 0), (1, 1, 4)))
+
+    properties = create_segment_properties(statistics, {2: "membrane"})
+
+    assert properties["@type"] == "neuroglancer_segment_properties"
+    inline = properties["inline"]
+    assert inline["ids"] == ["1", "2"]
+    assert inline["properties"][0]["values"] == ["1", "membrane"]
+    assert inline["properties"][1]["values"] == [1, 2]
+    assert inline["properties"][1]["data_type"] == "uint32"
@@ -0,0 +1,109 @@
+import json
+from pathlib import Path
+
+import dask.array as da
+import numpy as np
+import pytest
+import zarr
+from ome_zarr.io import parse_url
+from ome_zarr.writer import write_image
+
+from cryo_et_neuroglancer.chunk import Chunk
+from cryo_et_neuroglancer.merge_masks import (
+    get_label_names,
+    get_mask_name,
+    main,
+    merge_mask_chunks,
+    merge_masks,
+)
+from cryo_et_neuroglancer.segmentation_decoding import decode_chunk
+
+
+def _create_masks():
+    first = np.zeros((16, 24, 32), dtype=np.uint8)
+    first[2:10, 4:20, 4:12] = 1
+    second = np.zeros((16, 24, 32), dtype=np.uint8)
+    second[6:16, 10:24, 8:30] = 1
+    return first, second
+
+
+@pytest.mark.parametrize("rule, overlap_label", [("priority", 1), ("overlap", 3)])
+def test_merge_mask_chunks(rule, overlap_label):
+    first, second = _create_masks()
+
+    labels = merge_mask_chunks(first, second, rule=rule)
+
+    assert labels.dtype == np.uint32
+    assert set(np.unique(labels).tolist()) == {0, 1, 2, overlap_label}
+    assert labels[0, 0, 0] == 0
+    assert labels[3, 5, 5] == 1
+    assert labels[12, 20, 20] == 2
+    assert labels[7, 15, 10] == overlap_label
+
+
+def test_merge_mask_chunks__many_masks():
+    masks = [np.zeros((2, 2, 2), dtype=np.uint8) for _ in range(256)]
+    masks[0][0, 0, 0] = 1
+    masks[-1][0, 0, 0] = 1
+    for mask in masks:
+        mask[1, 1, 1] = 1
+
+    labels = merge_mask_chunks(*masks, rule="overlap")
+
+    assert labels[0, 0, 0] == 257
+    assert labels[1, 1, 1] == 257
+    assert labels[0, 1, 0] == 0
+
+
+def test_merge_masks():
+    first, second = _create_masks()
+
+    merged = merge_masks(
+        [da.from_array(first, chunks=(8, 8, 8)), da.from_array(second, chunks=16)],
+        "overlap",
+    )
+
+    assert np.array_equal(
+        merged.compute(), merge_mask_chunks(first, second, rule="overlap")
+    )
+    with pytest.raises(ValueError):
+        merge_masks([da.from_array(first), da.from_array(second[:8])])
+
+
+def test_get_label_names():
+    assert get_mask_name(Path("membrane.zarr")) == "membrane"
+    assert get_label_names(["a", "b"]) == {1: "a", 2: "b"}
+    assert get_label_names(["a", "b"], "overlap") == {1: "a", 2: "b", 3: "overlap"}
+
+
+def test_main(tmp_path, capsys):
+    masks = _create_masks()
+    paths = []
+    for name, mask in zip(["membrane.zarr", "ribosome.zarr"], masks):
+        paths.append(tmp_path / name)
+        root = zarr.group(store=parse_url(paths[-1], mode="w").store)
+        write_image(mask, root, axes="zyx", storage_options=dict(chunks=(8, 8, 8)))
+    output_path = tmp_path / "output"
+
+    main(paths, output_path, rule="overlap", block_size=(8, 8, 8), workers=2)
+
+    assert "Converting the 2 merged masks to" in capsys.readouterr().out
+    names = json.loads((output_path / "label_names.json").read_text())
+    assert names == {"1": "membrane", "2": "ribosome", "3": "overlap"}
+    properties = json.loads((output_path / "segment_properties" / "info").read_text())
+    assert properties["inline"]["ids"] == ["1", "2", "3"]
+    assert properties["inline"]["properties"][0]["values"] == [
+        "membrane",
+        "ribosome",
+        "overlap",
+    ]
+    expected = merge_mask_chunks(*masks, rule="overlap")
+    for path in (output_path / "data").iterdir():
+        (x0, x1), (y0, y1), (z0, z1) = [
+            map(int, r.split("-")) for r in path.name.split("_")
+        ]
+        chunk = Chunk(bytearray(path.read_bytes()), ((z0, y0, x0), (z1, y1, x1)))
+        decoded = decode_chunk(chunk, (8, 8, 8))
+        assert np.array_equal(decoded, expected[z0:z1, y0:y1, x0:x1])
+    with pytest.raises(ValueError):
+        main(paths, output_path, names=["membrane"])
@@ -0,0 +1,79 @@
+import json
+
+import dask.array as da
+import numpy as np
+import pytest
+
+from cryo_et_neuroglancer.relabel import (
+    LabelMapping,
+    compute_compact_mapping,
+    relabel,
+)
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.int32, np.int64, np.uint64])
+def test_label_mapping__apply(dtype):
+    mapping = LabelMapping.from_dict({5: 1, 7: 0, 2**40: 2})
+    data = np.array([[[0, 5, 7, 9, 5]]], dtype=dtype)
+
+    relabeled = mapping.apply(data)
+
+    assert relabeled.tolist() == [[[0, 1, 0, 9, 1]]]
+    assert relabeled.dtype == dtype
+    # The data is not modified
+    assert data.tolist() == [[[0, 5, 7, 9, 5]]]
+
+
+def test_label_mapping__uint64():
+    mapping = LabelMapping.from_dict({2**63 + 1: 3})
+
+    relabeled = mapping.apply(np.array([2**63 + 1, 2**63, 1], dtype=np.uint64))
+
+    assert relabeled.tolist() == [3, 2**63, 1]
+
+
+def test_label_mapping__duplicated_label():
+    with pytest.raises(ValueError):
+        LabelMapping(np.array([1, 2, 1]), np.array([1, 2, 3]))
+
+
+@pytest.mark.parametrize("suffix", [".json", ".csv"])
+def test_label_mapping__from_file(tmp_path, suffix):
+    path = tmp_path / f"mapping{suffix}"
+    if suffix == ".json":
+        path.write_text(json.dumps({"12": 1, "4": 2}))
+    else:
+        path.write_text("12,1\n4,2\n")
+
+    mapping = LabelMapping.from_file(path)
+
+    assert mapping.to_dict() == {"4": 2, "12": 1}
+
+
+def test_label_mapping__apply_float():
+    data = np.array([0.0, 4.0, 12.0, 5.0], dtype=np.float32)
+
+    relabeled = LabelMapping.from_dict({12: 1, 4: 2}).apply(data)
+
+    assert relabeled.tolist() == [0, 2, 1, 5]
+
+
+def test_relabel__convert_non_zero_to():
+    data = np.array([-1, 0, 3], dtype=np.int8)
+
+    relabeled = relabel(data, LabelMapping.from_dict({3: 0}), 300)
+    assert relabeled.tolist() == [0, 0, 0]
+    relabeled = relabel(data, None, 300)
+    assert relabeled.tolist() == [0, 0, 300]
+    assert data.tolist() == [-1, 0, 3]
+
+
+def test_compute_compact_mapping():
+    data = np.array([0, 2**40, 100, 7, 100, 9], dtype=np.uint64)
+
+    mapping = compute_compact_mapping(
+        da.from_array(data, chunks=2), LabelMapping.from_dict({9: 0})
+    )
+
+    assert mapping.apply(data).tolist() == [0, 3, 2, 1, 2, 0]
+    assert mapping.is_complete
@@ -12,6 +12,8 @@ from cryo_et_neuroglancer.segmentation_decoding import (
     _extract_encoded_values,
     _unpack_encoded_values,
     decode_chunk,
+    decode_region,
+    unpack_values,
 )
 from cryo_et_neuroglancer.segmentation_encoding import (
     _create_block_header,
@@ -19,8 +21,11 @@ from cryo_et_neuroglancer.segmentation_encoding import (
     _create_file_chunk_header,
     _create_lookup_table,
     create_segmentation_chunk,
+    pack_values,
 )
 
+from .reference_decoding import reference_decode_chunk
+
 
 @pytest.mark.parametrize(
     "packed_values, nb_bits, nb_values, expected",
@@ -38,6 +43,22 @@ def test__unpack_encoded_values(packed_values, nb_bits, nb_values, expected):
         assert value == expected_value
 
 
+@pytest.mark.parametrize("nb_bits", [1, 2, 4, 8, 16, 32])
+def test_unpack_values(nb_bits):
+    rng = np.random.default_rng(0)
+    values = rng.integers(0, 2**nb_bits, size=(3, 64), dtype=np.uint64)
+
+    result = unpack_values(pack_values(values, nb_bits), nb_bits)
+
+    assert result.dtype.itemsize == max(nb_bits // 8, 1)
+    assert np.array_equal(result, values)
+
+
+def test_unpack_values__unknown_bits():
+    with pytest.raises(ValueError):
+        unpack_values(np.zeros((1, 1), dtype="<I"), 0)
+
+
 def test__decode_block_header():
     offset = 0
     buffer = bytearray(64 // 8)
@@ -229,3 +250,82 @@ def test__decode_chunk():
     assert np.all(result[0, 0] == np.array([0, 5, 5, 0]))
     assert np.all(result[0, 3] == np.array([5, 5, 5, 5]))
     assert np.all(result[1, 1] == np.array([5, 5, 5, 5]))
+
+
+@pytest.mark.parametrize("shape", [(16, 16, 16), (13, 10, 7)])
+def test__decode_chunk__uint64(shape):
+    rng = np.random.default_rng(0)
+    array = rng.integers(0, 2**64 - 1, size=shape, dtype=np.uint64)
+    array[: shape[0] // 2] = 2**63 + 5
+    dimensions = ((0, 0, 0), shape)
+
+    chunk = create_segmentation_chunk(
+        array, dimensions, block_size=(8, 8, 8), data_type="uint64"
+    )
+    result = decode_chunk(chunk, block_size=(8, 8, 8), data_type="uint64")
+
+    assert result.dtype == np.uint64
+    assert np.array_equal(result, array)
+
+
+@pytest.mark.parametrize(
+    "shape, block_size, nb_labels",
+    [
+        ((16, 16, 16), (8, 8, 8), 1),
+        ((16, 16, 16), (8, 8, 8), 3),
+        ((16, 16, 16), (8, 8, 8), 300),
+        ((16, 16, 16), (8, 8, 8), 70000),
+        ((13, 10, 7), (8, 8, 8), 20),
+        ((16, 32, 8), (4, 8, 2), 5),
+    ],
+)
+def test__decode_chunk__same_as_reference(shape, block_size, nb_labels):
+    rng = np.random.default_rng(0)
+    array = rng.integers(0, nb_labels, size=shape, dtype=np.uint32)
+    array[: shape[0] // 2] = 4
+
+    chunk = create_segmentation_chunk(array, ((0, 0, 0), shape), block_size)
+    result = decode_chunk(chunk, block_size)
+
+    assert np.array_equal(result, array)
+    assert np.array_equal(result, reference_decode_chunk(chunk, block_size))
+
+
+@pytest.mark.parametrize(
+    "bbox",
+    [
+        ((100, 200, 300), (113, 210, 307)),  # whole chunk
+        ((100, 200, 300), (101, 201, 301)),  # single voxel
+        ((103, 201, 302), (111, 209, 306)),  # crosses blocks
+        ((109, 208, 304), (113, 210, 307)),  # partial edge blocks
+    ],
+)
+def test__decode_region(bbox):
+    rng = np.random.default_rng(0)
+    shape = (13, 10, 7)
+    array = rng.integers(0, 10, size=shape, dtype=np.uint32)
+    dimensions = ((100, 200, 300), (113, 210, 307))
+    chunk = create_segmentation_chunk(array, dimensions, block_size=(4, 4, 4))
+
+    result = decode_region(chunk, (4, 4, 4), bbox)
+
+    start = np.subtract(bbox[0], dimensions[0])
+    end = np.subtract(bbox[1], dimensions[0])
+    assert np.array_equal(
+        result, array[start[0] : end[0], start[1] : end[1], start[2] : end[2]]
+    )
+
+
+@pytest.mark.parametrize(
+    "bbox",
+    [
+        ((0, 0, 0), (9, 8, 8)),
+        ((2, 2, 2), (2, 4, 4)),
+    ],
+)
+def test__decode_region__outside_chunk(bbox):
+    array = np.ones((8, 8, 8), dtype=np.uint32)
+    chunk = create_segmentation_chunk(array, ((0, 0, 0), (8, 8, 8)))
+
+    with pytest.raises(ValueError):
+        decode_region(chunk, (8, 8, 8), bbox)
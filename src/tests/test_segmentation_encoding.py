@@ -5,16 +5,28 @@ import numpy as np
 import pytest
 
 from cryo_et_neuroglancer.chunk import Chunk
+from cryo_et_neuroglancer.segmentation_decoding import decode_chunk
 from cryo_et_neuroglancer.segmentation_encoding import (
+    _allocate_chunk_buffer,
+    _compute_lookup_tables,
+    _compute_lookup_tables_by_counting,
+    _compute_lookup_tables_by_sorting,
+    _compute_lookup_tables_skipping_uniform_blocks,
+    _create_background_chunk,
     _create_block_header,
     _create_encoded_values,
     _create_file_chunk_header,
     _create_lookup_table,
+    _find_first_lookup_tables,
     _get_buffer_position,
     _pack_encoded_values,
+    _split_into_blocks,
     create_segmentation_chunk,
+    pack_values,
 )
 
+from .reference_encoding import reference_create_segmentation_chunk
+
 
 # Used for decoding the header
 class BlockHeader(LittleEndianStructure):
@@ -98,6 +110,120 @@ def test__pack_encoded_values__needs_32multiple():
         _pack_encoded_values(np.array(array), nb_bits)
 
 
+def test_pack_values():
+    values = np.array([[1, 0, 2, 3, 4], [4, 3, 2, 1, 0]])
+    packed = pack_values(values, 4)
+    assert packed.shape == (2, 1)
+    assert packed[0].tobytes() == _pack_encoded_values(values[0], 4)
+    assert packed[1].tobytes() == _pack_encoded_values(values[1], 4)
+
+
+@pytest.mark.parametrize("nb_bits", [1, 2, 4, 8, 16, 32])
+@pytest.mark.parametrize("nb_values", [37, 512])
+def test_pack_values__matches_shifted_words(nb_bits, nb_values):
+    rng = np.random.default_rng(0)
+    values = rng.integers(0, 2**nb_bits, size=(3, nb_values), dtype=np.uint64)
+    values_per_word = 32 // nb_bits
+    padded = np.zeros(
+        (3, -(-nb_values // values_per_word) * values_per_word), np.uint64
+    )
+    padded[:, :nb_values] = values
+    shifts = np.arange(0, 32, nb_bits, dtype=np.uint64)
+    expected = np.bitwise_or.reduce(
+        padded.reshape(3, -1, values_per_word) << shifts, axis=2
+    ).astype("<I")
+
+    out = np.full(expected.shape, 0xFFFFFFFF, dtype="<I")
+    packed = pack_values(values, nb_bits, out=out)
+
+    assert packed is out
+    assert np.array_equal(packed, expected)
+
+
+def test_pack_values__unknown_bits():
+    with pytest.raises(ValueError):
+        pack_values(np.zeros((1, 8), dtype=np.uint32), 3)
+
+
+def test__split_into_blocks():
+    data = np.arange(4 * 4 * 6).reshape(4, 4, 6)
+    blocks, grid_size = _split_into_blocks(data, (2, 4, 4))
+
+    assert grid_size == (2, 1, 2)
+    assert blocks.shape == (4, 2 * 4 * 4)
+    assert np.array_equal(blocks[0], data[0:2, 0:4, 0:4].ravel())
+    assert np.array_equal(blocks[3].reshape(2, 4, 4)[:, :, :2], data[2:4, :, 4:6])
+    assert np.all(blocks[3].reshape(2, 4, 4)[:, :, 2:] == 0)  # padding
+
+
+def test__compute_lookup_tables():
+    blocks = np.array([[5, 3, 5, 3], [7, 7, 7, 7], [2, 1, 0, 1]])
+    lookup_tables, table_lengths, positions = _compute_lookup_tables(blocks)
+
+    assert np.array_equal(lookup_tables, [3, 5, 7, 0, 1, 2])
+    assert np.array_equal(table_lengths, [2, 1, 3])
+    assert np.array_equal(positions, [[1, 0, 1, 0], [0, 0, 0, 0], [2, 1, 0, 1]])
+
+
+@pytest.mark.parametrize(
+    "dtype, low, high",
+    [
+        (np.uint8, 0, 2),
+        (np.uint32, 0, 12),
+        (np.int16, -5, 300),
+        (np.uint64, 2**40, 2**40 + 1000),
+    ],
+)
+def test__compute_lookup_tables__kernels_are_identical(dtype, low, high):
+    rng = np.random.default_rng(0)
+    blocks = rng.integers(low, high, size=(20, 64), dtype=dtype)
+    blocks[3] = low
+
+    by_sorting = _compute_lookup_tables_by_sorting(blocks)
+    by_counting = _compute_lookup_tables_by_counting(blocks, low, high - low)
+
+    for sorted_result, counted_result in zip(by_sorting, by_counting):
+        assert sorted_result.dtype == counted_result.dtype
+        assert np.array_equal(sorted_result, counted_result)
+
+
+def test__compute_lookup_tables_skipping_uniform_blocks():
+    blocks = np.array([[5, 3, 5, 3], [7, 7, 7, 7], [2, 1, 0, 1], [0, 0, 0, 0]])
+    (
+        lookup_tables,
+        table_lengths,
+        mixed_indices,
+        positions,
+    ) = _compute_lookup_tables_skipping_uniform_blocks(blocks)
+
+    assert np.array_equal(lookup_tables, [3, 5, 7, 0, 1, 2, 0])
+    assert np.array_equal(table_lengths, [2, 1, 3, 1])
+    assert np.array_equal(mixed_indices, [0, 2])
+    assert np.array_equal(positions, [[1, 0, 1, 0], [2, 1, 0, 1]])
+
+
+def test__find_first_lookup_tables():
+    lookup_tables = np.array([0, 1, 0, 0, 1, 3, 0, 1])
+    table_lengths = np.array([2, 1, 2, 1, 2])
+
+    first_table_blocks = _find_first_lookup_tables(lookup_tables, table_lengths)
+
+    assert np.array_equal(first_table_blocks, [0, 1, 0, 3, 0])
+
+
+def test__allocate_chunk_buffer():
+    buffer, words = _allocate_chunk_buffer(3)
+    words[:] = [7, 8, 9]
+
+    assert buffer == struct.pack("<IIII", 1, 7, 8, 9)
+
+
+def test__create_background_chunk():
+    chunk = _create_background_chunk((1, 1, 2), ((0, 0, 0), (8, 8, 16)))
+
+    assert chunk.buffer == struct.pack("<IIIIII", 1, 4, 5, 4, 5, 0)
+
+
 def test__create_encoded_values():
     buffer = bytearray()  # will start in 0
     offset = _create_encoded_values(buffer, np.array([1, 0, 2]), 2)
@@ -207,3 +333,113 @@ def test__create_segmentation_chunk():
 
     assert chunk.dimensions == ((0, 0, 0), (8, 8, 4))
     # TODO expand me!
+
+
+@pytest.mark.parametrize(
+    "shape, block_size, nb_labels",
+    [
+        ((16, 16, 16), (8, 8, 8), 1),
+        ((16, 16, 16), (8, 8, 8), 2),
+        ((16, 16, 16), (8, 8, 8), 5),
+        ((16, 16, 16), (8, 8, 8), 300),
+        ((16, 16, 16), (8, 8, 8), 70000),
+        ((16, 32, 8), (4, 8, 8), 3),
+        ((13, 10, 7), (8, 8, 8), 4),  # partial blocks
+        ((8, 8, 8), (8, 8, 8), 600),
+        ((13, 10, 7), (8, 8, 8), 1),  # background with partial blocks
+    ],
+)
+def test__create_segmentation_chunk__same_bytes_as_reference(
+    shape, block_size, nb_labels
+):
+    rng = np.random.default_rng(42)
+    data = rng.integers(0, nb_labels, size=shape, dtype=np.uint32)
+    # Makes some blocks share their lookup table
+    data[: shape[0] // 2] = 0
+    dimensions = ((0, 0, 0), shape)
+
+    chunk = create_segmentation_chunk(data, dimensions, block_size)
+    expected = reference_create_segmentation_chunk(data, dimensions, block_size)
+
+    assert chunk.buffer == expected.buffer
+
+
+@pytest.mark.parametrize("shape", [(16, 16, 16), (13, 10, 7)])
+def test__create_segmentation_chunk__uniform_blocks(shape):
+    data = np.zeros(shape, dtype=np.uint32)
+    data[:8, :8, :8] = 3
+    data[9:, 9:, 5:] = 7
+    data[2, 3, 4] = 1
+    dimensions = ((0, 0, 0), shape)
+
+    chunk = create_segmentation_chunk(data, dimensions)
+    expected = reference_create_segmentation_chunk(data, dimensions)
+
+    assert chunk.buffer == expected.buffer
+
+
+@pytest.mark.parametrize("nb_labels", [1, 2, 5, 300])
+def test__create_segmentation_chunk__uint64(nb_labels):
+    rng = np.random.default_rng(42)
+    data = rng.integers(0, nb_labels, size=(16, 16, 16), dtype=np.uint64)
+    data[data > 0] += np.uint64(2**40)
+    data[:8] = 0
+    dimensions = ((0, 0, 0), data.shape)
+
+    chunk = create_segmentation_chunk(data, dimensions, data_type="uint64")
+    expected = reference_create_segmentation_chunk(data, dimensions, data_type="uint64")
+
+    assert chunk.buffer == expected.buffer
+
+
+@pytest.mark.parametrize("dtype", [np.int8, np.int16, np.int64])
+def test__create_segmentation_chunk__signed(dtype):
+    rng = np.random.default_rng(42)
+    data = rng.integers(-100, 101, size=(8, 8, 8), dtype=dtype)
+    dimensions = ((0, 0, 0), data.shape)
+
+    chunk = create_segmentation_chunk(data, dimensions)
+    expected = reference_create_segmentation_chunk(data, dimensions)
+
+    assert chunk.buffer == expected.buffer
+
+
+def test__create_segmentation_chunk__uint64_above_int64():
+    data = np.full((8, 8, 8), 2**63 + 5, dtype=np.uint64)
+    data[:4] = 2**63 + 1
+    dimensions = ((0, 0, 0), data.shape)
+
+    chunk = create_segmentation_chunk(data, dimensions, data_type="uint64")
+    expected = reference_create_segmentation_chunk(data, dimensions, data_type="uint64")
+
+    assert chunk.buffer == expected.buffer
+
+
+def test__create_segmentation_chunk__unknown_data_type():
+    with pytest.raises(ValueError):
+        create_segmentation_chunk(
+            np.ones((8, 8, 8)), ((0, 0, 0), (8, 8, 8)), data_type="int16"
+        )
+
+
+def test__create_segmentation_chunk__deduplicate_blocks():
+    # The same 8x8x8 pattern with different labels is repeated in all the blocks
+    rng = np.random.default_rng(0)
+    pattern = rng.integers(0, 2, size=(8, 8, 8), dtype=np.uint32)
+    data = np.tile(pattern, (2, 2, 2))
+    data[8:] *= 3
+    dimensions = ((0, 0, 0), data.shape)
+
+    chunk = create_segmentation_chunk(data, dimensions)
+    not_deduplicated_chunk = create_segmentation_chunk(
+        data, dimensions, deduplicate_blocks=False
+    )
+    expected = reference_create_segmentation_chunk(data, dimensions)
+
+    assert chunk.nb_packed_blocks == 8
+    assert chunk.nb_deduplicated_blocks == 7
+    assert not_deduplicated_chunk.nb_deduplicated_blocks == 0
+    assert not_deduplicated_chunk.buffer == expected.buffer
+    # Only one 8x8x8 block of 1-bit values is written
+    assert len(expected.buffer) - len(chunk.buffer) == 7 * 512 // 8
+    assert np.array_equal(decode_chunk(chunk, (8, 8, 8)), data)
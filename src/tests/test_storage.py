@@ -0,0 +1,66 @@
+from pathlib import Path
+
+import pytest
+from cloudfiles import CloudFiles
+
+from cryo_et_neuroglancer.storage import Uploader, get_local_path, is_remote
+
+
+@pytest.mark.parametrize(
+    "path, expected",
+    [
+        ("s3://bucket/output", True),
+        ("gs://bucket/output", True),
+        ("mem://bucket/output", True),
+        ("file:///data/output", False),
+        ("/data/output", False),
+        (Path("output"), False),
+    ],
+)
+def test_is_remote(path, expected):
+    assert is_remote(path) == expected
+
+
+def test_get_local_path():
+    assert get_local_path("file:///data/output") == Path("/data/output")
+    assert get_local_path("output") == Path("output")
+
+
+def test_uploader(tmp_path):
+    uploader = Uploader("mem://test-uploader/output")
+    uploader.put("data/chunk", b"content")
+    (tmp_path / "by_id").mkdir()
+    (tmp_path / "info").write_bytes(b"{}")
+    (tmp_path / "by_id" / "1").write_bytes(b"annotation")
+    uploader.upload_directory(tmp_path)
+
+    assert sorted(uploader.list_keys()) == ["by_id/1", "data/chunk", "info"]
+    assert uploader.exists("info")
+    files = CloudFiles("mem://test-uploader/output")
+    assert files.get("by_id/1") == b"annotation"
+
+    uploader.delete(uploader.list_keys())
+    assert uploader.list_keys() == []
+
+
+def test_uploader__retries(monkeypatch):
+    uploader = Uploader("mem://test-uploader-retries/output", retry_delay=0)
+    put = uploader.cloudfiles.put
+    nb_calls = 0
+
+    def failing_put(*args, **kwargs):
+        nonlocal nb_calls
+        nb_calls += 1
+        if nb_calls <= 2:
+            raise ConnectionError("Connection reset")
+        return put(*args, **kwargs)
+
+    monkeypatch.setattr(uploader.cloudfiles, "put", failing_put)
+    uploader.put("info", b"{}")
+    assert nb_calls == 3
+    assert uploader.exists("info")
+
+    uploader.max_retries = 1
+    nb_calls = 0
+    with pytest.raises(ConnectionError):
+        uploader.put("info", b"{}")
@@ -1,8 +1,23 @@
+import threading
+import time
+
+import dask.array as da
+import numpy as np
 import pytest
 
 from cryo_et_neuroglancer.utils import (
+    compute_chunk_size,
+    compute_data_contrast_limits,
+    get_chunk_size,
     get_grid_size_from_block_shape,
+    get_tile_chunk_dimensions,
+    get_tile_size,
+    iterate_chunks,
     number_of_encoding_bits,
+    parallel_map,
+    prefetch,
+    process_tiles,
+    split_downsampling_factors,
 )
 
 
@@ -41,3 +56,180 @@ def test___number_of_encoding_bits__too_many_values():
 )
 def test__get_grid_size_from_block_shape(dshape, bshape, expected):
     assert get_grid_size_from_block_shape(dshape, bshape) == expected
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test__parallel_map__keeps_order(workers):
+    def slow_square(x):
+        time.sleep(0.001 * (10 - x))
+        return x * x
+
+    assert list(parallel_map(slow_square, range(10), workers)) == [
+        x * x for x in range(10)
+    ]
+
+
+def test__parallel_map__bounds_in_flight_items():
+    submitted = []
+    lock = threading.Lock()
+
+    def items():
+        for i in range(20):
+            with lock:
+                submitted.append(i)
+            yield i
+
+    for result in parallel_map(lambda x: x, items(), workers=4, max_in_flight=3):
+        with lock:
+            assert len(submitted) <= result + 1 + 3
+
+
+def test__parallel_map__propagates_errors():
+    def fail_on_three(x):
+        if x == 3:
+            raise RuntimeError("boom")
+        return x
+
+    results = parallel_map(fail_on_three, range(10), workers=4)
+    assert [next(results) for _ in range(3)] == [0, 1, 2]
+    with pytest.raises(RuntimeError, match="boom"):
+        next(results)
+
+
+@pytest.mark.parametrize("read_ahead", [0, 1, 3])
+def test__prefetch(read_ahead):
+    assert list(prefetch(iter(range(10)), read_ahead)) == list(range(10))
+
+
+def test__prefetch__bounds_read_ahead():
+    produced = []
+
+    def items():
+        for i in range(10):
+            produced.append(i)
+            yield i
+
+    prefetched = prefetch(items(), read_ahead=2)
+    assert next(prefetched) == 0
+    time.sleep(0.05)
+    # 2 items in the queue and 1 waiting to be put
+    assert len(produced) <= 4
+    prefetched.close()
+
+
+def test__prefetch__propagates_errors():
+    def items():
+        yield 0
+        raise RuntimeError("boom")
+
+    prefetched = prefetch(items(), read_ahead=2)
+    assert next(prefetched) == 0
+    with pytest.raises(RuntimeError, match="boom"):
+        next(prefetched)
+
+
+def test__iterate_chunks__chunk_size():
+    data = np.arange(10 * 12 * 7).reshape(10, 12, 7)
+    dask_data = da.from_array(data, chunks=(10, 12, 7))
+
+    chunks = list(iterate_chunks(dask_data, (4, 6, 7)))
+
+    assert len(chunks) == 3 * 2 * 1
+    for chunk, (start, end) in chunks:
+        region = tuple(slice(s, e) for s, e in zip(start, end))
+        assert np.array_equal(chunk.compute(), data[region])
+    assert chunks[-1][1] == ((8, 6, 0), (10, 12, 7))
+
+
+@pytest.mark.parametrize(
+    "data_shape, expected",
+    [
+        ((500, 1000, 1000), (64, 64, 64)),
+        ((40, 2000, 2000), (40, 80, 80)),
+        ((30, 30, 30), (30, 30, 30)),
+        ((100, 20, 1000), (100, 20, 128)),
+    ],
+)
+def test__compute_chunk_size(data_shape, expected):
+    assert compute_chunk_size(data_shape, (8, 8, 8)) == expected
+
+
+@pytest.mark.parametrize(
+    "chunk_size, expected",
+    [
+        (None, None),
+        (["auto"], "auto"),
+        (["32"], (32, 32, 32)),
+        (["64", "32", "16"], (16, 32, 64)),
+    ],
+)
+def test__get_chunk_size(chunk_size, expected):
+    assert get_chunk_size(chunk_size) == expected
+
+
+@pytest.mark.parametrize("chunk_size", [["1", "2"], ["0"]])
+def test__get_chunk_size__invalid(chunk_size):
+    with pytest.raises(ValueError):
+        get_chunk_size(chunk_size)
+
+
+def test_get_tile_size():
+    assert get_tile_size((4, 8, 8), []) == (4, 8, 8)
+    assert get_tile_size(None, [(2, 2, 2)]) is None
+    assert get_tile_size((4, 8, 8), [(2, 2, 2), (1, 2, 2)]) == (8, 32, 32)
+
+
+def test_get_tile_chunk_dimensions():
+    chunks = get_tile_chunk_dimensions(((0, 0, 8), (8, 8, 13)), (4, 8, 4), [(2, 2, 2)])
+
+    assert chunks == [
+        (0, ((0, 0, 8), (4, 8, 12))),
+        (0, ((0, 0, 12), (4, 8, 13))),
+        (0, ((4, 0, 8), (8, 8, 12))),
+        (0, ((4, 0, 12), (8, 8, 13))),
+        (1, ((0, 0, 4), (4, 4, 7))),
+    ]
+
+
+@pytest.mark.parametrize("workers, read_ahead", [(1, 0), (3, 0), (3, 2)])
+def test_process_tiles(workers, read_ahead):
+    data = da.from_array(np.arange(8 * 8 * 8).reshape(8, 8, 8), chunks=(4, 4, 4))
+
+    results = list(
+        process_tiles(
+            iterate_chunks(data, (4, 8, 8)),
+            lambda tile: [tile[1][0], int(tile[0].sum())],
+            workers,
+            read_ahead=read_ahead,
+        )
+    )
+
+    assert results == [
+        (0, 0, 0),
+        int(data[:4].sum()),
+        (4, 0, 0),
+        int(data[4:].sum()),
+    ]
+
+
+def test_compute_data_contrast_limits():
+    # Only the 4 middle z slices are sampled, the NaN slices are never read
+    data = np.full((20, 16, 16), np.nan)
+    data[8:12] = np.linspace(0, 100, 4 * 16 * 16).reshape(4, 16, 16)
+
+    low, high = compute_data_contrast_limits(da.from_array(data, chunks=(4, 16, 16)))
+
+    assert type(low) is float and type(high) is float
+    assert 0 <= low < 10 and 90 < high <= 100
+
+
+def test_split_downsampling_factors():
+    factors = [(1, 2, 2), (2, 2, 2), (2, 2, 2)]
+
+    assert split_downsampling_factors((8, 8, 8), factors) == [factors]
+    assert split_downsampling_factors((8, 8, 8), factors, 8**3 * 32) == [
+        factors[:2],
+        factors[2:],
+    ]
+    assert split_downsampling_factors((8, 8, 8), factors, 1) == [[f] for f in factors]
+    assert split_downsampling_factors((8, 8, 8), []) == [[]]
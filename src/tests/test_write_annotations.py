@@ -0,0 +1,14 @@
+import pytest
+
+from cryo_et_neuroglancer.cli import parse_args
+from cryo_et_neuroglancer.write_annotations import process_annotation
+
+
+def test_process_annotation__no_output():
+    with pytest.raises(ValueError):
+        process_annotation(({}, []), None, 1.0, ["#ff0000"])  # type: ignore
+
+
+def test_encode_annotation__output_required():
+    with pytest.raises(SystemExit):
+        parse_args(["encode-annotation", "annotations.json"])
@@ -0,0 +1,264 @@
+import json
+from io import BytesIO
+
+import dask.array as da
+import numpy as np
+import pytest
+import zarr
+from cloudfiles import CloudFiles
+from ome_zarr.io import parse_url
+from ome_zarr.writer import write_image
+from PIL import Image
+
+from cryo_et_neuroglancer import write_image as write_image_module
+from cryo_et_neuroglancer.downsampling import downsample_average
+from cryo_et_neuroglancer.io import load_omezarr_data
+from cryo_et_neuroglancer.write_image import (
+    _create_metadata,
+    create_image,
+    create_image_chunk,
+    main,
+    quantize,
+)
+
+
+def _decode_chunk(buffer, shape, data_type="float32"):
+    return np.frombuffer(buffer, dtype=np.dtype(data_type).newbyteorder("<")).reshape(
+        shape
+    )
+
+
+def test_create_image_chunk():
+    data = np.arange(2 * 3 * 4, dtype=np.float32).reshape(2, 3, 4)
+
+    chunk = create_image_chunk(data, ((0, 0, 0), (2, 3, 4)), "float32")
+
+    assert len(chunk.buffer) == data.size * 4
+    # x varies fastest in the raw encoding
+    assert np.frombuffer(chunk.buffer, dtype="<f4")[1] == data[0, 0, 1]
+    assert np.array_equal(_decode_chunk(chunk.buffer, data.shape), data)
+
+
+def test_quantize():
+    data = np.array([-20.0, -10.0, 0.0, 10.0, 20.0], dtype=np.float32)
+
+    quantized = quantize(data, (-10.0, 10.0))
+
+    assert quantized.dtype == np.uint8
+    assert quantized.tolist() == [0, 0, 128, 255, 255]
+
+
+def test_create_image_chunk__jpeg():
+    data = np.tile(np.arange(0, 256, 16, dtype=np.uint8), (2, 8, 1))
+
+    chunk = create_image_chunk(data, ((0, 0, 0), (2, 8, 16)), "uint8", "jpeg", 95)
+
+    image = Image.open(BytesIO(chunk.buffer))
+    assert image.format == "JPEG"
+    # The z slices are stacked along y
+    assert image.size == (16, 2 * 8)
+    decoded = np.asarray(image).reshape(data.shape)
+    assert np.abs(decoded.astype(int) - data).max() <= 4
+
+
+def test_create_image_chunk__jpeg_float():
+    with pytest.raises(ValueError):
+        create_image_chunk(
+            np.zeros((1, 1, 1)), ((0, 0, 0), (1, 1, 1)), "float32", "jpeg"
+        )
+
+
+def test__create_metadata():
+    metadata = _create_metadata(
+        (8, 16, 32),
+        (20, 40, 80),
+        "data",
+        (2.0, 2.0, 4.0),
+        "uint8",
+        [((10, 20, 40), (2, 2, 2))],
+    )
+
+    assert metadata["type"] == "image"
+    assert metadata["data_type"] == "uint8"
+    assert [s["encoding"] for s in metadata["scales"]] == ["raw", "raw"]
+    assert metadata["scales"][0]["chunk_sizes"] == [(32, 16, 8)]
+    assert metadata["scales"][1]["key"] == "data_1"
+    assert metadata["scales"][1]["size"] == (40, 20, 10)
+    assert metadata["scales"][1]["resolution"] == (4.0, 4.0, 8.0)
+
+
+def test_create_image__downsampling(tmp_path):
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(20, 36, 44)).astype(np.float32)
+    factors = [(2, 2, 2), (1, 2, 2)]
+    directories = [tmp_path / f"data_{i}" for i in range(3)]
+
+    chunks = list(
+        create_image(
+            da.from_array(data, chunks=(10, 18, 22)),
+            "float32",
+            workers=2,
+            output_directories=directories,
+            chunk_size=(4, 8, 8),
+            downsampling_factors=factors,
+        )
+    )
+
+    expected = data
+    for scale in range(3):
+        if scale > 0:
+            expected = downsample_average(expected, factors[scale - 1])
+        decoded = np.zeros_like(expected)
+        scale_chunks = [c for c in chunks if c.scale == scale]
+        assert len(list(directories[scale].iterdir())) == len(scale_chunks)
+        for chunk in scale_chunks:
+            (z0, y0, x0), (z1, y1, x1) = chunk.dimensions
+            decoded[z0:z1, y0:y1, x0:x1] = _decode_chunk(chunk.buffer, chunk.shape)
+        np.testing.assert_allclose(decoded, expected, rtol=1e-5)
+
+
+def test_main(tmp_path):
+    data = np.arange(16 * 64 * 64, dtype=np.float64).reshape(16, 64, 64)
+    zarr_path = tmp_path / "tomogram.zarr"
+    root = zarr.group(store=parse_url(zarr_path, mode="w").store)
+    write_image(data, root, axes="zyx", storage_options=dict(chunks=(16, 64, 64)))
+
+    main(zarr_path, output_path=tmp_path / "image", chunk_size=(16, 16, 16))
+
+    info = json.loads((tmp_path / "image" / "info").read_text())
+    assert info["data_type"] == "float32"
+    assert [s["size"] for s in info["scales"]] == [
+        [64, 64, 16],
+        [32, 32, 16],
+        [16, 16, 16],
+    ]
+    lowest = (tmp_path / "image" / "data_2" / "0-16_0-16_0-16").read_bytes()
+    assert np.allclose(
+        _decode_chunk(lowest, (16, 16, 16)),
+        # The Z axis fits in one chunk and keeps its resolution
+        downsample_average(downsample_average(data, (1, 2, 2)), (1, 2, 2)),
+    )
+
+
+@pytest.mark.parametrize("encoding", ["raw", "jpeg"])
+def test_main__quantize(tmp_path, encoding):
+    data = np.linspace(-50, 50, 16 * 32 * 32).reshape(16, 32, 32)
+    zarr_path = tmp_path / "tomogram.zarr"
+    root = zarr.group(store=parse_url(zarr_path, mode="w").store)
+    write_image(data, root, axes="zyx", storage_options=dict(chunks=(16, 32, 32)))
+
+    main(
+        zarr_path,
+        output_path=tmp_path / "image",
+        chunk_size=(16, 32, 32),
+        max_scales=1,
+        encoding=encoding,
+        quantize_to_uint8=True,
+        contrast_limits=(-25.0, 25.0),
+    )
+
+    info = json.loads((tmp_path / "image" / "info").read_text())
+    assert info["data_type"] == "uint8"
+    assert info["scales"][0]["encoding"] == encoding
+    assert info["_non_neuroglancer_contrast_limits"] == [-25.0, 25.0]
+    content = (tmp_path / "image" / "data" / "0-32_0-32_0-16").read_bytes()
+    if encoding == "jpeg":
+        decoded = np.asarray(Image.open(BytesIO(content))).reshape(data.shape)
+        tolerance = 8
+    else:
+        decoded = _decode_chunk(content, data.shape, "uint8")
+        tolerance = 0
+    expected = quantize(data, (-25.0, 25.0))
+    assert np.abs(decoded.astype(int) - expected).max() <= tolerance
+
+
+def test_main__quantize_default_window(tmp_path, monkeypatch, capsys):
+    data = np.linspace(-50, 50, 16 * 32 * 32).reshape(16, 32, 32)
+    zarr_path = tmp_path / "tomogram.zarr"
+    root = zarr.group(store=parse_url(zarr_path, mode="w").store)
+    write_image(data, root, axes="zyx", storage_options=dict(chunks=(4, 32, 32)))
+    persisted = []
+
+    def load(filename, persist=True):
+        persisted.append(persist)
+        return load_omezarr_data(filename, persist)
+
+    monkeypatch.setattr(write_image_module, "load_omezarr_data", load)
+
+    main(
+        zarr_path,
+        output_path=tmp_path / "image",
+        streaming=True,
+        quantize_to_uint8=True,
+    )
+
+    # The window is estimated on the middle slices of the lazily loaded volume
+    assert persisted == [False]
+    low, high = json.loads((tmp_path / "image" / "info").read_text())[
+        "_non_neuroglancer_contrast_limits"
+    ]
+    assert -12.5 < low < high < 12.5
+    assert f"Quantizing the window ({low}, {high}) to uint8" in capsys.readouterr().out
+
+
+def _read_output(directory):
+    return {
+        path.relative_to(directory): path.read_bytes()
+        for path in directory.rglob("*")
+        if path.is_file()
+    }
+
+
+@pytest.mark.parametrize("quantize_to_uint8", [False, True])
+def test_main__several_passes(tmp_path, capsys, quantize_to_uint8):
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(20, 70, 60)).astype(np.float32)
+    zarr_path = tmp_path / "tomogram.zarr"
+    root = zarr.group(store=parse_url(zarr_path, mode="w").store)
+    write_image(data, root, axes="zyx", storage_options=dict(chunks=(20, 70, 60)))
+    parameters = dict(
+        chunk_size=(4, 8, 8),
+        max_scales=4,
+        quantize_to_uint8=quantize_to_uint8,
+        contrast_limits=(-2.0, 2.0),
+    )
+
+    main(zarr_path, output_path=tmp_path / "expected", **parameters)
+    main(
+        zarr_path,
+        output_path=tmp_path / "passes",
+        max_tile_nb_voxels=4 * 8 * 8 * 8,
+        **parameters,
+    )
+
+    assert "Downsampling in 3 passes" in capsys.readouterr().out
+    assert _read_output(tmp_path / "passes") == _read_output(tmp_path / "expected")
+
+
+def test_main__jpeg_without_quantization(tmp_path):
+    with pytest.raises(ValueError):
+        main(tmp_path / "tomogram.zarr", encoding="jpeg")
+
+
+def test_main__remote_output(tmp_path):
+    data = np.arange(16 * 32 * 32, dtype=np.float32).reshape(16, 32, 32)
+    zarr_path = tmp_path / "tomogram.zarr"
+    root = zarr.group(store=parse_url(zarr_path, mode="w").store)
+    write_image(data, root, axes="zyx", storage_options=dict(chunks=(16, 32, 32)))
+    url = f"mem://{tmp_path.name}/image"
+
+    main(zarr_path, output_path=tmp_path / "local", chunk_size=(16, 16, 16))
+    main(zarr_path, output_path=url, chunk_size=(16, 16, 16))
+
+    local = tmp_path / "local"
+    expected = {
+        path.relative_to(local).as_posix(): path.read_bytes()
+        for path in local.rglob("*")
+        if path.is_file()
+    }
+    files = CloudFiles(url)
+    assert sorted(files.list()) == sorted(expected)
+    for key, content in expected.items():
+        assert files.get(key) == content
+    with pytest.raises(SystemExit):
+        main(zarr_path, output_path=url, chunk_size=(16, 16, 16))
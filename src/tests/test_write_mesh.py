@@ -0,0 +1,135 @@
+import gzip
+import json
+from collections import Counter
+
+import dask.array as da
+import numpy as np
+import pytest
+import zarr
+from ome_zarr.io import parse_url
+from ome_zarr.writer import write_image
+
+from cryo_et_neuroglancer.sharding import ShardingSpecification
+from cryo_et_neuroglancer.write_mesh import (
+    compute_mesh_sharding_specification,
+    create_meshes,
+    decode_mesh,
+    encode_mesh,
+    merge_meshes,
+)
+from cryo_et_neuroglancer.write_segmentation import main
+
+from .test_chunk_sharding import read_sharded_chunk
+
+
+def _create_labels():
+    data = np.zeros((20, 20, 20), dtype=np.uint32)
+    data[3:15, 4:16, 5:17] = 7
+    data[10:18, 10:18, 10:18] = 3
+    return data
+
+
+def _get_mesh(fragments, label):
+    return merge_meshes([decode_mesh(f.buffer) for f in fragments if f.label == label])
+
+
+def _get_edge_counts(vertices, faces):
+    """Return how many edges are shared by n triangles, once the duplicated vertices merged"""
+    _, inverse = np.unique(vertices, axis=0, return_inverse=True)
+    faces = inverse.reshape(-1)[faces]
+    edges = np.sort(
+        np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]]), axis=1
+    )
+    _, counts = np.unique(edges, axis=0, return_counts=True)
+    return Counter(counts.tolist())
+
+
+def test_encode_mesh():
+    vertices = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0]], dtype=np.float32)
+    faces = np.array([[0, 1, 2]], dtype=np.uint32)
+
+    content = encode_mesh(vertices, faces)
+
+    assert len(content) == 4 + 3 * 3 * 4 + 3 * 4
+    assert np.frombuffer(content[:4], dtype="<u4")[0] == 3
+    decoded_vertices, decoded_faces = decode_mesh(content)
+    assert np.array_equal(decoded_vertices, vertices)
+    assert np.array_equal(decoded_faces, faces)
+
+
+@pytest.mark.parametrize("tile_size", [(20, 20, 20), (8, 8, 8), (7, 5, 19)])
+def test_create_meshes(tile_size):
+    data = _create_labels()
+    whole = list(create_meshes(da.from_array(data), (20, 20, 20), (1.0, 2.0, 3.0)))
+
+    fragments = list(
+        create_meshes(
+            da.from_array(data, chunks=(6, 6, 6)),
+            tile_size,
+            (1.0, 2.0, 3.0),
+            workers=2,
+        )
+    )
+
+    assert {f.label for f in fragments} == {3, 7}
+    vertices, faces = _get_mesh(fragments, 7)
+    expected_vertices, _ = _get_mesh(whole, 7)
+    # The fragments join into the same closed surface whatever the tiles
+    assert _get_edge_counts(vertices, faces).keys() == {2}
+    assert np.array_equal(
+        np.unique(vertices, axis=0), np.unique(expected_vertices, axis=0)
+    )
+    # The voxels 5 to 16 along x span from 5 to 17 times the resolution
+    assert np.array_equal(vertices.min(axis=0), [5.0, 8.0, 9.0])
+    assert np.array_equal(vertices.max(axis=0), [17.0, 32.0, 45.0])
+
+
+def test_compute_mesh_sharding_specification():
+    specification = compute_mesh_sharding_specification(1000, 4000, 1000)
+
+    assert specification.hash == "identity"
+    assert specification.shard_bits == 2
+    assert specification.minishard_bits == 3
+
+
+@pytest.mark.parametrize("sharded", [False, True])
+def test_main__include_mesh(tmp_path, sharded):
+    data = _create_labels()
+    zarr_path = tmp_path / "labels.zarr"
+    root = zarr.group(store=parse_url(zarr_path, mode="w").store)
+    write_image(data, root, axes="zyx", storage_options=dict(chunks=(20, 20, 20)))
+    output = tmp_path / "output"
+
+    main(
+        zarr_path,
+        (8, 8, 8),
+        output_path=output,
+        chunk_size=(8, 8, 8),
+        sharded=sharded,
+        target_shard_size=1000,
+        include_mesh=True,
+    )
+
+    info = json.loads((output / "info").read_text())
+    assert info["mesh"] == "mesh"
+    assert sorted(p.name for p in output.iterdir()) == ["data", "info", "mesh"]
+    fragments = list(create_meshes(da.from_array(data), (8, 8, 8)))
+    directory = output / "mesh"
+    info = json.loads((directory / "info").read_text())
+    assert info["@type"] == "neuroglancer_legacy_mesh"
+    for label in (3, 7):
+        if sharded:
+            specification = ShardingSpecification.from_dict(info["sharding"])
+            content = read_sharded_chunk(directory, specification, label)
+            vertices, faces = decode_mesh(gzip.decompress(content))
+        else:
+            manifest = json.loads((directory / f"{label}:0").read_text())
+            vertices, faces = merge_meshes(
+                [
+                    decode_mesh((directory / name).read_bytes())
+                    for name in manifest["fragments"]
+                ]
+            )
+        expected_vertices, expected_faces = _get_mesh(fragments, label)
+        assert np.array_equal(vertices, expected_vertices)
+        assert np.array_equal(faces, expected_faces)
@@ -0,0 +1,445 @@
+import gzip
+import json
+
+import dask.array as da
+import numpy as np
+import pytest
+import zarr
+from cloudfiles import CloudFiles
+from ome_zarr.io import parse_url
+from ome_zarr.writer import write_image
+
+from cryo_et_neuroglancer import chunk_writer
+from cryo_et_neuroglancer.chunk import Chunk
+from cryo_et_neuroglancer.chunk_sharding import compressed_morton_code
+
+from cryo_et_neuroglancer.downsampling import downsample_labels
+from cryo_et_neuroglancer.io import write_bytes_atomically
+from cryo_et_neuroglancer.relabel import LabelMapping
+from cryo_et_neuroglancer.segmentation_decoding import decode_chunk
+from cryo_et_neuroglancer.write_segmentation import (
+    _create_metadata,
+    _get_data_type,
+    create_segmentation,
+    main,
+)
+from cryo_et_neuroglancer.sharding import ShardingSpecification
+
+from .test_chunk_sharding import read_sharded_chunk
+
+
+@pytest.mark.parametrize(
+    "data, convert_non_zero_to, expected",
+    [
+        (np.array([0, 1, 2], dtype=np.uint8), 0, "uint32"),
+        (np.array([0, 1, 2**32 - 1], dtype=np.uint32), 0, "uint32"),
+        (np.array([0, 1, 2], dtype=np.uint64), 0, "uint32"),
+        (np.array([0, 1, 2**32], dtype=np.uint64), 0, "uint64"),
+        (np.array([0, 1, 2**32], dtype=np.int64), 1, "uint32"),
+    ],
+)
+def test__get_data_type(data, convert_non_zero_to, expected):
+    dask_data = da.from_array(data, chunks=2)
+    assert _get_data_type(dask_data, convert_non_zero_to) == expected
+
+
+def test__get_data_type__complete_mapping(monkeypatch):
+    data = np.array([0, 2**40, 2**41], dtype=np.uint64)
+    mapping = LabelMapping.from_dict({2**40: 1, 2**41: 2})
+    mapping.is_complete = True
+    # The labels of a complete mapping are known without reading the data
+    monkeypatch.setattr(da, "unique", None)
+
+    assert _get_data_type(da.from_array(data), 0, mapping) == "uint32"
+
+
+def test__create_metadata():
+    metadata = _create_metadata(
+        (32, 64, 64), (8, 8, 8), (100, 200, 300), "data", data_type="uint64"
+    )
+
+    assert metadata["data_type"] == "uint64"
+    scale = metadata["scales"][0]
+    assert scale["chunk_sizes"] == [(64, 64, 32)]
+    assert scale["size"] == (300, 200, 100)
+    assert len(metadata["scales"]) == 1
+
+
+def test__create_metadata__lower_scales():
+    metadata = _create_metadata(
+        (32, 64, 64),
+        (8, 8, 8),
+        (100, 200, 300),
+        "data",
+        resolution=(1.0, 1.0, 2.0),
+        lower_scales=[((100, 100, 150), (1, 2, 2))],
+    )
+
+    scales = metadata["scales"]
+    assert [scale["key"] for scale in scales] == ["data", "data_1"]
+    assert scales[1]["size"] == (150, 100, 100)
+    assert scales[1]["resolution"] == (2.0, 2.0, 2.0)
+    assert scales[1]["chunk_sizes"] == scales[0]["chunk_sizes"]
+
+
+@pytest.mark.parametrize("workers, read_ahead", [(1, 0), (3, 0), (1, 2), (3, 2)])
+def test_create_segmentation__workers(tmp_path, workers, read_ahead):
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 5, size=(20, 24, 24), dtype=np.uint32)
+    data[:10] = 0
+    dask_data = da.from_array(data, chunks=(10, 12, 12))
+
+    serial = list(create_segmentation(dask_data, (8, 8, 8)))
+    parallel = list(
+        create_segmentation(
+            dask_data,
+            (8, 8, 8),
+            workers=workers,
+            max_in_flight=2,
+            read_ahead=read_ahead,
+            output_directories=[tmp_path],
+            skip_empty_chunks=True,
+        )
+    )
+
+    assert [c.dimensions for c in parallel] == [c.dimensions for c in serial]
+    assert [c.buffer for c in parallel] == [c.buffer for c in serial]
+    written = sorted(path.name for path in tmp_path.iterdir())
+    assert written == sorted(c.get_name() for c in serial if not c.is_empty)
+
+
+def test_create_segmentation__chunk_size():
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 5, size=(20, 24, 24), dtype=np.uint32)
+    dask_data = da.from_array(data, chunks=(20, 24, 24))
+
+    chunks = list(create_segmentation(dask_data, (8, 8, 8), chunk_size=(8, 16, 24)))
+
+    assert len(chunks) == 3 * 2 * 1
+    assert chunks[1].dimensions == ((0, 16, 0), (8, 24, 24))
+    assert chunks[-1].shape == (4, 8, 24)
+
+
+def test_create_segmentation__downsampling(tmp_path):
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 3, size=(20, 40, 48), dtype=np.uint32)
+    dask_data = da.from_array(data, chunks=(20, 40, 48))
+    factors = [(1, 2, 2), (1, 2, 2)]
+    directories = [tmp_path / f"scale_{scale}" for scale in range(3)]
+
+    chunks = list(
+        create_segmentation(
+            dask_data,
+            (8, 8, 8),
+            chunk_size=(20, 8, 8),
+            downsampling_factors=factors,
+            output_directories=directories,
+            workers=2,
+        )
+    )
+
+    expected = [data]
+    for factor in factors:
+        expected.append(downsample_labels(expected[-1], factor))
+    for scale, scale_data in enumerate(expected):
+        scale_chunks = [c for c in chunks if c.scale == scale]
+        assert len(list(directories[scale].iterdir())) == len(scale_chunks)
+        decoded = np.zeros_like(scale_data)
+        for chunk in scale_chunks:
+            (z0, y0, x0), (z1, y1, x1) = chunk.dimensions
+            decoded[z0:z1, y0:y1, x0:x1] = decode_chunk(chunk, (8, 8, 8))
+        assert np.array_equal(decoded, scale_data)
+
+
+def test_main__sharded(tmp_path):
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 3, size=(24, 40, 48), dtype=np.uint32)
+    zarr_path = tmp_path / "labels.zarr"
+    root = zarr.group(store=parse_url(zarr_path, mode="w").store)
+    write_image(data, root, axes="zyx", storage_options=dict(chunks=(24, 40, 48)))
+
+    main(zarr_path, (8, 8, 8), output_path=tmp_path / "files", chunk_size=(8, 16, 16))
+    main(
+        zarr_path,
+        (8, 8, 8),
+        output_path=tmp_path / "shards",
+        chunk_size=(8, 16, 16),
+        sharded=True,
+        target_shard_size=8 * 8 * 16 * 16 * 4 * 4,
+    )
+
+    info = json.loads((tmp_path / "shards" / "info").read_text())
+    specification = ShardingSpecification.from_dict(info["scales"][0]["sharding"])
+    assert specification.shard_bits > 0
+    for path in (tmp_path / "files" / "data").iterdir():
+        (x0, _), (y0, _), (z0, _) = [
+            map(int, r.split("-")) for r in path.name.split("_")
+        ]
+        position = np.array([[z0 // 8, y0 // 16, x0 // 16]])
+        key = int(compressed_morton_code(position, (3, 3, 3))[0])
+        chunk = read_sharded_chunk(tmp_path / "shards" / "data", specification, key)
+        assert chunk == path.read_bytes()
+
+
+def _read_output(directory):
+    return {
+        path.relative_to(directory): path.read_bytes()
+        for path in directory.rglob("*")
+        if path.is_file()
+    }
+
+
+def test_main__without_filename(tmp_path, capsys):
+    data = da.from_array(np.ones((8, 8, 8), dtype=np.uint32))
+
+    main(None, (8, 8, 8), output_path=tmp_path / "output", dask_data=data, name="ones")
+
+    assert "Converting ones to" in capsys.readouterr().out
+    assert (tmp_path / "output" / "info").exists()
+    with pytest.raises(ValueError):
+        main(None, (8, 8, 8), dask_data=data)
+
+
+@pytest.mark.parametrize("sharded", [False, True])
+def test_main__several_passes(tmp_path, capsys, sharded):
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 4, size=(32, 64, 64), dtype=np.uint32)
+    parameters = dict(
+        dask_data=da.from_array(data),
+        block_size=(4, 4, 4),
+        chunk_size=(4, 8, 8),
+        max_scales=4,
+        sharded=sharded,
+    )
+
+    main(tmp_path / "labels.zarr", output_path=tmp_path / "expected", **parameters)
+    expected = _read_output(tmp_path / "expected")
+    main(
+        tmp_path / "labels.zarr",
+        output_path=tmp_path / "passes",
+        max_tile_nb_voxels=4 * 8 * 8 * 8,
+        **parameters,
+    )
+
+    assert "Downsampling in 3 passes" in capsys.readouterr().out
+    assert _read_output(tmp_path / "passes") == expected
+
+
+@pytest.mark.parametrize("sharded", [False, True])
+def test_main__resume(tmp_path, monkeypatch, sharded):
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 3, size=(24, 40, 48), dtype=np.uint32)
+    zarr_path = tmp_path / "labels.zarr"
+    root = zarr.group(store=parse_url(zarr_path, mode="w").store)
+    write_image(data, root, axes="zyx", storage_options=dict(chunks=(24, 40, 48)))
+    parameters = dict(
+        chunk_size=(8, 16, 16),
+        max_scales=2,
+        sharded=sharded,
+        target_shard_size=8 * 8 * 16 * 16 * 4,
+    )
+    main(zarr_path, (8, 8, 8), output_path=tmp_path / "expected", **parameters)
+    expected = _read_output(tmp_path / "expected")
+
+    # Interrupt the conversion after a few files are written
+    output_path = tmp_path / "resumed"
+    nb_writes = 0
+
+    def interrupted_write(path, content, fsync):
+        nonlocal nb_writes
+        nb_writes += 1
+        if nb_writes > 3:
+            raise KeyboardInterrupt
+        write_bytes_atomically(path, content, fsync)
+
+    monkeypatch.setattr(chunk_writer, "write_bytes_atomically", interrupted_write)
+    with pytest.raises(KeyboardInterrupt):
+        main(
+            zarr_path,
+            (8, 8, 8),
+            output_path=output_path,
+            resume=True,
+            writer_workers=1,
+            **parameters,
+        )
+    monkeypatch.undo()
+    assert not (output_path / "info").exists()
+    written = sorted((output_path / "data").iterdir())
+    assert len(written) == 3
+    written[0].write_bytes(b"corrupted")
+
+    rewritten = []
+    monkeypatch.setattr(
+        chunk_writer,
+        "write_bytes_atomically",
+        lambda path, content, fsync: (
+            rewritten.append(path) or write_bytes_atomically(path, content, fsync)
+        ),
+    )
+    main(zarr_path, (8, 8, 8), output_path=output_path, resume=True, **parameters)
+    assert _read_output(output_path) == expected
+    assert written[0] in rewritten
+    assert written[1] not in rewritten and written[2] not in rewritten
+
+
+def test_main__gzip(tmp_path):
+    data = np.zeros((16, 32, 32), dtype=np.uint32)
+    data[4:12, 8:24, 8:24] = 2
+    zarr_path = tmp_path / "labels.zarr"
+    root = zarr.group(store=parse_url(zarr_path, mode="w").store)
+    write_image(data, root, axes="zyx", storage_options=dict(chunks=(16, 32, 32)))
+
+    main(zarr_path, (8, 8, 8), output_path=tmp_path / "raw", chunk_size=(8, 16, 16))
+    main(
+        zarr_path,
+        (8, 8, 8),
+        output_path=tmp_path / "gzip",
+        chunk_size=(8, 16, 16),
+        compression_level=9,
+    )
+
+    raw_files = sorted((tmp_path / "raw" / "data").iterdir())
+    gzip_files = sorted((tmp_path / "gzip" / "data").iterdir())
+    assert [f.name + ".gz" for f in raw_files] == [f.name for f in gzip_files]
+    for raw_file, gzip_file in zip(raw_files, gzip_files):
+        assert gzip.decompress(gzip_file.read_bytes()) == raw_file.read_bytes()
+
+
+def test_main__gzip_sharded(tmp_path):
+    with pytest.raises(ValueError):
+        main(tmp_path / "labels.zarr", sharded=True, compression_level=9)
+
+
+@pytest.mark.parametrize(
+    "parameters",
+    [
+        dict(max_scales=2),
+        dict(sharded=True, target_shard_size=8 * 8 * 16 * 16 * 4),
+        dict(compression_level=6),
+    ],
+)
+def test_main__object_store(tmp_path, parameters):
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 3, size=(24, 40, 48), dtype=np.uint32)
+    zarr_path = tmp_path / "labels.zarr"
+    root = zarr.group(store=parse_url(zarr_path, mode="w").store)
+    write_image(data, root, axes="zyx", storage_options=dict(chunks=(24, 40, 48)))
+    url = f"mem://{tmp_path.name}/output"
+
+    main(
+        zarr_path,
+        (8, 8, 8),
+        output_path=tmp_path / "local",
+        chunk_size=(8, 16, 16),
+        **parameters,
+    )
+    main(zarr_path, (8, 8, 8), output_path=url, chunk_size=(8, 16, 16), **parameters)
+
+    expected = {}
+    for path, content in _read_output(tmp_path / "local").items():
+        if path.suffix == ".gz":
+            # Uploaded under the chunk name, with a gzip content encoding
+            path, content = path.with_suffix(""), gzip.decompress(content)
+        expected[path.as_posix()] = content
+    files = CloudFiles(url)
+    assert sorted(files.list()) == sorted(expected)
+    for key, content in expected.items():
+        assert files.get(key) == content
+
+    with pytest.raises(SystemExit):
+        main(
+            zarr_path, (8, 8, 8), output_path=url, chunk_size=(8, 16, 16), **parameters
+        )
+
+
+@pytest.mark.parametrize("resume", [False, True])
+def test_main__label_statistics(tmp_path, monkeypatch, resume):
+    data = np.zeros((24, 40, 48), dtype=np.uint32)
+    data[2:10, 5:30, 7:9] = 3
+    data[12:24, 0:40, 40:48] = 8
+    zarr_path = tmp_path / "labels.zarr"
+    root = zarr.group(store=parse_url(zarr_path, mode="w").store)
+    write_image(data, root, axes="zyx", storage_options=dict(chunks=(24, 40, 48)))
+    output_path = tmp_path / "output"
+    parameters = dict(chunk_size=(8, 16, 16), resume=resume)
+    if resume:
+        # The tiles converted before the interruption are only read for their statistics
+        nb_writes = 0
+
+        def interrupted_write(path, content, fsync):
+            nonlocal nb_writes
+            nb_writes += 1
+            if nb_writes > 3:
+                raise KeyboardInterrupt
+            write_bytes_atomically(path, content, fsync)
+
+        monkeypatch.setattr(chunk_writer, "write_bytes_atomically", interrupted_write)
+        with pytest.raises(KeyboardInterrupt):
+            main(
+                zarr_path,
+                (8, 8, 8),
+                output_path=output_path,
+                writer_workers=1,
+                collect_label_statistics=True,
+                **parameters,
+            )
+        monkeypatch.undo()
+
+    main(
+        zarr_path,
+        (8, 8, 8),
+        output_path=output_path,
+        collect_label_statistics=True,
+        **parameters,
+    )
+
+    info = json.loads((output_path / "info").read_text())
+    assert info["segment_properties"] == "segment_properties"
+    properties = json.loads((output_path / "segment_properties" / "info").read_text())
+    assert properties["inline"]["ids"] == ["3", "8"]
+    assert properties["inline"]["properties"][1]["values"] == [8 * 25 * 2, 12 * 40 * 8]
+    statistics = json.loads((output_path / "label_statistics.json").read_text())
+    assert statistics["labels"]["3"]["bounding_box"] == {
+        "start": [7, 5, 2],
+        "end": [9, 30, 10],
+    }
+    assert statistics["labels"]["8"]["chunks"] == sorted(
+        f"32-48_{y}-{y + 16 if y < 32 else 40}_{z}-{z + 8}"
+        for y in (0, 16, 32)
+        for z in (8, 16)
+    )
+
+
+def test_main__compact_labels(tmp_path):
+    data = np.zeros((16, 32, 32), dtype=np.uint64)
+    data[2:10, 5:20, 3:9] = 2**40
+    data[8:16, 10:30, 20:32] = 2**36 + 3
+    data[0:4, 0:4, 0:4] = 5
+    zarr_path = tmp_path / "labels.zarr"
+    root = zarr.group(store=parse_url(zarr_path, mode="w").store)
+    write_image(data, root, axes="zyx", storage_options=dict(chunks=(16, 32, 32)))
+    mapping = LabelMapping.from_dict({5: 0})
+
+    main(
+        zarr_path,
+        (8, 8, 8),
+        output_path=tmp_path / "output",
+        chunk_size=(8, 16, 16),
+        label_mapping=mapping,
+        compact_labels=True,
+    )
+
+    info = json.loads((tmp_path / "output" / "info").read_text())
+    assert info["data_type"] == "uint32"
+    saved = json.loads((tmp_path / "output" / "label_mapping.json").read_text())
+    assert saved == {"0": 0, "5": 0, str(2**36 + 3): 1, str(2**40): 2}
+    expected = np.zeros((16, 32, 32), dtype=np.uint32)
+    expected[2:10, 5:20, 3:9] = 2
+    expected[8:16, 10:30, 20:32] = 1
+    for path in (tmp_path / "output" / "data").iterdir():
+        (x0, x1), (y0, y1), (z0, z1) = [
+            map(int, r.split("-")) for r in path.name.split("_")
+        ]
+        chunk = Chunk(bytearray(path.read_bytes()), ((z0, y0, x0), (z1, y1, x1)))
+        decoded = decode_chunk(chunk, (8, 8, 8))
+        assert np.array_equal(decoded, expected[z0:z1, y0:y1, x0:x1])